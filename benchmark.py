@@ -0,0 +1,416 @@
+"""Benchmarks da integração ZIG-Omie.
+
+Uso:
+    python benchmark.py parse --lote 10000
+    python benchmark.py e2e --notas 2000 --itens-max 200 --omie-latencia 0.05 --taxa-fault 0.01
+    python benchmark.py memoria --notas 2000 --por-pagina 100 500 2000
+"""
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+import integracao
+
+NFE_NAMESPACE = 'http://www.portalfiscal.inf.br/nfe'
+
+PRODUTOS = [
+    ('CHOPP PILSEN 300ML', '22030000', 'UN', 12.90),
+    ('AGUA MINERAL 500ML', '22011000', 'UN', 6.00),
+    ('REFRIGERANTE LATA', '22021000', 'UN', 7.50),
+    ('PORCAO DE FRITAS', '21069090', 'UN', 34.00),
+    ('GIN TONICA', '22085000', 'UN', 32.00),
+    ('HAMBURGUER ARTESANAL', '16025000', 'UN', 42.00),
+]
+
+def gerar_nfce_xml(numero, itens=3, emissao=None, rng=random):
+    """Gera o XML de uma NFC-e autorizada no formato devolvido pela ZIG."""
+    emissao = emissao or datetime(2024, 10, 23, 20, 15, 30)
+    dets = []
+    total = 0.0
+    for n in range(1, itens + 1):
+        descricao, ncm, unidade, preco = PRODUTOS[rng.randrange(len(PRODUTOS))]
+        quantidade = rng.randint(1, 4)
+        valor = round(preco * quantidade, 2)
+        total += valor
+        dets.append(
+            f'<det nItem="{n}"><prod><cProd>{1000 + n}</cProd><cEAN>SEM GTIN</cEAN>'
+            f'<xProd>{descricao} &amp; CIA</xProd><NCM>{ncm}</NCM><CFOP>5102</CFOP><uCom>{unidade}</uCom>'
+            f'<qCom>{quantidade:.4f}</qCom><vUnCom>{preco:.2f}</vUnCom><vProd>{valor:.2f}</vProd>'
+            f'<cEANTrib>SEM GTIN</cEANTrib><uTrib>{unidade}</uTrib><qTrib>{quantidade:.4f}</qTrib>'
+            f'<vUnTrib>{preco:.2f}</vUnTrib><indTot>1</indTot></prod>'
+            f'<imposto><vTotTrib>{valor * 0.1:.2f}</vTotTrib><ICMS><ICMSSN102><orig>0</orig><CSOSN>102</CSOSN>'
+            f'</ICMSSN102></ICMS></imposto></det>'
+        )
+    chave = f"3524{numero:040d}"
+    tpag = rng.choice(['01', '03', '04', '17'])
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NFE_NAMESPACE}" versao="4.00">'
+        f'<NFe xmlns="{NFE_NAMESPACE}"><infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>35</cUF>'
+        f'<cNF>{numero % 99999999:08d}</cNF><natOp>VENDA</natOp><mod>65</mod><serie>1</serie><nNF>{numero}</nNF>'
+        f'<dhEmi>{emissao.strftime("%Y-%m-%dT%H:%M:%S")}-03:00</dhEmi><tpNF>1</tpNF><idDest>1</idDest>'
+        f'<cMunFG>3550308</cMunFG><tpImp>4</tpImp><tpEmis>1</tpEmis><cDV>0</cDV><tpAmb>1</tpAmb><finNFe>1</finNFe>'
+        f'<indFinal>1</indFinal><indPres>1</indPres><procEmi>0</procEmi><verProc>ZIG 2.0</verProc></ide>'
+        f'<emit><CNPJ>12345678000199</CNPJ><xNome>COMERCIO DE BEBIDAS EXEMPLO LTDA</xNome>'
+        f'<xFant>COMERCIO DE EXEMPLO LTDA</xFant><enderEmit><xLgr>RUA EXEMPLO</xLgr><nro>100</nro>'
+        f'<xBairro>CENTRO</xBairro><cMun>3550308</cMun><xMun>SAO PAULO</xMun><UF>SP</UF><CEP>01000000</CEP>'
+        f'<cPais>1058</cPais><xPais>BRASIL</xPais></enderEmit><IE>123456789</IE><CRT>1</CRT></emit>'
+        f'{"".join(dets)}<total><ICMSTot><vBC>0.00</vBC><vICMS>0.00</vICMS><vICMSDeson>0.00</vICMSDeson>'
+        f'<vFCP>0.00</vFCP><vBCST>0.00</vBCST><vST>0.00</vST><vFCPST>0.00</vFCPST><vFCPSTRet>0.00</vFCPSTRet>'
+        f'<vProd>{total:.2f}</vProd><vFrete>0.00</vFrete><vSeg>0.00</vSeg><vDesc>0.00</vDesc><vII>0.00</vII>'
+        f'<vIPI>0.00</vIPI><vIPIDevol>0.00</vIPIDevol><vPIS>0.00</vPIS><vCOFINS>0.00</vCOFINS>'
+        f'<vOutro>0.00</vOutro><vNF>{total:.2f}</vNF><vTotTrib>{total * 0.1:.2f}</vTotTrib></ICMSTot></total>'
+        f'<transp><modFrete>9</modFrete></transp><pag><detPag><tPag>{tpag}</tPag><vPag>{total:.2f}</vPag>'
+        f'</detPag></pag></infNFe></NFe><protNFe versao="4.00"><infProt><tpAmb>1</tpAmb>'
+        f'<chNFe>{chave}</chNFe><nProt>135{numero:012d}</nProt><cStat>100</cStat></infProt></protNFe></nfeProc>'
+    )
+
+def sortear_itens(rng, itens_min, itens_max, distribuicao='uniforme'):
+    """Quantidade de itens da nota; 'log' concentra em cupons pequenos, com alguns bem grandes."""
+    if distribuicao == 'log':
+        return min(itens_max, int(math.exp(rng.uniform(math.log(itens_min), math.log(itens_max + 1)))))
+    return rng.randint(itens_min, itens_max)
+
+def gerar_lote(tamanho, itens_min=1, itens_max=10, seed=42, distribuicao='uniforme', primeira=1):
+    rng = random.Random(seed)
+    inicio = datetime(2024, 10, 23, 18, 0, 0)
+    return [
+        gerar_nfce_xml(n, sortear_itens(rng, itens_min, itens_max, distribuicao), inicio + timedelta(seconds=n), rng)
+        for n in range(primeira, primeira + tamanho)
+    ]
+
+def _medir(funcao, xmls):
+    inicio = time.perf_counter()
+    for xml in xmls:
+        funcao(xml)
+    return time.perf_counter() - inicio
+
+def bench_parse(args):
+    for tamanho in args.lote:
+        xmls = gerar_lote(tamanho, args.itens_min, args.itens_max)
+        print(f"Lote de {tamanho} notas ({args.itens_min}-{args.itens_max} itens):")
+        for nome, funcao in (
+            ('parse_nfe_record', integracao.parse_nfe_record),
+            ('convert_xml_to_omie_json', integracao.convert_xml_to_omie_json),
+        ):
+            duracao = _medir(funcao, xmls)
+            print(f"  {nome:<28} {duracao * 1e6 / tamanho:8.1f} us/nota  {tamanho / duracao:10.0f} notas/s")
+
+class ServidorFalso:
+    """Substituto local da ZIG e do Omie para medir a integração sem tocar nas APIs reais.
+
+    GET devolve as páginas de notas da ZIG, geradas sob demanda (a massa de
+    teste não pesa na memória medida). POST responde ao IncluirNfce com a
+    latência, a taxa de faults e o limite de requisições por segundo
+    configurados; acima do limite o Omie falso responde como o real, com
+    "Consumo indevido" e o tempo de espera. O ListarProdutos devolve um
+    produto para cada cProd das notas geradas.
+    """
+
+    def __init__(self, notas, por_pagina=100, itens_min=1, itens_max=10, distribuicao='uniforme', seed=42,
+                 zig_latencia=0.0, omie_latencia=0.0, taxa_fault=0.0, omie_limite=0.0):
+        self.notas = notas
+        self.por_pagina = por_pagina
+        self.itens = (itens_min, itens_max, distribuicao)
+        self.seed = seed
+        self.zig_latencia = zig_latencia
+        self.omie_latencia = omie_latencia
+        self.taxa_fault = taxa_fault
+        self.omie_limite = omie_limite
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.janela = []  # instantes das últimas chamadas aceitas, para o limite por segundo
+        self.chamadas = self.recebidas = self.faults = self.bloqueios = 0
+        servidor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # sem isso cada resposta pode esperar ~40 ms pelo ACK atrasado
+
+            def log_message(self, format, *args):
+                pass
+
+            def responder(self, status, corpo):
+                dados = json.dumps(corpo).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(dados)))
+                self.end_headers()
+                self.wfile.write(dados)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/_estatisticas':
+                    self.responder(200, servidor.estatisticas())
+                    return
+                pagina = int(parse_qs(url.query).get('page', ['1'])[0])
+                self.responder(200, servidor.pagina(pagina))
+
+            def do_POST(self):
+                corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if corpo.get('call') == 'ListarProdutos':
+                    self.responder(*servidor.produtos(corpo['param'][0]))
+                    return
+                self.responder(*servidor.incluir(corpo.get('param', [])))
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def _latencia(self, media):
+        if media > 0:
+            time.sleep(media * self.rng.uniform(0.5, 1.5))
+
+    def pagina(self, pagina):
+        self._latencia(self.zig_latencia)
+        primeira = (pagina - 1) * self.por_pagina + 1
+        tamanho = max(0, min(self.por_pagina, self.notas - primeira + 1))
+        itens_min, itens_max, distribuicao = self.itens
+        xmls = gerar_lote(tamanho, itens_min, itens_max, self.seed * 1000003 + pagina, distribuicao, primeira)
+        return [{"xml": xml} for xml in xmls]
+
+    def incluir(self, param):
+        self._latencia(self.omie_latencia)
+        with self.lock:
+            self.chamadas += 1
+            agora = time.monotonic()
+            if self.omie_limite > 0:
+                self.janela = [t for t in self.janela if agora - t < 1]
+                if len(self.janela) >= self.omie_limite:
+                    self.bloqueios += 1
+                    return 500, {"faultcode": "SOAP-ENV:Client-6",
+                                 "faultstring": "ERROR: Consumo indevido da API. Aguarde 1 segundos."}
+                self.janela.append(agora)
+            self.recebidas += len(param)
+            resultados = []
+            for nota in param:
+                if self.rng.random() < self.taxa_fault:
+                    self.faults += 1
+                    resultados.append({"faultcode": "SOAP-ENV:Client-102", "faultstring": "ERROR: falha simulada"})
+                else:
+                    resultados.append({"nIdCupom": self.recebidas, "cStatus": "0",
+                                       "cMensagem": f"Cupom {nota['NFe']['nNF']} incluído"})
+        if len(resultados) > 1:
+            return 200, resultados
+        return (500 if "faultcode" in resultados[0] else 200), resultados[0]
+
+    def produtos(self, param):
+        codigos = [str(1000 + n) for n in range(1, self.itens[1] + 1)]
+        if param.get('produtosPorCodigo'):
+            pedidos = {p['codigo'] for p in param['produtosPorCodigo']}
+            codigos = [codigo for codigo in codigos if codigo in pedidos]
+        elif param.get('filtrar_apenas_alteracao') == 'S':
+            codigos = []
+        por_pagina = param['registros_por_pagina']
+        pagina = codigos[(param['pagina'] - 1) * por_pagina:param['pagina'] * por_pagina]
+        if not pagina:
+            return 500, {"faultcode": "SOAP-ENV:Client-5113",
+                         "faultstring": f"ERROR: Não existem registros para a página [{param['pagina']}]!"}
+        return 200, {"pagina": param['pagina'], "total_de_paginas": math.ceil(len(codigos) / por_pagina),
+                     "produto_servico_cadastro": [{"codigo_produto": 5000000 + int(codigo), "codigo": codigo,
+                                                   "codigo_produto_integracao": "", "ean": "", "inativo": "N"}
+                                                  for codigo in pagina]}
+
+    def estatisticas(self):
+        with self.lock:
+            return {'chamadas': self.chamadas, 'notas': self.recebidas, 'faults': self.faults, 'bloqueios': self.bloqueios}
+
+def _servir(opcoes, endereco):
+    servidor = ServidorFalso(**opcoes)
+    endereco.put(servidor.url)
+    servidor.httpd.serve_forever()
+
+@contextlib.contextmanager
+def servidor_falso(**opcoes):
+    """Sobe o ServidorFalso em outro processo, para não disputar o GIL com a integração medida."""
+    contexto = multiprocessing.get_context('spawn')
+    endereco = contexto.Queue()
+    processo = contexto.Process(target=_servir, args=(opcoes, endereco), name="servidor-falso", daemon=True)
+    processo.start()
+    try:
+        yield endereco.get(timeout=30)
+    finally:
+        processo.terminate()
+        processo.join()
+
+def _percentil(amostras, p):
+    amostras = sorted(amostras)
+    return amostras[min(int(len(amostras) * p), len(amostras) - 1)] if amostras else 0.0
+
+def bench_e2e(args):
+    integracao.CONVERSAO_PROCESSOS = args.processos
+    integracao.CONVERSAO_JANELA = max(args.processos, 1) * 4
+    integracao.LOJA_MAX_ENVIOS = args.envios
+    integracao.OMIE_LOTE_TAMANHO = args.lote_omie
+    loja = integracao.StoreConfig('bench', 'token', 'rede', 'app-key-bench', 'secret', 'cc')
+    integracao.config.stores = {'bench': loja}
+    integracao._rate_limiters[loja.omie_app_key] = integracao.OmieRateLimiter(loja.omie_app_key, args.taxa, args.rajada)
+
+    opcoes = dict(notas=args.notas, por_pagina=args.por_pagina, itens_min=args.itens_min, itens_max=args.itens_max,
+                  distribuicao=args.distribuicao, zig_latencia=args.zig_latencia, omie_latencia=args.omie_latencia,
+                  taxa_fault=args.taxa_fault, omie_limite=args.omie_limite)
+    # Cursor, limites salvos e banco ficam num diretório temporário, apagado no fim
+    cwd, banco = os.getcwd(), integracao.INTEGRACAO_DB
+    with tempfile.TemporaryDirectory(prefix='bench-integracao-') as diretorio:
+        os.chdir(diretorio)
+        integracao.INTEGRACAO_DB = os.path.join(diretorio, 'integracao.db')
+        try:
+            with servidor_falso(**opcoes) as url:
+                integracao.ZIG_API_URL = url + '/integration/erp/invoice'
+                integracao.OMIE_API_URL = url + '/api/v1/produtos/cupomfiscalincluir/'
+                integracao.OMIE_PRODUTOS_URL = url + '/api/v1/geral/produtos/'
+                if args.tracemalloc:
+                    tracemalloc.start()
+                inicio = time.perf_counter()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    integracao.get_dedup_store().load()
+                    integracao.refresh_catalogs(['bench'])
+                    if args.modo == 'async':
+                        integracao.run_all_stores_async(['bench'], datetime(2024, 10, 23), datetime(2024, 10, 24))
+                    else:
+                        integracao.execute_store_integration('bench', datetime(2024, 10, 23), datetime(2024, 10, 24))
+                    integracao.get_sequence_allocator().release()
+                duracao = time.perf_counter() - inicio
+                pico = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+                tracemalloc.stop()
+                servidor = requests.get(url + '/_estatisticas', timeout=10).json()
+        finally:
+            os.chdir(cwd)
+            integracao.INTEGRACAO_DB = banco
+
+    status = {dict(rotulos)['status']: int(valor)
+              for (nome, rotulos), valor in integracao.metrics.counters.items() if nome == 'integracao_notas_total'}
+    resultado = {
+        'notas': args.notas,
+        'duracao': round(duracao, 3),
+        'notas_por_segundo': round(status.get('enviada', 0) / duracao, 2),
+        'status': status,
+        'servidor': servidor,
+        'etapas': {},
+        'rss_max_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'pico_tracemalloc_mb': round(pico / 1024 / 1024, 1) if pico is not None else None,
+    }
+    for (nome, rotulos), histograma in integracao.metrics.histograms.items():
+        if nome == 'integracao_etapa_segundos':
+            resultado['etapas'][dict(rotulos)['etapa']] = {
+                'p50': _percentil(histograma.samples, 0.50), 'p99': _percentil(histograma.samples, 0.99)}
+
+    print(f"{args.notas} notas ({args.itens_min}-{args.itens_max} itens, {args.distribuicao}) em {duracao:.2f}s: "
+          f"{resultado['notas_por_segundo']:.1f} notas/s")
+    print(f"  status: {status}")
+    print(f"  servidor: {resultado['servidor']}")
+    for etapa, r in sorted(resultado['etapas'].items()):
+        print(f"  {etapa:<12} p50 {r['p50'] * 1000:8.2f} ms  p99 {r['p99'] * 1000:8.2f} ms")
+    memoria = f"  memória: RSS máx {resultado['rss_max_mb']} MB"
+    if pico is not None:
+        memoria += f", pico tracemalloc {resultado['pico_tracemalloc_mb']} MB"
+    print(memoria)
+
+    if args.saida:
+        with open(args.saida, 'w') as f:
+            json.dump(resultado, f, indent=2)
+    if args.referencia:
+        with open(args.referencia) as f:
+            referencia = json.load(f)
+        variacao = resultado['notas_por_segundo'] / referencia['notas_por_segundo'] - 1
+        print(f"  referência: {referencia['notas_por_segundo']:.1f} notas/s ({variacao:+.1%})")
+        if variacao < -args.tolerancia:
+            print(f"Regressão de vazão acima da tolerância de {args.tolerancia:.0%}.")
+            sys.exit(1)
+
+def bench_memoria(args):
+    """Roda o e2e em um processo novo para cada tamanho de página e compara o pico de memória.
+
+    Com a leitura incremental da ZIG o pico não deve crescer com a página:
+    sai com erro se o maior pico passar do menor pela tolerância.
+    O cache de conversão fica desligado para não somar os payloads guardados.
+    """
+    ambiente = dict(os.environ, CACHE_CONVERSAO_MB='0')
+    resultados = {}
+    for por_pagina in args.por_pagina:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            saida = f.name
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'e2e', '--notas', str(args.notas),
+                            '--por-pagina', str(por_pagina), '--itens-min', str(args.itens_min),
+                            '--itens-max', str(args.itens_max), '--distribuicao', args.distribuicao,
+                            '--zig-latencia', '0', '--omie-latencia', '0', '--modo', args.modo,
+                            '--tracemalloc', '--saida', saida],
+                           check=True, env=ambiente, stdout=subprocess.DEVNULL)
+            with open(saida) as f:
+                resultados[por_pagina] = json.load(f)
+        finally:
+            os.unlink(saida)
+        r = resultados[por_pagina]
+        print(f"{por_pagina:>6} notas/página: pico tracemalloc {r['pico_tracemalloc_mb']:7.1f} MB, "
+              f"RSS máx {r['rss_max_mb']:7.1f} MB, {r['notas_por_segundo']:.1f} notas/s")
+
+    picos = [r['pico_tracemalloc_mb'] for r in resultados.values()]
+    variacao = max(picos) / max(min(picos), 0.1) - 1
+    print(f"variação do pico entre páginas: {variacao:+.0%}")
+    if variacao > args.tolerancia:
+        print(f"Pico de memória cresce com a página além da tolerância de {args.tolerancia:.0%}.")
+        sys.exit(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks da integração ZIG-Omie")
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    parse = sub.add_parser('parse', help="custo por nota da leitura do XML")
+    parse.add_argument('--lote', type=int, nargs='+', default=[10000, 20000])
+    parse.add_argument('--itens-min', type=int, default=1)
+    parse.add_argument('--itens-max', type=int, default=10)
+    parse.set_defaults(func=bench_parse)
+
+    e2e = sub.add_parser('e2e', help="execute_store_integration contra um servidor ZIG/Omie local")
+    e2e.add_argument('--notas', type=int, default=2000)
+    e2e.add_argument('--por-pagina', type=int, default=100)
+    e2e.add_argument('--itens-min', type=int, default=1)
+    e2e.add_argument('--itens-max', type=int, default=200)
+    e2e.add_argument('--distribuicao', choices=['uniforme', 'log'], default='log')
+    e2e.add_argument('--zig-latencia', type=float, default=0.05, help="segundos por página")
+    e2e.add_argument('--omie-latencia', type=float, default=0.02, help="segundos por chamada")
+    e2e.add_argument('--taxa-fault', type=float, default=0.0, help="fração de notas recusadas")
+    e2e.add_argument('--omie-limite', type=float, default=0, help="requisições/s aceitas pelo Omie falso (0 = sem limite)")
+    e2e.add_argument('--taxa', type=float, default=1000, help="taxa máxima do limitador da integração (req/s)")
+    e2e.add_argument('--rajada', type=float, default=10)
+    e2e.add_argument('--envios', type=int, default=integracao.LOJA_MAX_ENVIOS, help="threads de envio da loja")
+    e2e.add_argument('--processos', type=int, default=0, help="processos de conversão")
+    e2e.add_argument('--lote-omie', type=int, default=1, help="notas por IncluirNfce")
+    e2e.add_argument('--modo', choices=['threads', 'async'], default='threads', help="motor de busca e envio")
+    e2e.add_argument('--tracemalloc', action='store_true', help="mede o pico de memória alocada (mais lento)")
+    e2e.add_argument('--saida', help="salva o resultado em JSON")
+    e2e.add_argument('--referencia', help="resultado JSON anterior para comparar a vazão")
+    e2e.add_argument('--tolerancia', type=float, default=0.1, help="queda de vazão aceita frente à referência")
+    e2e.set_defaults(func=bench_e2e)
+
+    memoria = sub.add_parser('memoria', help="pico de memória do e2e para páginas da ZIG de tamanhos diferentes")
+    memoria.add_argument('--notas', type=int, default=2000)
+    memoria.add_argument('--por-pagina', type=int, nargs='+', default=[100, 500, 2000])
+    memoria.add_argument('--itens-min', type=int, default=1)
+    memoria.add_argument('--itens-max', type=int, default=200)
+    memoria.add_argument('--distribuicao', choices=['uniforme', 'log'], default='log')
+    memoria.add_argument('--modo', choices=['threads', 'async'], default='threads')
+    memoria.add_argument('--tolerancia', type=float, default=0.5, help="crescimento do pico aceito entre páginas")
+    memoria.set_defaults(func=bench_memoria)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
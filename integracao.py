@@ -4,38 +4,203 @@ import xml.etree.ElementTree as ET
 import requests
 import logging
 import hashlib
+import hmac
+import cProfile
+import pstats
+import tracemalloc
 import html
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.jobstores.base import JobLookupError
 from contextlib import contextmanager
 import threading
 import openpyxl
 import time
+import re
+import queue
+import sqlite3
+import argparse
+import asyncio
+import codecs
+import gzip
+import zlib
+import tempfile
+import math
+import random
+import signal
+import socket
+import sys
+from urllib.parse import urlsplit, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+import multiprocessing
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from openpyxl.styles import Font, Alignment
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+try:
+    import aiohttp
+except ImportError:  # só o modo async (INTEGRACAO_MODO=async) precisa do aiohttp
+    aiohttp = None
+try:
+    import numpy as np
+except ImportError:  # a conciliação usa numpy, se instalado, para as somas agrupadas
+    np = None
 from datetime import datetime
 
 # Carrega variáveis de ambiente do .env
 load_dotenv()
 
 class StoreConfig:
-    def __init__(self, name, zig_token, zig_rede, omie_app_key, omie_app_secret,cc):
+    def __init__(self, name, zig_token, zig_rede, omie_app_key, omie_app_secret,cc,
+                 id_cliente=None, id_conta=None, emi_id=None, intervalo=None, max_envios=None,
+                 id_local_estoque=None, horario=None):
         self.name = name
         self.zig_token = zig_token
         self.zig_rede = zig_rede
         self.omie_app_key = omie_app_key
         self.omie_app_secret = omie_app_secret
         self.cc= cc
+        self.id_cliente = id_cliente
+        self.id_conta = id_conta
+        self.emi_id = emi_id if emi_id is not None else OMIE_EMI_ID_PADRAO
+        self.intervalo = intervalo or INTEGRACAO_INTERVALO  # segundos entre execuções da loja
+        self.max_envios = max_envios or LOJA_MAX_ENVIOS
+        self.id_local_estoque = id_local_estoque
+        self.horario = horario  # horário de funcionamento do agendamento adaptativo (AGENDA_HORARIO se vazio)
+
+    def __eq__(self, other):
+        return isinstance(other, StoreConfig) and vars(self) == vars(other)
+
+# Cadastro das lojas: um arquivo JSON ({"loja": {...}}) ou um diretório com um JSON por loja
+LOJAS_CONFIG = os.getenv('LOJAS_CONFIG', 'lojas.json')
+LOJAS_CAMPOS_OBRIGATORIOS = ('zig_token', 'zig_rede', 'omie_app_key', 'omie_app_secret')
+INTEGRACAO_INTERVALO = int(os.getenv('INTEGRACAO_INTERVALO', '21600'))  # segundos
+OMIE_EMI_ID_PADRAO = int(os.getenv('OMIE_EMI_ID_PADRAO', '6029653'))
+LOJA_MAX_ENVIOS = int(os.getenv('LOJA_MAX_ENVIOS', '2'))  # threads de envio por loja
+
+def _resolve_env(value):
+    # "env:NOME" lê o valor da variável de ambiente, para não gravar segredos no cadastro
+    if isinstance(value, str) and value.startswith('env:'):
+        return os.getenv(value[4:])
+    return value
+
+def parse_trading_hours(text):
+    """Faixas "HH:MM-HH:MM" separadas por vírgula, em minutos do dia; uma faixa pode passar da meia-noite."""
+    faixas = []
+    for faixa in filter(None, (parte.strip() for parte in (text or '').split(','))):
+        try:
+            inicio, fim = (datetime.strptime(hora.strip(), '%H:%M') for hora in faixa.split('-'))
+        except ValueError:
+            raise ValueError(f"horário inválido: {faixa!r} (use HH:MM-HH:MM)")
+        faixas.append((inicio.hour * 60 + inicio.minute, fim.hour * 60 + fim.minute))
+    return faixas
+
+def store_from_dict(name, data):
+    if not isinstance(data, dict):
+        raise ValueError(f"o cadastro deve ser um objeto JSON, não {type(data).__name__}")
+    faltando = [campo for campo in LOJAS_CAMPOS_OBRIGATORIOS if not _resolve_env(data.get(campo))]
+    if faltando:
+        raise ValueError(f"campos obrigatórios ausentes: {', '.join(faltando)}")
+    for campo in ('intervalo', 'max_envios'):
+        valor = data.get(campo)
+        if valor is not None and (isinstance(valor, bool) or not isinstance(valor, int) or valor <= 0):
+            raise ValueError(f"'{campo}' deve ser um inteiro positivo, não {valor!r}")
+    parse_trading_hours(data.get('horario'))
+    return StoreConfig(
+        name,
+        _resolve_env(data['zig_token']),
+        _resolve_env(data['zig_rede']),
+        _resolve_env(data['omie_app_key']),
+        _resolve_env(data['omie_app_secret']),
+        _resolve_env(data.get('cc')),
+        id_cliente=_resolve_env(data.get('id_cliente')),
+        id_conta=_resolve_env(data.get('id_conta')),
+        emi_id=_resolve_env(data.get('emi_id')),
+        intervalo=data.get('intervalo'),
+        max_envios=data.get('max_envios'),
+        id_local_estoque=_resolve_env(data.get('id_local_estoque')),
+        horario=data.get('horario'),
+    )
+
 class Config:
-    def __init__(self):
-        self.stores = {
+    """Lojas integradas, lidas de LOJAS_CONFIG.
+
+    Sem o arquivo/diretório de cadastro valem as lojas 'otro' e 'tratto' das
+    variáveis de ambiente. reload() relê o cadastro quando algum arquivo muda;
+    `stores` é sempre trocado por um dicionário novo, então quem já tem uma
+    referência continua vendo um cadastro consistente.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or LOJAS_CONFIG
+        self.signature = None
+        self.lock = threading.Lock()
+        self.stores = self._load()
+
+    def _files(self):
+        if os.path.isdir(self.path):
+            return sorted(os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith('.json'))
+        return [self.path] if os.path.isfile(self.path) else []
+
+    def _signature(self):
+        """(arquivo, mtime, tamanho) de cada arquivo do cadastro; None se algum sumiu no meio da leitura."""
+        signature = []
+        try:
+            for filename in self._files():
+                st = os.stat(filename)
+                signature.append((filename, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            return None
+        return tuple(signature)
+
+    def _load(self, strict=False):
+        """Lê o cadastro. Loja inválida é ignorada com erro no log, ou, com `strict`
+        (releitura), recusa o cadastro inteiro com ValueError."""
+        self.signature = self._signature()
+        if self.signature is None:
+            raise FileNotFoundError(f"{self.path} mudou durante a leitura")
+        if not self.signature:
+            return self._from_env()
+        entries = {}
+        for filename in self._files():
+            with open(filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if os.path.isdir(self.path):
+                nome = data.get('nome') if isinstance(data, dict) else None
+                data = {nome or os.path.splitext(os.path.basename(filename))[0]: data}
+            elif not isinstance(data, dict):
+                raise ValueError(f"{filename} deve conter um objeto JSON com as lojas por nome")
+            entries.update(data)
+        stores = {}
+        erros = []
+        for name, data in entries.items():
+            if isinstance(data, dict) and data.get('ativa', True) is False:
+                continue
+            try:
+                stores[name] = store_from_dict(name, data)
+            except ValueError as e:
+                erros.append(f"[{name}] {e}")
+                if not strict:
+                    logging.error(f"[{name}] Cadastro da loja ignorado: {e}")
+        if erros and strict:
+            raise ValueError(f"cadastro com lojas inválidas: {'; '.join(erros)}")
+        return stores
+
+    def _from_env(self):
+        return {
             'otro': StoreConfig(
                 'otro',
                 os.getenv('ZIG_TOKEN-OTRO'),
                 os.getenv('ZIG_REDE-OTRO'),
                 os.getenv('OMIE_APP_KEY-OTRO'),
                 os.getenv('OMIE_APP_SECRET-OTRO'),
-                os.getenv('CC-OTRO')
+                os.getenv('CC-OTRO'),
+                id_cliente='675944858',
+                id_conta=3569457062,
             ) ,
             'tratto': StoreConfig(
                 'tratto',
@@ -43,27 +208,1398 @@ class Config:
                 os.getenv('ZIG_REDE-TRATTO'),
                 os.getenv('OMIE_APP_KEY-TRATTO'),
                 os.getenv('OMIE_APP_SECRET-TRATTO'),
-                os.getenv('CC-TRATTO')
+                os.getenv('CC-TRATTO'),
+                id_cliente='675944859',  # Ajuste este valor conforme necessário
+                id_conta=7502625278,
             )
         }
 
+    def reload(self):
+        """Relê o cadastro se algum arquivo mudou; retorna (incluídas, removidas, alteradas)."""
+        with self.lock:
+            signature = self._signature()
+            # Arquivo trocado no meio da verificação: fica para a próxima releitura
+            if signature is None or signature == self.signature:
+                return set(), set(), set()
+            if not signature and self.signature:
+                logging.warning(f"Cadastro {self.path} não encontrado. Mantendo o cadastro atual.")
+                self.signature = signature
+                return set(), set(), set()
+            old = self.stores
+            try:
+                new = self._load(strict=True)
+            except (OSError, ValueError) as e:
+                # Cadastro com erro de sintaxe ou loja inválida: mantém as lojas atuais até a próxima correção
+                logging.error(f"Erro ao recarregar {self.path}: {e}. Mantendo o cadastro atual.")
+                return set(), set(), set()
+            self.stores = new
+        added = set(new) - set(old)
+        removed = set(old) - set(new)
+        changed = {name for name in set(new) & set(old) if new[name] != old[name]}
+        if added or removed or changed:
+            logging.info(f"Cadastro de lojas recarregado: {len(added)} incluídas, {len(removed)} removidas, "
+                         f"{len(changed)} alteradas ({len(new)} ativas).")
+        return added, removed, changed
+
 config = Config()
 scheduler = BlockingScheduler()
 
-# Timeout usando threading.Timer
+# Limite de requisições à API do Omie (por app_key)
+OMIE_TAXA_MAXIMA = float(os.getenv('OMIE_TAXA_MAXIMA', '3'))  # requisições por segundo
+OMIE_TAXA_MINIMA = float(os.getenv('OMIE_TAXA_MINIMA', '0.1'))
+OMIE_RAJADA = float(os.getenv('OMIE_RAJADA', '4'))
+OMIE_BACKOFF_PADRAO = float(os.getenv('OMIE_BACKOFF_PADRAO', '60'))  # segundos
+OMIE_MAX_TENTATIVAS = int(os.getenv('OMIE_MAX_TENTATIVAS', '5'))
+
+# Trechos de faultstring/corpo que indicam bloqueio por consumo excessivo
+OMIE_THROTTLE_MARCADORES = (
+    'consumo redundante',
+    'consumo indevido',
+    'misuse_api',
+    'too many requests',
+    'bloqueada',
+)
+
+class OmieRateLimiter:
+    """Token bucket adaptativo para as chamadas de um app_key do Omie.
+
+    A taxa sobe aos poucos a cada envio bem-sucedido (até OMIE_TAXA_MAXIMA)
+    e cai pela metade quando o Omie sinaliza consumo excessivo. O estado usa
+    o relógio de parede para poder ser salvo e retomado entre execuções.
+    """
+
+    def __init__(self, app_key, taxa_maxima=OMIE_TAXA_MAXIMA, rajada=OMIE_RAJADA, state=None):
+        state = state or {}
+        now = time.time()
+        self.app_key = app_key
+        self.max_rate = taxa_maxima
+        self.capacity = rajada
+        self.rate = min(float(state.get('rate', taxa_maxima)), taxa_maxima)
+        self.tokens = min(float(state.get('tokens', rajada)), rajada)
+        self.updated = min(float(state.get('updated', now)), now)
+        self.blocked_until = float(state.get('blocked_until', 0))
+        self.sent = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Consome um token se houver; senão retorna quantos segundos esperar."""
+        with self.lock:
+            now = time.time()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, deadline=None):
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            if deadline is not None:
+                deadline.sleep(wait)
+                deadline.check()
+            else:
+                time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.sent += 1
+            # Aumento aditivo até a taxa máxima
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+    def on_throttle(self, wait=None):
+        with self.lock:
+            now = time.time()
+            self.throttled += 1
+            # Redução multiplicativa e pausa até o Omie liberar novamente
+            self.rate = max(OMIE_TAXA_MINIMA, self.rate / 2)
+            self.tokens = 0
+            self.updated = now
+            self.blocked_until = max(self.blocked_until, now + (wait or OMIE_BACKOFF_PADRAO))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'tokens': self.tokens,
+                'updated': self.updated,
+                'blocked_until': self.blocked_until,
+            }
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(app_key):
+    with _rate_limiters_lock:
+        if app_key not in _rate_limiters:
+            _rate_limiters[app_key] = OmieRateLimiter(app_key, state=get_rate_limiter_store().load(app_key))
+        return _rate_limiters[app_key]
+
+def save_rate_limiters():
+    # Mantém o orçamento de cada app_key para a próxima execução do agendador
+    with _rate_limiters_lock:
+        states = {app_key: limiter.snapshot() for app_key, limiter in _rate_limiters.items()}
+    if states:
+        get_rate_limiter_store().save(states)
+
+def write_json_atomic(filename, data):
+    # Grava em arquivo temporário e renomeia, para não deixar JSON pela metade; o
+    # temporário tem nome único para duas gravações do mesmo arquivo não se atrapalharem
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename) or '.', prefix=os.path.basename(filename) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        tmp_name = f.name
+        try:
+            json.dump(data, f)
+        except BaseException:
+            f.close()
+            os.unlink(tmp_name)
+            raise
+    os.replace(tmp_name, filename)
+
+# Banco local com o estado persistente da integração
+INTEGRACAO_DB = os.getenv('INTEGRACAO_DB', 'integracao.db')
+DEDUP_RETENCAO_DIAS = int(os.getenv('DEDUP_RETENCAO_DIAS', '180'))
+LEGACY_MD5_FILE = 'processed_nfce_md5.txt'
+
+def connect_db(path=None, synchronous='NORMAL'):
+    conn = sqlite3.connect(path or INTEGRACAO_DB, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={synchronous}')
+    return conn
+
+class DedupStore:
+    """Índice das NFC-e já tratadas, por MD5 e por chave da NF-e.
+
+    Os status finais ('enviada', 'duplicada') são carregados em memória uma vez
+    por execução com load(); as consultas seguintes não tocam o disco.
+    """
+
+    STATUS_FINAIS = ('enviada', 'duplicada')
+
+    def __init__(self, path=None):
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.md5s = {}
+        self.chaves = {}
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS notas_processadas (
+                md5 TEXT PRIMARY KEY,
+                chave TEXT,
+                loja TEXT,
+                status TEXT NOT NULL,
+                atualizado REAL NOT NULL
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_chave ON notas_processadas (chave)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_atualizado ON notas_processadas (atualizado)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT)')
+        self._import_legacy_file()
+
+    def _import_legacy_file(self):
+        # Importa uma única vez o antigo processed_nfce_md5.txt
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE chave = 'legado_md5_importado'").fetchone():
+                return
+            try:
+                with open(LEGACY_MD5_FILE, 'r') as f:
+                    md5s = [line.strip() for line in f if line.strip()]
+            except FileNotFoundError:
+                md5s = []
+            now = time.time()
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO notas_processadas (md5, status, atualizado) VALUES (?, 'enviada', ?)",
+                [(md5, now) for md5 in md5s])
+            self.conn.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('legado_md5_importado', ?)", (str(len(md5s)),))
+            self.conn.execute('COMMIT')
+            if md5s:
+                logging.info(f"{len(md5s)} MD5 importados de {LEGACY_MD5_FILE}.")
+
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT md5, chave, status FROM notas_processadas WHERE status IN (?, ?)', self.STATUS_FINAIS
+            ).fetchall()
+            self.md5s = {md5: status for md5, _, status in rows}
+            self.chaves = {chave: status for _, chave, status in rows if chave}
+
+    def seen(self, md5=None, chave=None):
+        """Retorna o status final da nota, ou None se ainda precisa ser enviada."""
+        with self.lock:
+            return self.md5s.get(md5) or (self.chaves.get(chave) if chave else None)
+
+    def mark(self, md5, status, chave=None, loja=None):
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO notas_processadas (md5, chave, loja, status, atualizado) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(md5) DO UPDATE SET chave = COALESCE(excluded.chave, chave),
+                       loja = COALESCE(excluded.loja, loja), status = excluded.status, atualizado = excluded.atualizado""",
+                (md5, chave or None, loja, status, time.time()))
+            if status in self.STATUS_FINAIS:
+                self.md5s[md5] = status
+                if chave:
+                    self.chaves[chave] = status
+
+    def statuses(self, store_name):
+        """Status registrado de cada nota da loja (e das importadas sem loja): (por MD5, por chave)."""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT md5, chave, status FROM notas_processadas WHERE loja = ? OR loja IS NULL', (store_name,)
+            ).fetchall()
+        return {md5: status for md5, _, status in rows}, {chave: status for _, chave, status in rows if chave}
+
+    def compact(self, retention_days=DEDUP_RETENCAO_DIAS):
+        """Remove registros sem atualização há mais de `retention_days` dias."""
+        cutoff = time.time() - retention_days * 86400
+        with self.lock:
+            removed = self.conn.execute('DELETE FROM notas_processadas WHERE atualizado < ?', (cutoff,)).rowcount
+        if removed:
+            logging.info(f"Compactação do índice de notas: {removed} registros removidos.")
+        return removed
+
+_dedup_store = None
+_dedup_store_lock = threading.Lock()
+
+def get_dedup_store():
+    global _dedup_store
+    with _dedup_store_lock:
+        if _dedup_store is None:
+            _dedup_store = DedupStore()
+        return _dedup_store
+
+def nfce_md5(xml_data):
+    return hashlib.md5(html.unescape(xml_data).encode()).hexdigest()
+
+_CHAVE_RE = re.compile(r'Id="NFe(\d{44})"')
+
+def nfce_chave(xml_data):
+    # Extrai a chave sem montar a árvore XML
+    match = _CHAVE_RE.search(xml_data)
+    return match.group(1) if match else None
+
+_DHEMI_RE = re.compile(r'<dhEmi>([^<]+)</dhEmi>')
+
+def nfce_dh_emi(xml_data):
+    match = _DHEMI_RE.search(xml_data)
+    if not match:
+        return None
+    try:
+        return datetime.fromisoformat(match.group(1).strip())
+    except ValueError:
+        return None
+
+# Sincronização incremental por loja
+ZIG_SOBREPOSICAO_HORAS = float(os.getenv('ZIG_SOBREPOSICAO_HORAS', '2'))
+ZIG_LOOKBACK_DIAS = float(os.getenv('ZIG_LOOKBACK_DIAS', '1'))  # sem marca d'água salva
+
+class WatermarkStore:
+    """Marca d'água por loja: o dhEmi mais recente já tratado sem falhas antes dele."""
+
+    def __init__(self, path=None):
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS marcas_dagua (
+                loja TEXT PRIMARY KEY,
+                dh_emi TEXT NOT NULL,
+                atualizado REAL NOT NULL
+            )""")
+
+    def load(self, store_name):
+        with self.lock:
+            row = self.conn.execute('SELECT dh_emi FROM marcas_dagua WHERE loja = ?', (store_name,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def advance(self, store_name, dh_emi):
+        """Avança a marca da loja; nunca a faz voltar."""
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO marcas_dagua (loja, dh_emi, atualizado) VALUES (?, ?, ?)
+                   ON CONFLICT(loja) DO UPDATE SET dh_emi = excluded.dh_emi, atualizado = excluded.atualizado
+                   WHERE excluded.dh_emi > marcas_dagua.dh_emi""",
+                (store_name, dh_emi.isoformat(), time.time()))
+
+_watermark_store = None
+_watermark_store_lock = threading.Lock()
+
+def get_watermark_store():
+    global _watermark_store
+    with _watermark_store_lock:
+        if _watermark_store is None:
+            _watermark_store = WatermarkStore()
+        return _watermark_store
+
+class WatermarkTracker:
+    """Acompanha os dhEmi tratados numa execução para calcular a nova marca d'água.
+
+    A marca avança até o maior dhEmi tratado, mas fica antes da nota mais antiga
+    que falhou, para que ela volte a ser buscada na próxima execução. Uma falha
+    sem dhEmi conhecido segura a marca onde está.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_ok = None
+        self.min_falha = None
+        self.falha_sem_data = False
+
+    def observe(self, dh_emi, ok):
+        if dh_emi is None:
+            if not ok:
+                with self.lock:
+                    self.falha_sem_data = True
+            return
+        with self.lock:
+            if ok:
+                if self.max_ok is None or dh_emi > self.max_ok:
+                    self.max_ok = dh_emi
+            elif self.min_falha is None or dh_emi < self.min_falha:
+                self.min_falha = dh_emi
+
+    def value(self):
+        with self.lock:
+            if self.falha_sem_data:
+                return None
+            if self.min_falha is not None and (self.max_ok is None or self.max_ok >= self.min_falha):
+                return self.min_falha - timedelta(seconds=1) if self.max_ok is not None else None
+            return self.max_ok
+
+class RateLimiterStore:
+    """Estado salvo dos limitadores do Omie, uma linha por app_key no banco compartilhado.
+
+    Réplicas com app_keys diferentes não sobrescrevem o estado umas das
+    outras; para o mesmo app_key, um bloqueio do Omie registrado por uma
+    réplica nunca é encurtado pela gravação de outra.
+    """
+
+    def __init__(self, path=None):
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS limites_omie (
+                app_key TEXT PRIMARY KEY,
+                taxa REAL NOT NULL,
+                tokens REAL NOT NULL,
+                atualizado REAL NOT NULL,
+                bloqueado_ate REAL NOT NULL
+            )""")
+
+    def load(self, app_key):
+        """Estado no formato de OmieRateLimiter.snapshot(), ou None se o app_key não tem estado salvo."""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT taxa, tokens, atualizado, bloqueado_ate FROM limites_omie WHERE app_key = ?', (app_key,)
+            ).fetchone()
+        return dict(zip(('rate', 'tokens', 'updated', 'blocked_until'), row)) if row else None
+
+    def save(self, states):
+        with self.lock:
+            self.conn.executemany(
+                """INSERT INTO limites_omie (app_key, taxa, tokens, atualizado, bloqueado_ate) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(app_key) DO UPDATE SET taxa = excluded.taxa, tokens = excluded.tokens,
+                       atualizado = excluded.atualizado, bloqueado_ate = MAX(bloqueado_ate, excluded.bloqueado_ate)""",
+                [(app_key, state['rate'], state['tokens'], state['updated'], state['blocked_until'])
+                 for app_key, state in states.items()])
+
+_rate_limiter_store = None
+_rate_limiter_store_lock = threading.Lock()
+
+def get_rate_limiter_store():
+    global _rate_limiter_store
+    with _rate_limiter_store_lock:
+        if _rate_limiter_store is None:
+            _rate_limiter_store = RateLimiterStore()
+        return _rate_limiter_store
+
+# Fila persistente de payloads convertidos aguardando envio ao Omie
+FILA_MAX_TENTATIVAS = int(os.getenv('FILA_MAX_TENTATIVAS', '5'))
+
+class WorkQueue:
+    """Payloads já convertidos (com números sequenciais) que ainda não foram enviados.
+
+    Cada nota entra na fila antes do envio e sai quando o Omie a aceita ou a
+    reconhece como duplicada; uma queda no meio do caminho não perde o
+    trabalho. A chave é o MD5 da NFC-e, então reenfileirar é idempotente.
+    """
+
+    STATUS_CONCLUIDOS = ('enviada', 'duplicada', 'ignorada')
+
+    def __init__(self, path=None):
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fila_envio (
+                md5 TEXT PRIMARY KEY,
+                loja TEXT NOT NULL,
+                dh_emi TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                criado REAL NOT NULL,
+                atualizado REAL NOT NULL
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_fila_loja_status ON fila_envio (loja, status, criado)')
+
+    def enqueue(self, store_name, omie_json, dh_emi=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """INSERT OR IGNORE INTO fila_envio (md5, loja, dh_emi, payload, status, criado, atualizado)
+                   VALUES (?, ?, ?, ?, 'pendente', ?, ?)""",
+                (omie_json["nfce"]["nfceMd5"], store_name, dh_emi.isoformat() if dh_emi else None,
+                 json.dumps(omie_json, ensure_ascii=False), now, now))
+
+    def pending_md5s(self, store_name):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT md5 FROM fila_envio WHERE loja = ? AND status = 'pendente' ORDER BY criado", (store_name,)
+            ).fetchall()
+        return [md5 for md5, in rows]
+
+    def iter_pending(self, store_name, md5s=None):
+        """Gera (dh_emi, payload) das notas pendentes da loja, uma de cada vez."""
+        for md5 in (md5s if md5s is not None else self.pending_md5s(store_name)):
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT dh_emi, payload FROM fila_envio WHERE md5 = ? AND status = 'pendente'", (md5,)
+                ).fetchone()
+            if row:
+                yield (datetime.fromisoformat(row[0]) if row[0] else None), json.loads(row[1])
+
+    def finish(self, md5, status):
+        with self.lock:
+            if status in self.STATUS_CONCLUIDOS:
+                self.conn.execute('DELETE FROM fila_envio WHERE md5 = ?', (md5,))
+            elif status == 'erro':
+                self.conn.execute(
+                    """UPDATE fila_envio SET tentativas = tentativas + 1, atualizado = ?,
+                           status = CASE WHEN tentativas + 1 >= ? THEN 'erro' ELSE 'pendente' END
+                       WHERE md5 = ?""",
+                    (time.time(), FILA_MAX_TENTATIVAS, md5))
+
+    def compact(self, retention_days=DEDUP_RETENCAO_DIAS):
+        cutoff = time.time() - retention_days * 86400
+        with self.lock:
+            return self.conn.execute("DELETE FROM fila_envio WHERE status = 'erro' AND atualizado < ?", (cutoff,)).rowcount
+
+_work_queue = None
+_work_queue_lock = threading.Lock()
+
+def get_work_queue():
+    global _work_queue
+    with _work_queue_lock:
+        if _work_queue is None:
+            _work_queue = WorkQueue()
+        return _work_queue
+
+# Arquivo das notas: XML da ZIG e payload enviado, em segmentos gzip por loja e dia de emissão
+ARQUIVO_DIR = os.getenv('ARQUIVO_DIR', 'arquivo')  # vazio desliga o arquivo
+ARQUIVO_COMPRESSAO = int(os.getenv('ARQUIVO_COMPRESSAO', '6'))  # nível do gzip
+ARQUIVO_RETENCAO_DIAS = int(os.getenv('ARQUIVO_RETENCAO_DIAS', '0'))  # 0 = guarda para sempre
+
+class InvoiceArchive:
+    """Arquivo somente-acréscimo das notas tratadas, com índice por chave da NF-e e nNF.
+
+    Cada nota é um membro gzip independente com uma linha JSON (loja, chave,
+    nNF, série, dhEmi, MD5, XML da ZIG e payload do Omie), acrescentado ao
+    segmento `<loja>/<AAAA-MM-DD>.ndjson.gz`. O índice no SQLite guarda
+    segmento, posição e tamanho: ler uma nota é um seek e uma descompressão,
+    sem percorrer o segmento. Um segmento inteiro continua legível com zcat.
+    O nfceXml do payload não é gravado (é o XML da ZIG sem escapes) e é
+    refeito na leitura.
+    """
+
+    def __init__(self, directory=None, path=None):
+        self.directory = directory or ARQUIVO_DIR
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS arquivo_notas (
+                md5 TEXT PRIMARY KEY,
+                chave TEXT,
+                loja TEXT NOT NULL,
+                nnf TEXT,
+                serie TEXT,
+                dh_emi TEXT,
+                segmento TEXT NOT NULL,
+                posicao INTEGER NOT NULL,
+                tamanho INTEGER NOT NULL,
+                gravado REAL NOT NULL,
+                tpag TEXT,
+                vnf REAL,
+                vdesc REAL,
+                itens TEXT
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_arquivo_chave ON arquivo_notas (chave)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_arquivo_nnf ON arquivo_notas (nnf, serie)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_arquivo_emissao ON arquivo_notas (loja, dh_emi)')
+
+    def put(self, store_name, xml_data, omie_json, dh_emi=None):
+        nfe = omie_json["NFe"]
+        md5 = omie_json["nfce"]["nfceMd5"]
+        record = {
+            "loja": store_name,
+            "chave": nfe["chNFe"],
+            "nNF": nfe["nNF"],
+            "serie": nfe["serie"],
+            "dhEmi": dh_emi.isoformat() if dh_emi else None,
+            "md5": md5,
+            "xml": xml_data,
+            "payload": dict(omie_json, nfce=dict(omie_json["nfce"], nfceXml=None)),
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        data = gzip.compress(line.encode('utf-8'), ARQUIVO_COMPRESSAO)
+        _, _, _, _, tpag, vnf, vdesc, itens = payload_row(omie_json)
+        segmento = f"{store_name}/{(dh_emi or datetime.now()):%Y-%m-%d}.ndjson.gz"
+        filename = os.path.join(self.directory, segmento)
+        with self.lock:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'ab') as f:
+                posicao = f.tell()
+                f.write(data)
+            self.conn.execute(
+                """INSERT OR REPLACE INTO arquivo_notas
+                   (md5, chave, loja, nnf, serie, dh_emi, segmento, posicao, tamanho, gravado, tpag, vnf, vdesc, itens)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (md5, nfe["chNFe"] or None, store_name, nfe["nNF"], nfe["serie"], record["dhEmi"],
+                 segmento, posicao, len(data), time.time(), tpag, vnf, vdesc,
+                 json.dumps(itens, separators=(',', ':'))))
+
+    def read(self, segmento, posicao, tamanho):
+        with open(os.path.join(self.directory, segmento), 'rb') as f:
+            return read_archive_record(f, posicao, tamanho)
+
+    def _read_rows(self, rows):
+        # Linhas em sequência costumam ser do mesmo segmento: reaproveita o arquivo aberto
+        f, aberto = None, None
+        try:
+            for segmento, posicao, tamanho, status in rows:
+                if segmento != aberto:
+                    if f is not None:
+                        f.close()
+                    f, aberto = open(os.path.join(self.directory, segmento), 'rb'), segmento
+                record = read_archive_record(f, posicao, tamanho)
+                record["status"] = status
+                yield record
+        finally:
+            if f is not None:
+                f.close()
+
+    def _select(self, where, params, with_md5=False):
+        # Status do envio vem do índice de notas (mesmo banco)
+        with self.lock:
+            return self.conn.execute(
+                f"""SELECT a.segmento, a.posicao, a.tamanho, n.status{', a.md5' if with_md5 else ''} FROM arquivo_notas a
+                    LEFT JOIN notas_processadas n ON n.md5 = a.md5
+                    WHERE {where} ORDER BY a.segmento, a.posicao""", params).fetchall()
+
+    def lookup(self, chave=None, nnf=None, serie=None, store_name=None):
+        """Registros arquivados pela chave da NF-e ou pelo nNF (e série/loja, se informados)."""
+        conditions, params = [], []
+        for column, value in (('a.chave', chave), ('a.nnf', nnf), ('a.serie', serie), ('a.loja', store_name)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(str(value))
+        if not conditions:
+            return []
+        return list(self._read_rows(self._select(" AND ".join(conditions), params)))
+
+    def sent_rows(self, store_name, from_date, to_date):
+        """Gera payload_row das notas da loja emitidas entre as datas, direto do índice (sem ler os segmentos)."""
+        with self.lock:
+            rows = self.conn.execute(
+                """SELECT chave, md5, nnf, dh_emi, tpag, vnf, vdesc, itens
+                   FROM arquivo_notas WHERE loja = ? AND dh_emi >= ? AND dh_emi < ?""",
+                (store_name, from_date.strftime('%Y-%m-%d'), (to_date + timedelta(days=1)).strftime('%Y-%m-%d'))
+            ).fetchall()
+        for chave, md5, nnf, dh_emi, tpag, vnf, vdesc, itens in rows:
+            yield (chave or "", md5, nnf, dh_emi, tpag, vnf, vdesc, [tuple(item) for item in json.loads(itens)])
+
+    def entries(self, store_name, from_date, to_date, with_md5=False):
+        """Entradas do índice (segmento, posição, tamanho, status[, MD5]) da loja emitidas entre as datas (inclusive)."""
+        return self._select("a.loja = ? AND a.dh_emi >= ? AND a.dh_emi < ?",
+                            (store_name, from_date.strftime('%Y-%m-%d'),
+                             (to_date + timedelta(days=1)).strftime('%Y-%m-%d')), with_md5)
+
+    def iter_range(self, store_name, from_date, to_date):
+        """Gera, por dia de emissão, os registros da loja emitidos entre as datas (inclusive)."""
+        return self._read_rows(self.entries(store_name, from_date, to_date))
+
+    def compact(self, retention_days=None):
+        """Remove os segmentos (e suas entradas no índice) de dias anteriores à retenção."""
+        retention_days = ARQUIVO_RETENCAO_DIAS if retention_days is None else retention_days
+        if retention_days <= 0 or not os.path.isdir(self.directory):
+            return 0
+        cutoff = f"{datetime.now() - timedelta(days=retention_days):%Y-%m-%d}.ndjson.gz"
+        removed = 0
+        with self.lock:
+            for store_name in os.listdir(self.directory):
+                store_dir = os.path.join(self.directory, store_name)
+                if not os.path.isdir(store_dir):
+                    continue
+                for name in os.listdir(store_dir):
+                    if name.endswith('.ndjson.gz') and name < cutoff:
+                        self.conn.execute('DELETE FROM arquivo_notas WHERE segmento = ?', (f"{store_name}/{name}",))
+                        os.remove(os.path.join(store_dir, name))
+                        removed += 1
+        if removed:
+            logging.info(f"Arquivo de notas: {removed} segmentos removidos pela retenção.")
+        return removed
+
+def read_archive_record(f, posicao, tamanho):
+    # Um membro gzip do segmento aberto em `f`, com o nfceXml do payload refeito
+    f.seek(posicao)
+    record = json.loads(zlib.decompress(f.read(tamanho), 31))
+    nfce = record["payload"]["nfce"]
+    if nfce.get("nfceXml") is None:
+        nfce["nfceXml"] = html.unescape(record["xml"])
+    return record
+
+def read_archive_xml(f, posicao, tamanho):
+    # Só o XML da ZIG do registro, sem decodificar o payload (o campo "xml" vem antes dele)
+    f.seek(posicao)
+    line = zlib.decompress(f.read(tamanho), 31).decode('utf-8')
+    return json.decoder.scanstring(line, line.index('"xml":"') + 7)[0]
+
+_archive = None
+_archive_lock = threading.Lock()
+
+def get_archive():
+    global _archive
+    if not ARQUIVO_DIR:
+        return None
+    get_dedup_store()  # o índice consulta o status de envio em notas_processadas
+    with _archive_lock:
+        if _archive is None:
+            _archive = InvoiceArchive()
+        return _archive
+
+def archive_invoice(store_name, invoice, omie_json, dh_emi=None):
+    # Falha no arquivo não impede o envio da nota
+    archive = get_archive()
+    if archive is None:
+        return
+    try:
+        archive.put(store_name, invoice["xml"], omie_json, dh_emi)
+    except Exception as e:
+        logging.error(f"[{store_name}] Erro ao arquivar nota: {e}")
+
+# Coordenação entre réplicas: cada trabalhador integra só as lojas cuja concessão detém
+INTEGRACAO_COORDENACAO = os.getenv('INTEGRACAO_COORDENACAO', '')  # '' (processo único) ou 'sqlite'
+TRABALHADOR_ID = os.getenv('TRABALHADOR_ID', f"{socket.gethostname()}-{os.getpid()}")
+CONCESSAO_DURACAO = float(os.getenv('CONCESSAO_DURACAO', '120'))  # segundos sem renovação até a loja ser liberada
+CONCESSAO_RENOVACAO = float(os.getenv('CONCESSAO_RENOVACAO', '30'))
+
+class ShardCoordinator:
+    """Divide as lojas entre os trabalhadores que compartilham o banco SQLite.
+
+    Cada trabalhador registra um batimento e detém concessões (loja, validade).
+    A cada renovação ele renova as suas, devolve o que passar da parte justa
+    (lojas / trabalhadores vivos) e assume lojas sem concessão válida, inclusive
+    as de um trabalhador que parou de renovar. Tudo numa transação
+    BEGIN IMMEDIATE, então duas réplicas nunca detêm a mesma loja.
+    """
+
+    def __init__(self, worker_id=None, path=None):
+        self.worker_id = worker_id or TRABALHADOR_ID
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.owned = set()
+        self.expires = 0.0
+        self.on_claim = None  # chamado com as lojas recém-assumidas
+        self.stopped = threading.Event()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS trabalhadores (
+                id TEXT PRIMARY KEY,
+                batimento REAL NOT NULL,
+                iniciado REAL NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS concessoes (
+                loja TEXT PRIMARY KEY,
+                trabalhador TEXT NOT NULL,
+                expira REAL NOT NULL
+            )""")
+
+    def rebalance(self, stores, busy=()):
+        """Renova, devolve e assume concessões; retorna as lojas detidas por este trabalhador."""
+        stores = set(stores)
+        with self.lock:
+            now = time.time()
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute(
+                    """INSERT INTO trabalhadores (id, batimento, iniciado) VALUES (?, ?, ?)
+                       ON CONFLICT(id) DO UPDATE SET batimento = excluded.batimento""",
+                    (self.worker_id, now, now))
+                self.conn.execute('DELETE FROM trabalhadores WHERE batimento < ?', (now - CONCESSAO_DURACAO,))
+                workers = self.conn.execute('SELECT COUNT(*) FROM trabalhadores').fetchone()[0]
+                leases = dict(self.conn.execute('SELECT loja, trabalhador FROM concessoes WHERE expira >= ?', (now,)))
+                share = -(-len(stores) // max(workers, 1))
+
+                mine = {store for store, worker in leases.items() if worker == self.worker_id and store in stores}
+                # Excedente volta para o conjunto livre, exceto lojas em execução aqui
+                surplus = sorted(mine - set(busy), reverse=True)[:max(len(mine) - share, 0)]
+                mine.difference_update(surplus)
+                free = sorted(store for store in stores if store not in leases)
+                mine.update(free[:max(share - len(mine), 0)])
+
+                self.conn.execute('DELETE FROM concessoes WHERE trabalhador = ? OR expira < ?', (self.worker_id, now))
+                self.conn.executemany(
+                    'INSERT INTO concessoes (loja, trabalhador, expira) VALUES (?, ?, ?)',
+                    [(store, self.worker_id, now + CONCESSAO_DURACAO) for store in mine])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            lost, gained = self.owned - mine, mine - self.owned
+            self.owned, self.expires = mine, now + CONCESSAO_DURACAO
+
+        for store_name in lost:
+            if cancel_active_run(store_name):
+                logging.warning(f"[{store_name}] Concessão da loja perdida; execução em andamento interrompida.")
+        if gained or lost:
+            logging.info(f"[coordenação] {self.worker_id}: {len(mine)} lojas (+{len(gained)} -{len(lost)}), "
+                         f"{workers} trabalhadores ativos.")
+        if gained:
+            get_dedup_store().load()  # notas enviadas pelo dono anterior
+            if self.on_claim:
+                self.on_claim(gained)
+        return set(mine)
+
+    def owns(self, store_name):
+        with self.lock:
+            return store_name in self.owned and time.time() < self.expires
+
+    def start(self, stores_fn):
+        """Faz a primeira divisão e renova as concessões numa thread própria até stop()."""
+        self.rebalance(stores_fn())
+
+        def renew():
+            while not self.stopped.wait(CONCESSAO_RENOVACAO):
+                try:
+                    self.rebalance(stores_fn(), busy=active_run_names())
+                except Exception as e:
+                    logging.error(f"[coordenação] Erro ao renovar concessões: {e}")
+
+        threading.Thread(target=renew, name="coordenacao", daemon=True).start()
+
+    def stop(self):
+        # Devolve as lojas na saída, para outra réplica assumir sem esperar a validade expirar
+        self.stopped.set()
+        with self.lock:
+            self.conn.execute('DELETE FROM concessoes WHERE trabalhador = ?', (self.worker_id,))
+            self.conn.execute('DELETE FROM trabalhadores WHERE id = ?', (self.worker_id,))
+            self.owned = set()
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+def get_coordinator():
+    """Coordenador das réplicas, ou None quando o processo integra todas as lojas sozinho."""
+    global _coordinator
+    if INTEGRACAO_COORDENACAO != 'sqlite':
+        return None
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = ShardCoordinator()
+        return _coordinator
+
+# Execução das lojas: 'paralelo' (uma thread por loja), 'sequencial' ou 'async' (um event loop)
+INTEGRACAO_MODO = os.getenv('INTEGRACAO_MODO', 'paralelo')
+LOJAS_MAX_SIMULTANEAS = int(os.getenv('LOJAS_MAX_SIMULTANEAS', '8'))  # lojas integrando ao mesmo tempo
+LOJAS_RECARGA_SEGUNDOS = int(os.getenv('LOJAS_RECARGA_SEGUNDOS', '60'))  # verificação do cadastro de lojas
+OMIE_MAX_CONCORRENCIA = int(os.getenv('OMIE_MAX_CONCORRENCIA', '2'))  # envios simultâneos por app_key
+LOJA_FILA_MAXIMA = int(os.getenv('LOJA_FILA_MAXIMA', '20'))  # notas convertidas aguardando envio
+
+_app_key_semaphores = {}
+_app_key_semaphores_lock = threading.Lock()
+
+def get_app_key_semaphore(app_key):
+    with _app_key_semaphores_lock:
+        if app_key not in _app_key_semaphores:
+            _app_key_semaphores[app_key] = threading.BoundedSemaphore(OMIE_MAX_CONCORRENCIA)
+        return _app_key_semaphores[app_key]
+
+def omie_throttle_wait(response, response_data):
+    """Retorna None se não houve bloqueio, ou os segundos sugeridos (0 se o Omie não informar)."""
+    text = ""
+    if isinstance(response_data, dict):
+        text = f"{response_data.get('faultcode', '')} {response_data.get('faultstring', '')}"
+    if response.status_code != 429 and not any(m in text.lower() for m in OMIE_THROTTLE_MARCADORES):
+        return None
+    match = re.search(r'(\d+)\s*segundo', text)
+    if match:
+        return float(match.group(1))
+    retry_after = response.headers.get('Retry-After', '')
+    return float(retry_after) if retry_after.isdigit() else 0
+
+# Métricas de tempo e volume por loja e etapa, no formato texto do Prometheus
+METRICAS_PORTA = int(os.getenv('METRICAS_PORTA', '0'))  # 0 = sem endpoint HTTP
+METRICAS_ENDERECO = os.getenv('METRICAS_ENDERECO', '127.0.0.1')
+METRICAS_FAIXAS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICAS_DESCRICOES = {
+    'integracao_etapa_segundos': "Duração de cada etapa da integração",
+    'integracao_http_segundos': "Duração das chamadas HTTP à ZIG e ao Omie",
+    'integracao_notas_total': "Notas tratadas, por status",
+    'integracao_http_tentativas_extras_total': "Novas tentativas de chamadas HTTP",
+    'integracao_http_erros_total': "Chamadas HTTP com erro de conexão ou 5xx",
+    'integracao_omie_faults_total': "Faults de negócio devolvidos pelo Omie",
+    'integracao_omie_limites_total': "Bloqueios por limite de consumo do Omie",
+    'integracao_fila_envio': "Notas convertidas aguardando envio",
+    'integracao_notas_por_segundo': "Notas enviadas por segundo na última execução da loja",
+    'integracao_catalogo_itens_total': "Itens por origem do idProduto (catálogo ou padrão)",
+    'integracao_proxima_execucao_segundos': "Espaçamento até a próxima execução da loja (agendamento adaptativo)",
+}
+
+class Histogram:
+    """Histograma cumulativo (para o endpoint) e amostras da execução atual (para o resumo)."""
+
+    def __init__(self, amostras=4096):
+        self.buckets = [0] * len(METRICAS_FAIXAS)
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=amostras)
+        self.run_count = 0
+        self.run_total = 0.0
+
+    def observe(self, value):
+        for i, limite in enumerate(METRICAS_FAIXAS):
+            if value <= limite:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+        self.run_count += 1
+        self.run_total += value
+
+    def reset_run(self):
+        self.samples.clear()
+        self.run_count = 0
+        self.run_total = 0.0
+
+class MetricsRegistry:
+    """Histogramas, contadores e medidores identificados por nome e rótulos."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.counters_baseline = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def reset_run(self):
+        # O endpoint continua cumulativo; o resumo passa a contar a partir daqui
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.reset_run()
+            self.counters_baseline = dict(self.counters)
+
+    def render(self):
+        """Exporta as métricas no formato texto do Prometheus (versão 0.0.4)."""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (k + '="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                       for k, v in pairs)
+            return '{' + ','.join(escaped) + '}'
+
+        lines = []
+        with self.lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges), ('histogram', self.histograms)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# HELP {name} {METRICAS_DESCRICOES.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name != name:
+                            continue
+                        if kind != 'histogram':
+                            lines.append(f"{name}{fmt(labels)} {value}")
+                            continue
+                        acumulado = 0
+                        for limite, n in zip(METRICAS_FAIXAS, value.buckets):
+                            acumulado += n
+                            lines.append(f"{name}_bucket{fmt(labels, [('le', str(limite))])} {acumulado}")
+                        lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {value.count}")
+                        lines.append(f"{name}_sum{fmt(labels)} {value.total}")
+                        lines.append(f"{name}_count{fmt(labels)} {value.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Linhas de resumo da execução atual: etapas com contagem, média e percentis, e contadores."""
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not histogram.run_count:
+                    continue
+                samples = sorted(histogram.samples)
+                def percentile(p):
+                    return samples[min(int(len(samples) * p), len(samples) - 1)]
+                rotulos = ' '.join(v for _, v in labels)
+                lines.append(
+                    f"{name} {rotulos}: {histogram.run_count} medições, média {histogram.run_total / histogram.run_count:.4f}s, "
+                    f"p50 {percentile(0.50):.4f}s, p99 {percentile(0.99):.4f}s")
+            for (name, labels), value in sorted(self.counters.items()):
+                delta = value - self.counters_baseline.get((name, labels), 0)
+                if delta:
+                    lines.append(f"{name} {' '.join(v for _, v in labels)}: {delta}")
+        return lines
+
+metrics = MetricsRegistry()
+
 @contextmanager
-def timeout(duration):
-    def raise_timeout():
-        raise TimeoutError("Operation timed out.")
-    
-    timer = threading.Timer(duration, raise_timeout)
-    timer.start()
+def observe_stage(stage, store_name=None):
+    """Mede a duração do bloco em integracao_etapa_segundos{etapa, loja}."""
+    inicio = time.perf_counter()
     try:
+        with profile_stage(stage):
+            yield
+    finally:
+        metrics.observe('integracao_etapa_segundos', time.perf_counter() - inicio, etapa=stage, loja=store_name)
+
+def log_metrics_summary():
+    for line in metrics.summary():
+        logging.info(f"[métricas] {line}")
+
+# Perfis dos comandos avulsos (--profile DIR e --tracemalloc)
+PERFIL_LINHAS = int(os.getenv('PERFIL_LINHAS', '40'))  # funções no resumo em texto de cada etapa
+
+class StageProfiler:
+    """cProfile separado por etapa da integração.
+
+    Cada thread tem um Profile por etapa, somados no dump. Uma etapa aninhada
+    pausa a de fora até terminar, então o tempo fica com a etapa mais interna.
+    No Python 3.12+ só um perfilador pode estar ativo por processo: etapas que
+    começam enquanto outra thread está sendo medida ficam fora do perfil.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}  # (etapa, thread) -> cProfile.Profile
+        self.local = threading.local()
+
+    @staticmethod
+    def _enable(profile):
+        try:
+            profile.enable()
+        except ValueError:
+            pass  # outro perfilador ativo no processo
+
+    @contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        with self.lock:
+            profile = self.profiles.setdefault((name, threading.get_ident()), cProfile.Profile())
+        if stack:
+            stack[-1].disable()
+        stack.append(profile)
+        self._enable(profile)
+        try:
+            yield
+        finally:
+            profile.disable()
+            # No event loop as etapas se intercalam: sai esta, não necessariamente a do topo
+            del stack[len(stack) - 1 - stack[::-1].index(profile)]
+            if stack:
+                self._enable(stack[-1])
+
+    def dump(self, directory):
+        """Grava <etapa>.prof (pstats) e <etapa>.txt (funções por tempo acumulado); retorna os .prof gravados."""
+        by_stage = {}
+        for (name, _), profile in self.profiles.items():
+            by_stage.setdefault(name, []).append(profile)
+        paths = []
+        for name, profiles in sorted(by_stage.items()):
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if profile.stats:
+                    stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+            if stats is None:
+                continue
+            path = os.path.join(directory, f"{name}.prof")
+            stats.dump_stats(path)
+            with open(os.path.join(directory, f"{name}.txt"), 'w', encoding='utf-8') as f:
+                pstats.Stats(path, stream=f).sort_stats('cumulative').print_stats(PERFIL_LINHAS)
+            paths.append(path)
+        return paths
+
+_stage_profiler = None
+
+@contextmanager
+def profile_stage(stage):
+    """Atribui o bloco ao perfil da etapa quando há um StageProfiler ativo (--profile)."""
+    profiler = _stage_profiler
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(stage):
+        yield
+
+def memory_report(directory=None, limite=25):
+    """Pico e maiores alocações ainda vivas segundo o tracemalloc; com `directory`, grava memoria.txt e memoria.snapshot."""
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    atual, pico = tracemalloc.get_traced_memory()
+    linhas = [f"Memória rastreada: pico de {pico / 1024 / 1024:.1f} MB, {atual / 1024 / 1024:.1f} MB ainda alocados no fim.",
+              f"Maiores alocações vivas no fim (por linha):"]
+    linhas.extend(f"  {stat}" for stat in snapshot.statistics('lineno')[:limite])
+    if directory:
+        snapshot.dump(os.path.join(directory, 'memoria.snapshot'))
+        with open(os.path.join(directory, 'memoria.txt'), 'w', encoding='utf-8') as f:
+            f.write("\n".join(linhas) + "\n")
+        print(f"{linhas[0]} Detalhes em {os.path.join(directory, 'memoria.txt')}.")
+    else:
+        print("\n".join(linhas))
+
+@contextmanager
+def profiling(directory=None, trace_memory=False, command='comando'):
+    """Perfil de um comando avulso: cProfile por etapa em `directory` e, com `trace_memory`, o tracemalloc.
+
+    O tempo da thread principal fora das etapas fica no perfil `command`. A
+    conversão passa para a thread da loja (CONVERSAO_PROCESSOS=0), para entrar
+    no perfil.
+    """
+    global _stage_profiler, CONVERSAO_PROCESSOS
+    if not directory and not trace_memory:
         yield
+        return
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        if CONVERSAO_PROCESSOS > 0:
+            logging.info("Perfil ativo: conversão na thread da loja, sem o pool de processos.")
+            CONVERSAO_PROCESSOS = 0
+        _stage_profiler = StageProfiler()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with profile_stage(command):
+            yield
+    finally:
+        if trace_memory:
+            memory_report(directory)
+            tracemalloc.stop()
+        if directory:
+            profiler, _stage_profiler = _stage_profiler, None
+            paths = profiler.dump(directory)
+            print(f"Perfis por etapa em {directory}: {', '.join(os.path.basename(path) for path in paths)}")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # /metrics para o Prometheus e, no mesmo servidor, o webhook POST /sync/<loja>
+    WEBHOOK_CODIGOS = {'agendada': 202, 'em_execucao': 202, 'desconhecida': 404, 'outra_replica': 409, 'parado': 503}
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        self._reply(200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))  # o corpo do aviso não é usado
+        partes = self.path.split('?')[0].strip('/').split('/')
+        if len(partes) != 2 or partes[0] != 'sync':
+            self.send_error(404)
+            return
+        if AGENDA_WEBHOOK_TOKEN and not hmac.compare_digest(
+                self.headers.get('Authorization', ''), f"Bearer {AGENDA_WEBHOOK_TOKEN}"):
+            self.send_error(401)
+            return
+        store_name = unquote(partes[1])
+        situacao = request_store_sync(store_name)
+        body = json.dumps({"loja": store_name, "situacao": situacao}).encode()
+        self._reply(self.WEBHOOK_CODIGOS[situacao], 'application/json', body)
+
+    def _reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # as consultas periódicas não vão para o log da integração
+
+_metrics_server = None
+
+def start_metrics_server(port=None, host=None):
+    """Sobe o endpoint /metrics numa thread em segundo plano (uma vez por processo)."""
+    global _metrics_server
+    port = METRICAS_PORTA if port is None else port
+    if not port or _metrics_server is not None:
+        return _metrics_server
+    _metrics_server = ThreadingHTTPServer((host or METRICAS_ENDERECO, port), _MetricsHandler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, name="metricas", daemon=True).start()
+    logging.info(f"Métricas disponíveis em http://{host or METRICAS_ENDERECO}:{port}/metrics")
+    return _metrics_server
+
+# Cliente HTTP compartilhado (uma Session com keep-alive por host)
+ZIG_API_URL = os.getenv('ZIG_API_URL', "https://api.zigcore.com.br/integration/erp/invoice")
+OMIE_API_URL = os.getenv('OMIE_API_URL', "https://app.omie.com.br/api/v1/produtos/cupomfiscalincluir/")
+HTTP_TIMEOUT_CONEXAO = float(os.getenv('HTTP_TIMEOUT_CONEXAO', '10'))
+HTTP_TIMEOUT_LEITURA = float(os.getenv('HTTP_TIMEOUT_LEITURA', '60'))
+HTTP_MAX_TENTATIVAS = int(os.getenv('HTTP_MAX_TENTATIVAS', '4'))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '1'))
+HTTP_BACKOFF_MAXIMO = float(os.getenv('HTTP_BACKOFF_MAXIMO', '30'))
+HTTP_POOL_MAXIMO = int(os.getenv('HTTP_POOL_MAXIMO', '10'))
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(url):
+    host = urlsplit(url).netloc
+    with _http_sessions_lock:
+        if host not in _http_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXIMO)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[host] = session
+        return _http_sessions[host]
+
+class EndpointStats:
+    """Latência e falhas das chamadas a um endpoint."""
+
+    def __init__(self, endpoint, amostras=1024):
+        self.endpoint = endpoint
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=amostras)
+        self.lock = threading.Lock()
+
+    def record(self, duration, ok=True, retry=False):
+        with self.lock:
+            self.count += 1
+            self.total += duration
+            self.max = max(self.max, duration)
+            self.samples.append(duration)
+            if not ok:
+                self.errors += 1
+            if retry:
+                self.retries += 1
+        metrics.observe('integracao_http_segundos', duration, endpoint=self.endpoint)
+        if not ok:
+            metrics.inc('integracao_http_erros_total', endpoint=self.endpoint)
+        if retry:
+            metrics.inc('integracao_http_tentativas_extras_total', endpoint=self.endpoint)
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            def percentile(p):
+                return samples[min(int(len(samples) * p), len(samples) - 1)] if samples else 0.0
+            return {
+                'chamadas': self.count,
+                'erros': self.errors,
+                'tentativas_extras': self.retries,
+                'media': self.total / self.count if self.count else 0.0,
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'max': self.max,
+            }
+
+_endpoint_stats = {}
+_endpoint_stats_lock = threading.Lock()
+
+def get_endpoint_stats(endpoint):
+    with _endpoint_stats_lock:
+        if endpoint not in _endpoint_stats:
+            _endpoint_stats[endpoint] = EndpointStats(endpoint)
+        return _endpoint_stats[endpoint]
+
+def log_endpoint_stats():
+    for endpoint, stats in sorted(_endpoint_stats.items()):
+        r = stats.summary()
+        logging.info(
+            f"[http] {endpoint}: {r['chamadas']} chamadas, {r['erros']} erros, {r['tentativas_extras']} novas tentativas, "
+            f"média {r['media']:.3f}s, p50 {r['p50']:.3f}s, p95 {r['p95']:.3f}s, máx {r['max']:.3f}s")
+
+def retry_delay(tentativa):
+    # Backoff exponencial com jitter (metade fixa, metade aleatória)
+    cap = min(HTTP_BACKOFF_MAXIMO, HTTP_BACKOFF_BASE * (2 ** (tentativa - 1)))
+    return cap / 2 + random.uniform(0, cap / 2)
+
+def http_request(method, url, endpoint, retry_status=(500, 502, 503, 504), deadline=None, **kwargs):
+    """Faz a requisição pela Session do host, com timeouts e novas tentativas.
+
+    Erros de conexão/timeout e os status em `retry_status` são repetidos até
+    HTTP_MAX_TENTATIVAS vezes; a última resposta (ou exceção) é devolvida.
+    Com `deadline`, cada tentativa usa no máximo o tempo restante do prazo.
+    """
+    session = get_http_session(url)
+    stats = get_endpoint_stats(endpoint)
+    sleep = deadline.sleep if deadline is not None else time.sleep
+    for tentativa in range(1, HTTP_MAX_TENTATIVAS + 1):
+        if deadline is not None:
+            deadline.check()
+            remaining = deadline.remaining()
+            kwargs['timeout'] = (min(HTTP_TIMEOUT_CONEXAO, remaining), min(HTTP_TIMEOUT_LEITURA, remaining))
+        else:
+            kwargs.setdefault('timeout', (HTTP_TIMEOUT_CONEXAO, HTTP_TIMEOUT_LEITURA))
+        inicio = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            stats.record(time.perf_counter() - inicio, ok=False, retry=tentativa > 1)
+            if tentativa == HTTP_MAX_TENTATIVAS:
+                raise
+            logging.warning(f"[http] {endpoint}: {e.__class__.__name__} (tentativa {tentativa}/{HTTP_MAX_TENTATIVAS})")
+            sleep(retry_delay(tentativa))
+            continue
+        ok = response.status_code not in retry_status
+        stats.record(time.perf_counter() - inicio, ok=ok, retry=tentativa > 1)
+        if ok or tentativa == HTTP_MAX_TENTATIVAS:
+            return response
+        logging.warning(f"[http] {endpoint}: status {response.status_code} (tentativa {tentativa}/{HTTP_MAX_TENTATIVAS})")
+        sleep(retry_delay(tentativa))
+
+INTEGRACAO_TIMEOUT = float(os.getenv('INTEGRACAO_TIMEOUT', '900'))  # segundos por loja
+
+class Deadline:
+    """Prazo de uma execução, consultado entre as notas e repassado às chamadas de rede."""
+
+    def __init__(self, duration):
+        self.expires = time.monotonic() + duration
+        self.cancelled = threading.Event()
+
+    def remaining(self):
+        if self.cancelled.is_set():
+            return 0.0
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check(self):
+        if self.expired():
+            raise TimeoutError("Operation timed out.")
+
+    def sleep(self, seconds):
+        # Dorme no máximo até o fim do prazo; acorda antes se for cancelado
+        self.cancelled.wait(min(seconds, self.remaining()))
+
+# Prazo da execução; o código dentro do bloco consulta o Deadline devolvido
+@contextmanager
+def timeout(duration):
+    deadline = Deadline(duration)
+    try:
+        yield deadline
+    finally:
+        deadline.cancel()
+
+# Execuções em andamento por loja, para poderem ser interrompidas de fora
+_active_runs = {}
+_active_runs_lock = threading.Lock()
+
+@contextmanager
+def active_run(store_name, deadline):
+    with _active_runs_lock:
+        _active_runs[store_name] = deadline
+    try:
+        yield deadline
     finally:
-        timer.cancel()
+        with _active_runs_lock:
+            _active_runs.pop(store_name, None)
+
+def active_run_names():
+    with _active_runs_lock:
+        return set(_active_runs)
+
+def cancel_active_run(store_name):
+    with _active_runs_lock:
+        deadline = _active_runs.get(store_name)
+    if deadline is not None:
+        deadline.cancel()
+    return deadline is not None
 
-def fetch_invoices(store_config, from_date, to_date, page):
+ZIG_BLOCO_BYTES = int(os.getenv('ZIG_BLOCO_BYTES', str(64 * 1024)))  # leitura incremental das páginas
+
+class JsonArrayStream:
+    """Lê um array JSON de objetos aos pedaços, devolvendo cada elemento assim que ele termina.
+
+    Só o elemento em leitura fica em memória, qualquer que seja o tamanho da
+    página. feed() recebe bytes e devolve os elementos completos; close()
+    confirma que o array terminou.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk, final=False):
+        buffer = self.buffer + self.utf8.decode(chunk, final)
+        items = []
+        pos = 0
+        while not self.finished:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not self.started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Resposta da ZIG não é uma lista: {buffer[pos:pos + 200]!r}")
+                self.started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                self.finished = True
+                pos += 1
+                break
+            try:
+                item, pos = self.decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # elemento ainda incompleto: espera o próximo bloco
+            items.append(item)
+        self.buffer = buffer[pos:]
+        return items
+
+    def close(self):
+        self.feed(b'', final=True)
+        if not self.finished:
+            raise ValueError("Resposta da ZIG incompleta ou inválida.")
+
+def stream_invoices(store_config, from_date, to_date, page, deadline=None):
+    """Gera as notas de uma página da ZIG à medida que chegam, sem carregar a página inteira."""
     headers = {
         "Authorization": store_config.zig_token,
     }
@@ -75,11 +1611,174 @@ def fetch_invoices(store_config, from_date, to_date, page):
         "loja": store_config.zig_rede,
         "page": str(page)
     }
-    response = requests.get("https://api.zigcore.com.br/integration/erp/invoice?", headers=headers, params=params)
-    if response.status_code != 200:
-        raise Exception(f"Unexpected status: {response.status_code}")
-    
-    return response.json()
+    with observe_stage('zig_busca', store_config.name):
+        response = http_request("GET", ZIG_API_URL, "zig.invoice", deadline=deadline, headers=headers, params=params,
+                                stream=True)
+    with response:
+        if response.status_code != 200:
+            raise Exception(f"Unexpected status: {response.status_code}")
+        parser = JsonArrayStream()
+        for chunk in response.iter_content(chunk_size=ZIG_BLOCO_BYTES):
+            yield from parser.feed(chunk)
+        parser.close()
+
+def fetch_invoices(store_config, from_date, to_date, page, deadline=None):
+    return list(stream_invoices(store_config, from_date, to_date, page, deadline))
+
+# Cursor de páginas da ZIG, para retomar uma execução interrompida
+ZIG_PREFETCH_NOTAS = int(os.getenv('ZIG_PREFETCH_NOTAS', '200'))
+
+class PageCursorStore:
+    """Próxima página da ZIG de cada loja, uma linha por loja no banco compartilhado pelas réplicas."""
+
+    def __init__(self, path=None):
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cursores_zig (
+                loja TEXT PRIMARY KEY,
+                periodo TEXT NOT NULL,
+                pagina INTEGER NOT NULL,
+                atualizado REAL NOT NULL
+            )""")
+
+    def load(self, store_name, periodo):
+        with self.lock:
+            row = self.conn.execute('SELECT periodo, pagina FROM cursores_zig WHERE loja = ?', (store_name,)).fetchone()
+        return row[1] if row and row[0] == periodo else None
+
+    def save(self, store_name, periodo, page):
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO cursores_zig (loja, periodo, pagina, atualizado) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(loja) DO UPDATE SET periodo = excluded.periodo, pagina = excluded.pagina,
+                       atualizado = excluded.atualizado""",
+                (store_name, periodo, page, time.time()))
+
+    def clear(self, store_name):
+        with self.lock:
+            self.conn.execute('DELETE FROM cursores_zig WHERE loja = ?', (store_name,))
+
+_page_cursor_store = None
+_page_cursor_store_lock = threading.Lock()
+
+def get_page_cursor_store():
+    global _page_cursor_store
+    with _page_cursor_store_lock:
+        if _page_cursor_store is None:
+            _page_cursor_store = PageCursorStore()
+        return _page_cursor_store
+
+def _cursor_key(from_date, to_date):
+    return f"{from_date.strftime('%Y-%m-%d')}/{to_date.strftime('%Y-%m-%d')}"
+
+def load_page_cursor(store_name, from_date, to_date):
+    """Retorna a próxima página a buscar para a loja, ou 1 se não houver cursor válido."""
+    return get_page_cursor_store().load(store_name, _cursor_key(from_date, to_date)) or 1
+
+def save_page_cursor(store_name, from_date, to_date, page):
+    get_page_cursor_store().save(store_name, _cursor_key(from_date, to_date), page)
+
+def clear_page_cursor(store_name):
+    get_page_cursor_store().clear(store_name)
+
+def iter_invoices(store_config, from_date, to_date, start_page=1, deadline=None):
+    """Percorre todas as páginas da ZIG gerando tuplas (página, nota).
+
+    Ao fim de cada página é gerado (página, None). Uma thread busca as próximas
+    páginas enquanto as notas atuais são processadas; o buffer é limitado a
+    ZIG_PREFETCH_NOTAS notas.
+    """
+    buffer = queue.Queue(maxsize=ZIG_PREFETCH_NOTAS)
+    stop = threading.Event()
+    fim = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        page = start_page
+        previous_first = None
+        try:
+            while not stop.is_set():
+                first = fim
+                for invoice in stream_invoices(store_config, from_date, to_date, page, deadline):
+                    if first is fim:
+                        first = invoice.get("xml")
+                        if first is not None and first == previous_first:
+                            logging.warning(f"[{store_config.name}] Página {page} repetiu a anterior; encerrando paginação.")
+                            break
+                    if not put((page, invoice)):
+                        return
+                    invoice = None  # só o buffer guarda a nota
+                if first is fim or first is not None and first == previous_first:
+                    break
+                previous_first = first
+                if not put((page, None)):
+                    return
+                page += 1
+            put(fim)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, name=f"zig-{store_config.name}", daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item = buffer.get(timeout=1)
+            except queue.Empty:
+                if deadline is not None:
+                    deadline.check()
+                continue
+            if item is fim:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+class PageCheckpoint:
+    """Acompanha as notas pendentes por página e avisa quando uma página
+    (e todas as anteriores) terminou de ser enviada."""
+
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+        self.pending = {}
+        self.closed = set()
+        self.lock = threading.Lock()
+
+    def add(self, page):
+        with self.lock:
+            self.pending[page] = self.pending.get(page, 0) + 1
+
+    def done(self, page):
+        with self.lock:
+            self.pending[page] -= 1
+            self._advance()
+
+    def close(self, page):
+        with self.lock:
+            self.closed.add(page)
+            self.pending.setdefault(page, 0)
+            self._advance()
+
+    def _advance(self):
+        while self.pending:
+            page = min(self.pending)
+            if page not in self.closed or self.pending[page] > 0:
+                return
+            del self.pending[page]
+            self.closed.discard(page)
+            self.on_complete(page)
+
 def create_xlsx_from_omie_json(omie_json, filename=None):
     if filename is None:
         filename = f"omie_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
@@ -168,29 +1867,141 @@ def convert_xml_to_json(xml_string):
     root = ET.fromstring(xml_string)
     return json.dumps(_xml_to_dict(root), indent=2)
 
-def convert_xml_to_omie_json(xml_data):
-    nfe_json, nfe_data = parse_nfe_xml(xml_data)
-    nome_transformado = nfe_data['emit']['xFant'].replace("COMERCIO DE ", "").replace(" LTDA", "")
-    xml_unescaped = html.unescape(xml_data)
+# Mapeamento dos códigos TPag (exemplo, ajuste conforme a especificação)
+# Os códigos numéricos do XML são mapeados para as opções definidas:
+TPAG_MAPPING = {
+    "01": "DIN",    # Dinheiro
+    "02": "CHQ",    # Cheque
+    "03": "CRC",    # Cartão de Crédito
+    "04": "CRD",    # Cartão de Débito
+    "05": "CRE",    # Crediário
+    "15": "BOL",    # Boleto (código hipotético)
+    "16": "PIX",    # Pix (código hipotético)
+    "99": "99999"   # Outros
+    # Outros códigos podem ser adicionados aqui se necessário
+}
+
+NFE_NS = '{http://www.portalfiscal.inf.br/nfe}'
+
+class NFeItem:
+    __slots__ = ('nItem', 'cProd', 'cEAN', 'xProd', 'NCM', 'CFOP', 'uCom', 'qCom', 'vUnCom', 'vProd')
+
+    def __init__(self, nItem, fields):
+        self.nItem = nItem
+        for name in self.__slots__[1:]:
+            setattr(self, name, fields.get(name))
+
+class NFeRecord:
+    """Somente os campos da NF-e usados no payload do Omie."""
+
+    __slots__ = ('Id', 'dhEmi', 'nNF', 'serie', 'tpAmb', 'tpEmis', 'verProc', 'xFant',
+                 'vNF', 'vDesc', 'vICMS', 'vProd', 'vTotTrib', 'tPag', 'nProt', 'det')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.det = []
+
+_TAG_PROD = NFE_NS + 'prod'
+_TAG_DET = NFE_NS + 'det'
+_TAG_IDE = NFE_NS + 'ide'
+_TAG_EMIT = NFE_NS + 'emit'
+_TAG_XFANT = NFE_NS + 'xFant'
+_TAG_ICMSTOT = NFE_NS + 'ICMSTot'
+_TAG_DETPAG = NFE_NS + 'detPag'
+_TAG_TPAG = NFE_NS + 'tPag'
+_TAG_NPROT = NFE_NS + 'nProt'
+_TAG_INFNFE = NFE_NS + 'infNFe'
+
+def _children_text(element):
+    n = len(NFE_NS)
+    return {child.tag[n:]: child.text for child in element}
+
+XML_BLOCO = 16 * 1024
+
+def _pull_events(xml_data, bloco=XML_BLOCO):
+    # Alimenta o parser em blocos e entrega os eventos de cada bloco antes do
+    # próximo: como os blocos lidos são limpos, a árvore nunca fica inteira em memória
+    parser = ET.XMLPullParser(events=('end',))
+    for inicio in range(0, len(xml_data), bloco):
+        parser.feed(xml_data[inicio:inicio + bloco])
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def parse_nfe_record(xml_data):
+    """Extrai um NFeRecord do XML em uma única passada (eventos 'end').
+
+    Cada bloco de interesse é lido quando termina e descartado em seguida,
+    sem montar dicionários intermediários nem serializar JSON.
+    """
+    record = NFeRecord()
+    det_fields = None
+    for _, elem in _pull_events(xml_data):
+        tag = elem.tag
+        if tag == _TAG_PROD:
+            det_fields = _children_text(elem)
+        elif tag == _TAG_DET:
+            record.det.append(NFeItem(elem.attrib.get('nItem'), det_fields or {}))
+            det_fields = None
+            elem.clear()
+        elif tag == _TAG_IDE:
+            fields = _children_text(elem)
+            record.dhEmi = fields.get('dhEmi')
+            record.nNF = fields.get('nNF')
+            record.serie = fields.get('serie')
+            record.tpAmb = fields.get('tpAmb')
+            record.tpEmis = fields.get('tpEmis')
+            record.verProc = fields.get('verProc')
+            elem.clear()
+        elif tag == _TAG_EMIT:
+            record.xFant = elem.findtext(_TAG_XFANT)
+            elem.clear()
+        elif tag == _TAG_ICMSTOT:
+            fields = _children_text(elem)
+            record.vNF = fields.get('vNF')
+            record.vDesc = fields.get('vDesc')
+            record.vICMS = fields.get('vICMS')
+            record.vProd = fields.get('vProd')
+            record.vTotTrib = fields.get('vTotTrib')
+            elem.clear()
+        elif tag == _TAG_DETPAG:
+            if record.tPag is None:
+                tpag = (elem.findtext(_TAG_TPAG) or '').strip() or "99999"
+                record.tPag = TPAG_MAPPING.get(tpag, "99999")
+        elif tag == _TAG_NPROT:
+            record.nProt = elem.text
+        elif tag == _TAG_INFNFE:
+            record.Id = elem.attrib.get('Id')
+    if record.tPag is None:
+        record.tPag = "99999"
+    return record
+
+def convert_xml_to_omie_json(xml_data, nfe=None):
+    nfe = nfe or parse_nfe_record(xml_data)
+    nome_transformado = nfe.xFant.replace("COMERCIO DE ", "").replace(" LTDA", "")
+    xml_unescaped = html.unescape(xml_data)
+    emissao = datetime.strptime(nfe.dhEmi, "%Y-%m-%dT%H:%M:%S%z")
+    data_emissao = emissao.strftime("%d/%m/%Y")
     omie_json = {
         "NFe": {
-            "chNFe": nfe_data['Id'][3:] if nfe_data.get('Id') else "",
-            "dEmi": datetime.strptime(nfe_data['ide']['dhEmi'], "%Y-%m-%dT%H:%M:%S%z").strftime("%d/%m/%Y"),
-            "hEmi": datetime.strptime(nfe_data['ide']['dhEmi'], "%Y-%m-%dT%H:%M:%S%z").strftime("%H:%M:%S"),
-            "nNF": nfe_data['ide']['nNF'],
-            "serie": nfe_data['ide']['serie'],
-            "tpAmb": "P" if nfe_data['ide']['tpAmb'] == "1" else "H",
-            "tpEmis": nfe_data['ide']['tpEmis'],
+            "chNFe": nfe.Id[3:] if nfe.Id else "",
+            "dEmi": data_emissao,
+            "hEmi": emissao.strftime("%H:%M:%S"),
+            "nNF": nfe.nNF,
+            "serie": nfe.serie,
+            "tpAmb": "P" if nfe.tpAmb == "1" else "H",
+            "tpEmis": nfe.tpEmis,
             "lCanc": False,  # Assuming not cancelled
             "det": [],
             "total": {
                 "vAcresc": "0.00",
-                "vCF": nfe_data['total']['vNF'],
-                "vDesc": nfe_data['total']['vDesc'],
-                "vICMS": nfe_data['total']['vICMS'],
-                "vItem": nfe_data['total']['vProd'],
+                "vCF": nfe.vNF,
+                "vDesc": nfe.vDesc,
+                "vICMS": nfe.vICMS,
+                "vItem": nfe.vProd,
                 "vTaxa": 0,
-                "vTotTrib": nfe_data['total']['vTotTrib']
+                "vTotTrib": nfe.vTotTrib
             }
         },
         "caixa": {
@@ -204,18 +2015,18 @@ def convert_xml_to_omie_json(xml_data):
             "idVendedor": 0
         },
         "emissor": {
-            "emiId": 6029653,
+            "emiId": OMIE_EMI_ID_PADRAO,
             "emiNome": nome_transformado,
             "emiSerial": "",  # You'll need to provide this information
-            "emiVersao": nfe_data['ide']['verProc']
+            "emiVersao": nfe.verProc
         },
         "formasPag": [
              {
             "Parcelas": [
                 {
-                "dVenc": datetime.strptime(nfe_data['ide']['dhEmi'], "%Y-%m-%dT%H:%M:%S%z").strftime("%d/%m/%Y"),    
+                "dVenc": data_emissao,
                 "nParc": "001/001",
-                "vParc": nfe_data['total']['vNF']
+                "vParc": nfe.vNF
                 }
             ],
             "TEF": {
@@ -224,14 +2035,14 @@ def convert_xml_to_omie_json(xml_data):
             "lNaoGerarTitulo":False,
             "pag": {
                 "pTaxa": 0,
-                "vLiq": nfe_data['total']['vNF'],  # Corrigido para o valor total correto
-                "vPag": nfe_data['total']['vNF'],  # Certifique-se que o valor está correto
+                "vLiq": nfe.vNF,  # Corrigido para o valor total correto
+                "vPag": nfe.vNF,  # Certifique-se que o valor está correto
                 "vTaxa": 0,
                 "vTroco": 0
             },
             "pagIdent": {
                 "cCategoria": " 1.01.03",
-                "cTipoPag": nfe_data['pag']['tPag'],
+                "cTipoPag": nfe.tPag,
                 #"idConta":  7502625278
                 "idConta": 0
             },
@@ -239,60 +2050,189 @@ def convert_xml_to_omie_json(xml_data):
             }],  # You'll need to provide this information
         "nfce": {
             "nfceMd5": hashlib.md5(xml_unescaped.encode()).hexdigest(),
-            "nfceProt": nfe_data['nProt'],
+            "nfceProt": nfe.nProt,
             "nfceXml": xml_unescaped,
         }
     }
     
-    for item in nfe_data['det']:
+    for item in nfe.det:
+        v_prod = float(item.vProd)
         det_item = {
             "lCanc": False,
             "lNaoMovEstoque": False,
             "prod": {
-                "CFOP": item['prod']['CFOP'],
-                "NCM": item['prod']['NCM'],
-                "cEAN": item['prod']['cEAN'],
-                "cProd": item['prod']['cProd'],
-                "cUn": item['prod']['uCom'],
-                "nQuant": float(item['prod']['qCom']),
+                "CFOP": item.CFOP,
+                "NCM": item.NCM,
+                "cEAN": item.cEAN,
+                "cProd": item.cProd,
+                "cUn": item.uCom,
+                "nQuant": float(item.qCom),
                 "vAcresc": 0,
                 "vDesc": 0,
-                "vItem": float(item['prod']['vProd']),
-                "vProd": float(item['prod']['vProd']),
-                "vUnit": float(item['prod']['vUnCom']),
-                "xProd": item['prod']['xProd']
+                "vItem": v_prod,
+                "vProd": v_prod,
+                "vUnit": float(item.vUnCom),
+                "xProd": item.xProd
             },
             "prodIdent": {
-                "emiProduto": item['prod']['cProd'],
+                "emiProduto": item.cProd,
                 "idLocalEstoque": "",  # You'll need to provide this information
-                "idProduto": 13  # You'll need to provide this information
+                "idProduto": OMIE_ID_PRODUTO_PADRAO  # trocado pelo catálogo em apply_store_fields
             },
-            "seqItem": int(item['nItem'])
+            "seqItem": int(item.nItem)
         }
         omie_json["NFe"]["det"].append(det_item)    
     return omie_json
 
-def build_omie_json(store_name, invoice):
-    omie_json = convert_xml_to_omie_json(invoice["xml"])
-    
-    # Adiciona informações específicas da loja
-    omie_json["caixa"]["seqCaixa"] = get_next_sequencial('seqCaixa')
-    omie_json["caixa"]["seqCupom"] = get_next_sequencial('seqCupom')
+# Cache dos payloads convertidos, pelo hash do XML cru
+CACHE_CONVERSAO_MB = float(os.getenv('CACHE_CONVERSAO_MB', '64'))  # 0 desliga o cache
+CACHE_CONVERSAO_DISCO = os.getenv('CACHE_CONVERSAO_DISCO', '0') == '1'
+CACHE_CONVERSAO_RETENCAO_DIAS = int(os.getenv('CACHE_CONVERSAO_RETENCAO_DIAS', '7'))
+
+class ConversionCache:
+    """Payloads do Omie já convertidos, endereçados pelo SHA-1 do XML da ZIG.
+
+    Guarda só a parte do payload que não depende da loja (a saída de
+    convert_xml_to_omie_json), serializada em JSON: cada get() devolve uma cópia
+    nova, que apply_store_fields pode alterar à vontade. Em memória o descarte é
+    LRU por tamanho; com `disk`, as entradas também ficam na tabela
+    cache_conversao e sobrevivem entre execuções.
+    """
+
+    def __init__(self, max_bytes, disk=False, path=None):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.disk_hits = self.misses = 0
+        self.conn = connect_db(path) if disk else None
+        if self.conn is not None:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_conversao (
+                    digest TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    usado REAL NOT NULL
+                )""")
+
+    @staticmethod
+    def key(xml_data):
+        return hashlib.sha1(xml_data.encode()).hexdigest()
+
+    def get(self, digest):
+        with self.lock:
+            data = self.entries.get(digest)
+            if data is not None:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+                return json.loads(data)
+            if self.conn is not None:
+                row = self.conn.execute('SELECT payload FROM cache_conversao WHERE digest = ?', (digest,)).fetchone()
+                if row:
+                    self.conn.execute('UPDATE cache_conversao SET usado = ? WHERE digest = ?', (time.time(), digest))
+                    self.disk_hits += 1
+                    self._remember(digest, row[0])
+                    return json.loads(row[0])
+            self.misses += 1
+            return None
+
+    def put(self, digest, omie_json):
+        data = json.dumps(omie_json, ensure_ascii=False)
+        with self.lock:
+            self._remember(digest, data)
+            if self.conn is not None:
+                self.conn.execute('INSERT OR REPLACE INTO cache_conversao (digest, payload, usado) VALUES (?, ?, ?)',
+                                  (digest, data, time.time()))
+
+    def _remember(self, digest, data):
+        if len(data) > self.max_bytes:
+            return
+        previous = self.entries.pop(digest, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[digest] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def compact(self, retention_days=CACHE_CONVERSAO_RETENCAO_DIAS):
+        if self.conn is None:
+            return 0
+        cutoff = time.time() - retention_days * 86400
+        with self.lock:
+            return self.conn.execute('DELETE FROM cache_conversao WHERE usado < ?', (cutoff,)).rowcount
+
+    def log_stats(self):
+        with self.lock:
+            hits, disk_hits, misses = self.hits, self.disk_hits, self.misses
+            entries, size = len(self.entries), self.size
+        if hits or disk_hits or misses:
+            logging.info(f"Cache de conversão: {hits} acertos em memória, {disk_hits} em disco, {misses} conversões; "
+                         f"{entries} payloads ({size / 1024 / 1024:.1f} MB) em memória.")
+
+_conversion_cache = None
+_conversion_cache_lock = threading.Lock()
+
+def get_conversion_cache():
+    global _conversion_cache
+    if CACHE_CONVERSAO_MB <= 0:
+        return None
+    with _conversion_cache_lock:
+        if _conversion_cache is None:
+            _conversion_cache = ConversionCache(int(CACHE_CONVERSAO_MB * 1024 * 1024), CACHE_CONVERSAO_DISCO)
+        return _conversion_cache
+
+def convert_xml_timed(xml_data):
+    """Converte a nota e devolve (payload, segundos na leitura do XML, segundos na montagem do payload).
+
+    Roda também nos processos do pool de conversão; os tempos voltam junto
+    com o resultado e são registrados pela thread da loja.
+    """
+    inicio = time.perf_counter()
+    with profile_stage('leitura_xml'):
+        nfe = parse_nfe_record(xml_data)
+    meio = time.perf_counter()
+    with profile_stage('conversao'):
+        omie_json = convert_xml_to_omie_json(xml_data, nfe)
+    return omie_json, meio - inicio, time.perf_counter() - meio
+
+def record_conversion_times(store_name, parse_seconds, build_seconds):
+    metrics.observe('integracao_etapa_segundos', parse_seconds, etapa='leitura_xml', loja=store_name)
+    metrics.observe('integracao_etapa_segundos', build_seconds, etapa='conversao', loja=store_name)
+
+def convert_xml_cached(xml_data, store_name=None):
+    """convert_xml_to_omie_json passando pelo cache de conversão."""
+    cache = get_conversion_cache()
+    digest = cache.key(xml_data) if cache is not None else None
+    omie_json = cache.get(digest) if cache is not None else None
+    if omie_json is None:
+        omie_json, parse_seconds, build_seconds = convert_xml_timed(xml_data)
+        record_conversion_times(store_name, parse_seconds, build_seconds)
+        if cache is not None:
+            cache.put(digest, omie_json)
+    return omie_json
+
+def apply_store_fields(store_name, omie_json, invoice, sequencial=True):
+    # Adiciona informações específicas da loja; sequencial=False (dry-run) não reserva seqCaixa/seqCupom
+    if sequencial:
+        with observe_stage('sequencial', store_name):
+            omie_json["caixa"]["seqCaixa"] = get_next_sequencial('seqCaixa')
+            omie_json["caixa"]["seqCupom"] = get_next_sequencial('seqCupom')
     
-    # Define ID do cliente específico para cada loja
-    if store_name == 'otro':
-        omie_json["cupomIdent"]["idCliente"] = '675944858'
-        omie_json["formasPag"][0]["pagIdent"]["idConta"] = 3569457062
-    elif store_name == 'tratto':
-        omie_json["cupomIdent"]["idCliente"] = '675944859'  # Ajuste este valor conforme necessário
-        omie_json["formasPag"][0]["pagIdent"]["idConta"] = 7502625278
+    # Cliente, conta e emissor vêm do cadastro da loja
+    store_config = config.stores.get(store_name)
+    if store_config is not None:
+        if store_config.id_cliente is not None:
+            omie_json["cupomIdent"]["idCliente"] = store_config.id_cliente
+        if store_config.id_conta is not None:
+            omie_json["formasPag"][0]["pagIdent"]["idConta"] = store_config.id_conta
+        omie_json["emissor"]["emiId"] = store_config.emi_id
+        resolve_products(store_config, omie_json)
 
     omie_json["emissor"]["emiSerial"] = invoice.get("emiSerial", 1)
     
     return omie_json
     #omie_json["nfce"]["nfceProt"] = nfe_data['nProt']
-    
-    return omie_json
 def create_json_from_omie_json(omie_json, filename=None):
     if filename is None:
         filename = f"omie_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
@@ -308,314 +2248,1816 @@ def create_json_from_omie_json(omie_json, filename=None):
         json.dump(json_data, f, ensure_ascii=False, indent=4)
     
     return filename
-def process_omie_invoice(store_config, omie_json):
-    md5_value = omie_json["nfce"]["nfceMd5"]
-    file_name = "processed_nfce_md5.txt"
 
-    # Carregar valores existentes do arquivo
+# Exportação em lote (relatórios por dia/mês), com memória constante
+EXPORT_NOTAS_HEADERS = ["Chave NF-e", "Data Emissão", "Hora Emissão", "Número NF", "Série", "Ambiente",
+                        "Tipo Emissão", "Tipo Pagamento", "Valor Total", "Desconto", "seqCaixa", "seqCupom"]
+EXPORT_ITENS_HEADERS = ["Chave NF-e", "Sequência", "Código", "Descrição", "NCM", "CFOP", "Unidade",
+                        "Quantidade", "Valor Unitário", "Valor Total"]
+
+def _to_number(value):
     try:
-        with open(file_name, "r") as f:
-            processed_md5 = set(f.read().splitlines())
-    except FileNotFoundError:
-        processed_md5 = set()
+        return float(value)
+    except (TypeError, ValueError):
+        return value
 
-    # Verificar se o valor já foi processado
-    if md5_value in processed_md5:
-        logging.info(f"[{store_config.name}] NF-e já processada (MD5: {md5_value}). Pulando...")
-        print(f"[{store_config.name}] NF-e já processada (MD5: {md5_value}). Pulando...")
-        return
-    time.sleep(180)
-    # Fazer a requisição
-    url = "https://app.omie.com.br/api/v1/produtos/cupomfiscalincluir/"
+def _omie_json_rows(omie_json):
+    """Linha da nota e linhas dos itens de um payload do Omie."""
+    nfe_data = omie_json["NFe"]
+    pagamento = omie_json["formasPag"][0]["pagIdent"]["cTipoPag"] if omie_json.get("formasPag") else None
+    nota = [
+        nfe_data["chNFe"],
+        nfe_data["dEmi"],
+        nfe_data["hEmi"],
+        nfe_data["nNF"],
+        nfe_data["serie"],
+        "Produção" if nfe_data["tpAmb"] == "P" else "Homologação",
+        nfe_data["tpEmis"],
+        pagamento,
+        _to_number(nfe_data["total"]["vCF"]),
+        _to_number(nfe_data["total"]["vDesc"]),
+        omie_json["caixa"]["seqCaixa"],
+        omie_json["caixa"]["seqCupom"],
+    ]
+    itens = [
+        [
+            nfe_data["chNFe"],
+            item["seqItem"],
+            item["prod"]["cProd"],
+            item["prod"]["xProd"],
+            item["prod"]["NCM"],
+            item["prod"]["CFOP"],
+            item["prod"]["cUn"],
+            item["prod"]["nQuant"],
+            item["prod"]["vUnit"],
+            item["prod"]["vProd"],
+        ]
+        for item in nfe_data["det"]
+    ]
+    return nota, itens
+
+class _SpooledSheet:
+    """Guarda as linhas de uma planilha em arquivo temporário e calcula a largura
+    das colunas à medida que as linhas chegam."""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.widths = [len(str(h)) for h in headers]
+        self.file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.rows = 0
+
+    def append(self, row):
+        for i, value in enumerate(row):
+            length = len(str(value)) if value is not None else 0
+            if length > self.widths[i]:
+                self.widths[i] = length
+        self.file.write(json.dumps(row, ensure_ascii=False))
+        self.file.write("\n")
+        self.rows += 1
+
+    def write_to(self, ws):
+        for i, width in enumerate(self.widths, 1):
+            ws.column_dimensions[get_column_letter(i)].width = (width + 2) * 1.2
+        header_cells = []
+        for header in self.headers:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.font = Font(bold=True)
+            cell.alignment = Alignment(horizontal='center')
+            header_cells.append(cell)
+        ws.append(header_cells)
+        self.file.seek(0)
+        for line in self.file:
+            ws.append(json.loads(line))
+        self.file.close()
+
+def export_omie_xlsx(omie_jsons, filename=None):
+    """Gera um relatório XLSX (abas Notas e Itens) a partir de um iterável de payloads.
+
+    As linhas passam por arquivos temporários para que as larguras das colunas
+    sejam conhecidas antes da escrita em modo write-only; a memória usada não
+    depende da quantidade de notas.
+    """
+    if filename is None:
+        filename = f"omie_relatorio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+    notas = _SpooledSheet(EXPORT_NOTAS_HEADERS)
+    itens = _SpooledSheet(EXPORT_ITENS_HEADERS)
+    for omie_json in omie_jsons:
+        nota, linhas = _omie_json_rows(omie_json)
+        notas.append(nota)
+        for linha in linhas:
+            itens.append(linha)
+
+    wb = openpyxl.Workbook(write_only=True)
+    notas.write_to(wb.create_sheet("Notas"))
+    itens.write_to(wb.create_sheet("Itens"))
+    wb.save(filename)
+    logging.info(f"Relatório {filename}: {notas.rows} notas, {itens.rows} itens.")
+    return filename
+
+def export_omie_ndjson(omie_jsons, filename=None):
+    """Grava um payload por linha (NDJSON); compacta com gzip se o nome terminar em .gz."""
+    if filename is None:
+        filename = f"omie_relatorio_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+    opener = gzip.open if filename.endswith('.gz') else open
+    count = 0
+    with opener(filename, 'wt', encoding='utf-8') as f:
+        for omie_json in omie_jsons:
+            f.write(json.dumps(omie_json, ensure_ascii=False, separators=(',', ':')))
+            f.write("\n")
+            count += 1
+    logging.info(f"Relatório {filename}: {count} notas.")
+    return filename
+
+def iter_omie_json_files(paths):
+    """Lê payloads de arquivos JSON (um por nota) ou NDJSON (.ndjson/.ndjson.gz), um de cada vez."""
+    for path in paths:
+        if path.endswith(('.ndjson', '.ndjson.gz', '.jsonl')):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                yield json.load(f)
+
+def post_omie_nfce(store_config, param, deadline=None):
+    """Chama IncluirNfce com as notas de `param`; retorna (response, dados da resposta)."""
+    return call_omie(store_config, OMIE_API_URL, "IncluirNfce", param, 'omie_envio', deadline)
+
+def call_omie(store_config, url, call, param, stage, deadline=None):
+    """Chama um método da API do Omie respeitando o limite de consumo do app_key.
+
+    Retorna (response, dados da resposta). Bloqueios por consumo excessivo são
+    aguardados e repetidos até OMIE_MAX_TENTATIVAS vezes.
+    """
     headers = {"Content-Type": "application/json"}
     body = {
-        "call": "IncluirNfce",
+        "call": call,
         "app_key": store_config.omie_app_key,
         "app_secret": store_config.omie_app_secret,
-        "param": [omie_json]
+        "param": param
     }
+    limiter = get_rate_limiter(store_config.omie_app_key)
+    semaphore = get_app_key_semaphore(store_config.omie_app_key)
+    for tentativa in range(1, OMIE_MAX_TENTATIVAS + 1):
+        limiter.acquire(deadline)
+        with semaphore, observe_stage(stage, store_config.name):
+            # O Omie responde faults de negócio com status 500; só 502/503/504 são repetidos
+            response = http_request("POST", url, f"omie.{call}", retry_status=(502, 503, 504),
+                                    deadline=deadline, headers=headers, json=body)
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = {}
+
+        wait = omie_throttle_wait(response, response_data)
+        if wait is None:
+            return response, response_data
+        limiter.on_throttle(wait)
+        metrics.inc('integracao_omie_limites_total', loja=store_config.name)
+        logging.warning(f"[{store_config.name}] Omie limitou o consumo (tentativa {tentativa}/{OMIE_MAX_TENTATIVAS}). Nova taxa: {limiter.rate:.2f} req/s")
+        print(f"[{store_config.name}] Omie limitou o consumo (tentativa {tentativa}/{OMIE_MAX_TENTATIVAS}). Aguardando...")
+    raise Exception(f"Limite de consumo do Omie persistiu após {OMIE_MAX_TENTATIVAS} tentativas")
+
+# Catálogo de produtos do Omie por app_key: idProduto de cada item pelo cProd/cEAN
+OMIE_PRODUTOS_URL = os.getenv('OMIE_PRODUTOS_URL', "https://app.omie.com.br/api/v1/geral/produtos/")
+OMIE_ID_PRODUTO_PADRAO = int(os.getenv('OMIE_ID_PRODUTO_PADRAO', '13'))  # itens sem produto no catálogo
+CATALOGO_PRODUTOS = os.getenv('CATALOGO_PRODUTOS', '1') == '1'
+CATALOGO_TTL = int(os.getenv('CATALOGO_TTL', '3600'))  # segundos até a sincronização incremental
+CATALOGO_COMPLETO_HORAS = float(os.getenv('CATALOGO_COMPLETO_HORAS', '24'))  # recarga completa (remove excluídos)
+CATALOGO_AUSENTE_TTL = int(os.getenv('CATALOGO_AUSENTE_TTL', '21600'))  # segundos até reconsultar um código ausente
+CATALOGO_PAGINA = 500  # registros por página do ListarProdutos
+CATALOGO_LOTE = 50  # códigos por consulta de itens ausentes
+CATALOGO_TIMEOUT = float(os.getenv('CATALOGO_TIMEOUT', '300'))  # segundos por refresh de um app_key (job e comando)
+CATALOGO_TIMEOUT_LOJA = float(os.getenv('CATALOGO_TIMEOUT_LOJA', '15'))  # segundos do refresh no início da execução da loja
+
+def _valid_ean(ean):
+    return bool(ean) and ean != 'SEM GTIN'
+
+class ProductCatalog:
+    """Produtos do Omie de um app_key, guardados no banco e indexados em memória por código e EAN.
+
+    resolve() só consulta a memória: roda na conversão de cada nota e nunca
+    chama o Omie. A rede fica com refresh(), chamado no início da execução de
+    cada loja e pelo job do catálogo: sincroniza pelo ListarProdutos
+    (por inteiro na primeira vez e a cada CATALOGO_COMPLETO_HORAS, só os
+    alterados depois de CATALOGO_TTL) e consulta em lote (até CATALOGO_LOTE
+    por chamada) os códigos que resolve() não achou. Códigos que o Omie não
+    conhece não são consultados de novo por CATALOGO_AUSENTE_TTL.
+    """
+
+    def __init__(self, store_config, path=None):
+        self.store_config = store_config  # credenciais usadas nas chamadas ao Omie
+        self.app_key = store_config.omie_app_key
+        self.conn = connect_db(path)
+        self.lock = threading.Lock()  # índice em memória e conexão; nunca preso durante chamadas ao Omie
+        self.sync_lock = threading.Lock()  # um refresh() por vez
+        self.by_code = {}
+        self.by_ean = {}
+        self.missing = {}  # código → momento da consulta sem resultado
+        self.wanted = set()  # códigos sem produto vistos nas notas, para o próximo refresh()
+        self.loaded = False
+        self.next_sync = 0.0
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS catalogo_produtos (
+                app_key TEXT NOT NULL,
+                id_produto INTEGER NOT NULL,
+                codigo TEXT,
+                integracao TEXT,
+                ean TEXT,
+                atualizado REAL NOT NULL,
+                PRIMARY KEY (app_key, id_produto)
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS catalogo_ausentes (
+                app_key TEXT NOT NULL,
+                codigo TEXT NOT NULL,
+                consultado REAL NOT NULL,
+                PRIMARY KEY (app_key, codigo)
+            )""")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT)')
+
+    def _meta(self, name):
+        row = self.conn.execute('SELECT valor FROM meta WHERE chave = ?', (f"{name}:{self.app_key}",)).fetchone()
+        return float(row[0]) if row else None
+
+    def _set_meta(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (chave, valor) VALUES (?, ?)', (f"{name}:{self.app_key}", str(value)))
+
+    def _index(self, id_produto, codigo, integracao, ean):
+        for code in (codigo, integracao):
+            if code:
+                self.by_code[code] = id_produto
+        if _valid_ean(ean):
+            self.by_ean[ean] = id_produto
+
+    def load(self):
+        """(Re)carrega o índice do banco; chamar com self.lock."""
+        rows = self.conn.execute(
+            'SELECT id_produto, codigo, integracao, ean FROM catalogo_produtos WHERE app_key = ?', (self.app_key,)
+        ).fetchall()
+        self.by_code, self.by_ean = {}, {}
+        for row in rows:
+            self._index(*row)
+        cutoff = time.time() - CATALOGO_AUSENTE_TTL
+        self.missing = dict(self.conn.execute(
+            'SELECT codigo, consultado FROM catalogo_ausentes WHERE app_key = ? AND consultado >= ?',
+            (self.app_key, cutoff)).fetchall())
+        sincronizado = self._meta('catalogo_incremental')
+        self.next_sync = sincronizado + CATALOGO_TTL if sincronizado else 0.0
+        self.loaded = True
+
+    def _pages(self, param, deadline=None):
+        """Gera a lista de produtos de cada página do ListarProdutos com os filtros de `param`."""
+        pagina, total = 1, 1
+        while pagina <= total:
+            if deadline is not None:
+                deadline.check()
+            response, data = call_omie(self.store_config, OMIE_PRODUTOS_URL, "ListarProdutos",
+                                       [dict(param, pagina=pagina)], 'omie_catalogo', deadline)
+            if "faultcode" in data:
+                if "Não existem registros" in data.get("faultstring", ""):
+                    return
+                raise Exception(f"Erro ao listar produtos: {data['faultstring']}")
+            if response.status_code != 200:
+                raise Exception(f"Unexpected status: {response.status_code}")
+            total = int(data.get("total_de_paginas") or 1)
+            yield data.get("produto_servico_cadastro") or []
+            pagina += 1
+
+    def _save(self, produtos):
+        """Grava e indexa uma página de produtos; inativos saem do catálogo. Retorna os IDs recebidos."""
+        now = time.time()
+        ids = set()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for produto in produtos:
+                    id_produto = produto.get("codigo_produto")
+                    if not id_produto:
+                        continue
+                    ids.add(id_produto)
+                    if produto.get("inativo") == "S":
+                        self.conn.execute('DELETE FROM catalogo_produtos WHERE app_key = ? AND id_produto = ?',
+                                          (self.app_key, id_produto))
+                        continue
+                    codigo, integracao, ean = produto.get("codigo"), produto.get("codigo_produto_integracao"), produto.get("ean")
+                    self.conn.execute(
+                        """INSERT OR REPLACE INTO catalogo_produtos (app_key, id_produto, codigo, integracao, ean, atualizado)
+                           VALUES (?, ?, ?, ?, ?, ?)""", (self.app_key, id_produto, codigo, integracao, ean, now))
+                    self._index(id_produto, codigo, integracao, ean)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return ids
+
+    def sync(self, full=None, deadline=None):
+        """Sincroniza com o Omie: completa (`full`) ou só os produtos alterados desde a última vez."""
+        inicio = time.time()
+        with self.lock:
+            completo = self._meta('catalogo_completo')
+            incremental = self._meta('catalogo_incremental')
+        if full is None:
+            full = completo is None or incremental is None or inicio - completo >= CATALOGO_COMPLETO_HORAS * 3600
+        param = {"registros_por_pagina": CATALOGO_PAGINA, "apenas_importado_api": "N", "filtrar_apenas_omiepdv": "N"}
+        if not full:
+            # O filtro do Omie é por dia: a margem de um dia cobre alterações perto da meia-noite
+            param.update(filtrar_apenas_alteracao="S",
+                         filtrar_por_data_de=(datetime.fromtimestamp(incremental) - timedelta(days=1)).strftime('%d/%m/%Y'))
+        ids = set()
+        for produtos in self._pages(param, deadline):
+            ids |= self._save(produtos)
+        with self.lock:
+            if full:
+                # Produtos que sumiram do Omie saem do catálogo local
+                self.conn.execute('BEGIN IMMEDIATE')
+                existentes = self.conn.execute(
+                    'SELECT id_produto FROM catalogo_produtos WHERE app_key = ?', (self.app_key,)).fetchall()
+                removidos = [(self.app_key, id_produto) for id_produto, in existentes if id_produto not in ids]
+                self.conn.executemany('DELETE FROM catalogo_produtos WHERE app_key = ? AND id_produto = ?', removidos)
+                self.conn.execute('COMMIT')
+                self.load()
+                self._set_meta('catalogo_completo', inicio)
+            self._set_meta('catalogo_incremental', inicio)
+            self.next_sync = inicio + CATALOGO_TTL
+        logging.info(f"[catálogo {self.app_key}] Sincronização {'completa' if full else 'incremental'}: "
+                     f"{len(ids)} produtos recebidos, {len(self.by_code)} códigos no índice.")
+        return len(ids)
+
+    def _lookup(self, codigo, ean):
+        id_produto = self.by_code.get(codigo)
+        if id_produto is None and _valid_ean(ean):
+            id_produto = self.by_ean.get(ean)
+        return id_produto
 
+    def _resolve_missing(self, codigos, deadline=None):
+        # Uma chamada para cada CATALOGO_LOTE códigos; os que continuam sem produto ficam marcados
+        for inicio in range(0, len(codigos), CATALOGO_LOTE):
+            lote = codigos[inicio:inicio + CATALOGO_LOTE]
+            param = {"registros_por_pagina": CATALOGO_LOTE, "apenas_importado_api": "N",
+                     "filtrar_apenas_omiepdv": "N", "produtosPorCodigo": [{"codigo": codigo} for codigo in lote]}
+            for produtos in self._pages(param, deadline):
+                self._save(produtos)
+            now = time.time()
+            with self.lock:
+                ausentes = [codigo for codigo in lote if codigo not in self.by_code]
+                for codigo in ausentes:
+                    self.missing[codigo] = now
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO catalogo_ausentes (app_key, codigo, consultado) VALUES (?, ?, ?)',
+                    [(self.app_key, codigo, now) for codigo in ausentes])
+
+    def refresh(self, deadline=None, full=None, force=False, wait=True):
+        """Sincroniza se venceu o prazo (ou com `force`/`full`) e consulta os códigos pendentes; retorna os produtos recebidos.
+
+        Erros, inclusive o fim do `deadline`, são registrados no log: o
+        catálogo guardado continua valendo até o próximo refresh(). Sem
+        `wait`, retorna na hora se outro refresh() já está em andamento.
+        """
+        if not self.sync_lock.acquire(blocking=wait):
+            return 0
+        try:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+                due = force or full or time.time() >= self.next_sync
+            recebidos = 0
+            try:
+                if due:
+                    recebidos = self.sync(full, deadline)
+            except Exception as e:
+                with self.lock:
+                    self.next_sync = time.time() + CATALOGO_TTL
+                logging.error(f"[catálogo {self.app_key}] Erro na sincronização: {e}")
+            with self.lock:
+                cutoff = time.time() - CATALOGO_AUSENTE_TTL
+                faltando = sorted(codigo for codigo in self.wanted
+                                  if codigo not in self.by_code and self.missing.get(codigo, 0) < cutoff)
+                self.wanted.clear()
+            try:
+                if faltando:
+                    self._resolve_missing(faltando, deadline)
+            except Exception as e:
+                with self.lock:
+                    self.wanted.update(faltando)  # tenta de novo no próximo refresh()
+                logging.error(f"[catálogo {self.app_key}] Erro ao consultar produtos: {e}")
+            return recebidos
+        finally:
+            self.sync_lock.release()
+
+    def resolve(self, items):
+        """Lista com o idProduto de cada (cProd, cEAN) de `items`, ou None quando o produto não está no catálogo.
+
+        Só consulta a memória; os códigos não encontrados ficam para o próximo refresh().
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            found = [self._lookup(codigo, ean) for codigo, ean in items]
+            cutoff = time.time() - CATALOGO_AUSENTE_TTL
+            self.wanted.update(codigo for (codigo, _), id_produto in zip(items, found)
+                               if id_produto is None and codigo and self.missing.get(codigo, 0) < cutoff)
+            return found
+
+_product_catalogs = {}
+_product_catalogs_lock = threading.Lock()
+
+def get_product_catalog(store_config):
+    if not CATALOGO_PRODUTOS:
+        return None
+    with _product_catalogs_lock:
+        catalog = _product_catalogs.get(store_config.omie_app_key)
+        if catalog is None:
+            catalog = _product_catalogs[store_config.omie_app_key] = ProductCatalog(store_config)
+        catalog.store_config = store_config  # credenciais atualizadas pelo cadastro
+        return catalog
+
+def refresh_store_catalog(store_config):
+    """refresh() do catálogo da loja no início da execução, limitado a CATALOGO_TIMEOUT_LOJA.
+
+    Se outra loja do mesmo app_key já está atualizando o catálogo, ou se o
+    Omie falhar ou demorar, a loja segue com o catálogo guardado.
+    """
     try:
-        response = requests.post(url, headers=headers, json=body)
-        response_data = response.json()
+        catalog = get_product_catalog(store_config)
+        if catalog is not None:
+            with timeout(CATALOGO_TIMEOUT_LOJA) as deadline:
+                catalog.refresh(deadline, wait=False)
+    except Exception as e:
+        logging.error(f"[{store_config.name}] Erro ao atualizar o catálogo de produtos: {e}")
 
-        if "faultcode" in response_data:
-            if response_data["faultcode"] == "SOAP-ENV:Client-3333":
-                logging.info(f"[{store_config.name}] Cupom duplicado: {response_data['faultstring']}. Continuando...")
-                print(f"[{store_config.name}] Cupom duplicado: {response_data['faultstring']}. Continuando...")
-                return
-            raise Exception(f"Erro ao processar nota: {response_data['faultstring']}")
+def refresh_catalogs(store_names=None, full=None, force=False):
+    """refresh() do catálogo de cada app_key das lojas, cada um limitado a CATALOGO_TIMEOUT.
 
-        if response.status_code != 200:
-            logging.error(f"Unexpected status: {response.status_code}")
-            raise Exception(f"Erro ao enviar nota: {response.text}")
+    Usado pelo job do catálogo e pelo comando `catalogo`, fora das
+    execuções das lojas.
+    """
+    atualizados = {}
+    for store_name in sorted(config.stores) if store_names is None else store_names:
+        store_config = config.stores.get(store_name)
+        if store_config is None or store_config.omie_app_key in atualizados:
+            continue
+        catalog = get_product_catalog(store_config)
+        if catalog is None:
+            return atualizados
+        with timeout(CATALOGO_TIMEOUT) as deadline:
+            catalog.refresh(deadline, full=full, force=force)
+        atualizados[store_config.omie_app_key] = catalog
+    return atualizados
+
+def resolve_products(store_config, omie_json):
+    """Preenche o prodIdent de cada item pelo catálogo do app_key (OMIE_ID_PRODUTO_PADRAO se não achar)."""
+    dets = omie_json["NFe"]["det"]
+    catalog = get_product_catalog(store_config)
+    if catalog is not None and dets:
+        with observe_stage('catalogo', store_config.name):
+            ids = catalog.resolve([(det["prod"]["cProd"], det["prod"]["cEAN"]) for det in dets])
+    else:
+        ids = [None] * len(dets)
+    resolvidos = 0
+    for det, id_produto in zip(dets, ids):
+        ident = det["prodIdent"]
+        if id_produto is not None:
+            ident["idProduto"] = id_produto
+            resolvidos += 1
+        if store_config.id_local_estoque is not None:
+            ident["idLocalEstoque"] = store_config.id_local_estoque
+    if resolvidos:
+        metrics.inc('integracao_catalogo_itens_total', resolvidos, loja=store_config.name, origem='catalogo')
+    if len(dets) > resolvidos:
+        metrics.inc('integracao_catalogo_itens_total', len(dets) - resolvidos, loja=store_config.name, origem='padrao')
 
-        # Salvar MD5 no arquivo após sucesso
-        with open(file_name, "a") as f:
-            f.write(md5_value + "\n")
+def process_omie_invoice(store_config, omie_json, deadline=None, force=False):
+    md5_value = omie_json["nfce"]["nfceMd5"]
+    chave = omie_json["NFe"]["chNFe"]
+    dedup = get_dedup_store()
 
-        logging.info(f"[{store_config.name}] Nota fiscal enviada com sucesso: {response.text}")
-        print(f"[{store_config.name}] Nota fiscal enviada com sucesso: {response.text}")
+    # Verificar se o valor já foi processado (force reenvia mesmo assim)
+    anterior = dedup.seen(md5_value, chave)
+    if not force and anterior:
+        logging.info(f"[{store_config.name}] NF-e já processada (MD5: {md5_value}). Pulando...")
+        print(f"[{store_config.name}] NF-e já processada (MD5: {md5_value}). Pulando...")
+        return "ignorada"
 
+    # No reenvio forçado de nota já enviada, o status registrado não volta para pendente/erro
+    if not anterior:
+        dedup.mark(md5_value, "pendente", chave, store_config.name)
+
+    try:
+        response, response_data = post_omie_nfce(store_config, [omie_json], deadline)
+        return record_omie_response(store_config, omie_json, response, response_data, anterior)
+
+    except TimeoutError:
+        # Prazo da execução esgotado: a nota fica pendente para a próxima rodada
+        logging.warning(f"[{store_config.name}] Envio interrompido pelo tempo limite (MD5: {md5_value}).")
+        return "interrompida"
     except Exception as e:
         logging.error(f"[{store_config.name}] Erro ao enviar nota: {str(e)}")
         print(f"[{store_config.name}] Erro ao enviar nota: {str(e)}")
+        if not anterior:
+            dedup.mark(md5_value, "erro", chave, store_config.name)
+        return "erro"
 
-def execute_zig_omie_integration():
-    logging.info("Iniciando integração...")
-    
-    now = datetime.now()
-    last_run = now - timedelta(days=1)
+def record_omie_response(store_config, omie_json, response, response_data, anterior=None):
+    """Registra a resposta do IncluirNfce de uma nota: retorna "enviada" ou "duplicada", ou levanta o erro.
 
+    `anterior` é o status final já registrado (reenvio forçado): um cupom
+    duplicado mantém esse status em vez de trocá-lo por "duplicada".
+    """
+    md5_value = omie_json["nfce"]["nfceMd5"]
+    chave = omie_json["NFe"]["chNFe"]
+    dedup = get_dedup_store()
+
+    if "faultcode" in response_data:
+        if response_data["faultcode"] == "SOAP-ENV:Client-3333":
+            logging.info(f"[{store_config.name}] Cupom duplicado: {response_data['faultstring']}. Continuando...")
+            print(f"[{store_config.name}] Cupom duplicado: {response_data['faultstring']}. Continuando...")
+            if not anterior:
+                dedup.mark(md5_value, "duplicada", chave, store_config.name)
+            return "duplicada"
+        metrics.inc('integracao_omie_faults_total', loja=store_config.name, faultcode=response_data["faultcode"])
+        raise Exception(f"Erro ao processar nota: {response_data['faultstring']}")
+
+    if response.status_code != 200:
+        logging.error(f"Unexpected status: {response.status_code}")
+        raise Exception(f"Erro ao enviar nota: {response.text}")
+
+    get_rate_limiter(store_config.omie_app_key).on_success()
+
+    # Registrar a nota como enviada após sucesso
+    dedup.mark(md5_value, "enviada", chave, store_config.name)
+
+    logging.info(f"[{store_config.name}] Nota fiscal enviada com sucesso: {response.text}")
+    print(f"[{store_config.name}] Nota fiscal enviada com sucesso: {response.text}")
+    return "enviada"
+
+# Envio em lote: várias notas por chamada de IncluirNfce (1 = uma nota por chamada)
+OMIE_LOTE_TAMANHO = int(os.getenv('OMIE_LOTE_TAMANHO', '1'))
+OMIE_LOTE_BYTES = int(os.getenv('OMIE_LOTE_BYTES', str(4 * 1024 * 1024)))
+
+def omie_payload_size(omie_json):
+    # Estimativa barata do tamanho serializado: o XML embutido domina o payload
+    return len(omie_json["nfce"]["nfceXml"]) + 300 * len(omie_json["NFe"]["det"]) + 2048
+
+def process_omie_batch(store_config, omie_jsons, deadline=None):
+    """Envia várias notas em um único IncluirNfce e retorna o status de cada uma, na mesma ordem.
+
+    Uma resposta em lista é associada às notas pela posição. Notas com fault
+    próprio (exceto cupom duplicado), lotes recusados por inteiro e respostas
+    que não dizem o resultado de cada nota são reenviados individualmente; o
+    Omie recusa como duplicado o que já tinha aceitado.
+    """
+    dedup = get_dedup_store()
+    statuses = [None] * len(omie_jsons)
+    pendentes = []
+    for i, omie_json in enumerate(omie_jsons):
+        if dedup.seen(omie_json["nfce"]["nfceMd5"], omie_json["NFe"]["chNFe"]):
+            statuses[i] = "ignorada"
+        else:
+            pendentes.append(i)
+    if len(pendentes) <= 1:
+        for i in pendentes:
+            statuses[i] = process_omie_invoice(store_config, omie_jsons[i], deadline)
+        return statuses
+
+    for i in pendentes:
+        dedup.mark(omie_jsons[i]["nfce"]["nfceMd5"], "pendente", omie_jsons[i]["NFe"]["chNFe"], store_config.name)
     try:
-        with timeout(900):  # Timeout de 4 minutos
-            invoices = fetch_invoices(last_run, now, 1)
-            for invoice in invoices:
-                omie_json = build_omie_json(invoice)
-                process_omie_invoice(omie_json)
+        response, response_data = post_omie_nfce(store_config, [omie_jsons[i] for i in pendentes], deadline)
     except TimeoutError:
-        logging.error("O tempo limite foi atingido.")
+        logging.warning(f"[{store_config.name}] Lote de {len(pendentes)} notas interrompido pelo tempo limite.")
+        for i in pendentes:
+            statuses[i] = "interrompida"
+        return statuses
     except Exception as e:
-        logging.error(f"Erro na integração: {e}")
+        logging.error(f"[{store_config.name}] Erro ao enviar lote de {len(pendentes)} notas: {e}")
+        response, response_data = None, None
 
-    logging.info("Processamento concluído.")
+    if isinstance(response_data, list) and len(response_data) == len(pendentes):
+        item_results = response_data
+    else:
+        if isinstance(response_data, dict) and "faultcode" not in response_data:
+            # Uma só resposta sem fault para o lote inteiro não prova que cada nota entrou
+            logging.warning(f"[{store_config.name}] Resposta do lote sem resultado por nota: {response_data}")
+        item_results = [None] * len(pendentes)
 
-def parse_nfe_xml(xml_data):
-    # Define o namespace
-    ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe', 'ds': 'http://www.w3.org/2000/09/xmldsig#'}
+    limiter = get_rate_limiter(store_config.omie_app_key)
+    individuais = []
+    for i, item in zip(pendentes, item_results):
+        omie_json = omie_jsons[i]
+        md5_value = omie_json["nfce"]["nfceMd5"]
+        chave = omie_json["NFe"]["chNFe"]
+        if not isinstance(item, dict):
+            individuais.append(i)
+        elif item.get("faultcode") == "SOAP-ENV:Client-3333":
+            logging.info(f"[{store_config.name}] Cupom duplicado: {item.get('faultstring')}. Continuando...")
+            dedup.mark(md5_value, "duplicada", chave, store_config.name)
+            statuses[i] = "duplicada"
+        elif "faultcode" in item:
+            metrics.inc('integracao_omie_faults_total', loja=store_config.name, faultcode=item["faultcode"])
+            logging.warning(f"[{store_config.name}] Nota {chave} recusada no lote: {item.get('faultstring')}")
+            individuais.append(i)
+        else:
+            dedup.mark(md5_value, "enviada", chave, store_config.name)
+            statuses[i] = "enviada"
+    if len(individuais) < len(pendentes):
+        limiter.on_success()
+        logging.info(f"[{store_config.name}] Lote enviado: {len(pendentes) - len(individuais)} de {len(pendentes)} notas aceitas.")
+        print(f"[{store_config.name}] Lote enviado: {len(pendentes) - len(individuais)} de {len(pendentes)} notas aceitas.")
 
-    # Função auxiliar para obter o texto de um elemento ou retornar None
-    def get_text_or_none(element, tag, ns):
-        if element is not None:
-            found = element.find(tag, ns)
-            return found.text if found is not None else None
-        return None
+    if individuais:
+        logging.info(f"[{store_config.name}] Reenviando {len(individuais)} notas do lote individualmente.")
+        for i in individuais:
+            statuses[i] = process_omie_invoice(store_config, omie_jsons[i], deadline)
+    return statuses
 
-    # Carrega o XML
-    root = ET.fromstring(xml_data)
+# Numeração de seqCaixa/seqCupom
+LEGACY_SEQUENCIAL_FILE = 'sequenciais.json'
+SEQUENCIAL_LOTE = int(os.getenv('SEQUENCIAL_LOTE', '100'))  # números reservados por transação
+SEQUENCIAL_RETENCAO_DIAS = int(os.getenv('SEQUENCIAL_RETENCAO_DIAS', '7'))
 
-    # Inicializa um dicionário para armazenar os dados
-    nfe_data = {}
+class SequenceAllocator:
+    """Distribui seqCaixa/seqCupom a partir de blocos reservados no SQLite.
 
-    # Encontra o elemento 'infNFe' com o namespace
-    inf_nfe = root.find('.//nfe:infNFe', ns)
-    
-    if inf_nfe is not None:
-        # Atributos de 'infNFe'
-        nfe_data['Id'] = inf_nfe.attrib.get('Id')
-        nfe_data['versao'] = inf_nfe.attrib.get('versao')
-
-        # 'ide' - Identificação da NF-e
-        ide = inf_nfe.find('nfe:ide', ns)
-        pag = inf_nfe.find('nfe:pag', ns)
-        if ide is not None:
-            nfe_data['ide'] = {
-                'cUF': get_text_or_none(ide, 'nfe:cUF', ns),
-                'cNF': get_text_or_none(ide, 'nfe:cNF', ns),
-                'natOp': get_text_or_none(ide, 'nfe:natOp', ns),
-                'mod': get_text_or_none(ide, 'nfe:mod', ns),
-                'serie': get_text_or_none(ide, 'nfe:serie', ns),
-                'nNF': get_text_or_none(ide, 'nfe:nNF', ns),
-                'dhEmi': get_text_or_none(ide, 'nfe:dhEmi', ns),
-                'tpNF': get_text_or_none(ide, 'nfe:tpNF', ns),
-                'idDest': get_text_or_none(ide, 'nfe:idDest', ns),
-                'cMunFG': get_text_or_none(ide, 'nfe:cMunFG', ns),
-                'tpImp': get_text_or_none(ide, 'nfe:tpImp', ns),
-                'tpEmis': get_text_or_none(ide, 'nfe:tpEmis', ns),
-                'cDV': get_text_or_none(ide, 'nfe:cDV', ns),
-                'tpAmb': get_text_or_none(ide, 'nfe:tpAmb', ns),
-                'finNFe': get_text_or_none(ide, 'nfe:finNFe', ns),
-                'indFinal': get_text_or_none(ide, 'nfe:indFinal', ns),
-                'indPres': get_text_or_none(ide, 'nfe:indPres', ns),
-                'indIntermed': get_text_or_none(ide, 'nfe:indIntermed', ns),
-                'procEmi': get_text_or_none(ide, 'nfe:procEmi', ns),
-                'verProc': get_text_or_none(ide, 'nfe:verProc', ns)
-            }
+    Cada reserva é uma única transação (BEGIN IMMEDIATE, fsync) que avança os
+    contadores do dia em N números; depois disso a alocação é feita em memória.
+    Uma queda entre a reserva e o uso apenas deixa lacunas, nunca repetições.
+    """
 
-        # 'emit' - Emitente
-        emit = inf_nfe.find('nfe:emit', ns)
-        if emit is not None:
-            enderEmit = emit.find('nfe:enderEmit', ns)
-            nfe_data['emit'] = {
-                'CNPJ': get_text_or_none(emit, 'nfe:CNPJ', ns),
-                'xNome': get_text_or_none(emit, 'nfe:xNome', ns),
-                'xFant': get_text_or_none(emit, 'nfe:xFant', ns),
-                'IE': get_text_or_none(emit, 'nfe:IE', ns),
-                'CRT': get_text_or_none(emit, 'nfe:CRT', ns),
-                'enderEmit': {
-                    'xLgr': get_text_or_none(enderEmit, 'nfe:xLgr', ns),
-                    'nro': get_text_or_none(enderEmit, 'nfe:nro', ns),
-                    'xBairro': get_text_or_none(enderEmit, 'nfe:xBairro', ns),
-                    'cMun': get_text_or_none(enderEmit, 'nfe:cMun', ns),
-                    'xMun': get_text_or_none(enderEmit, 'nfe:xMun', ns),
-                    'UF': get_text_or_none(enderEmit, 'nfe:UF', ns),
-                    'CEP': get_text_or_none(enderEmit, 'nfe:CEP', ns),
-                    'cPais': get_text_or_none(enderEmit, 'nfe:cPais', ns),
-                    'xPais': get_text_or_none(enderEmit, 'nfe:xPais', ns),
-                    'fone': get_text_or_none(enderEmit, 'nfe:fone', ns)
-                }
-            }
+    TIPOS = ('seqCaixa', 'seqCupom')
 
-        if pag is not None:
-            detPag = pag.find('nfe:detPag', ns)
-            if detPag is not None:
-                tPag_elem = detPag.find('nfe:tPag', ns)
-                # Se não estiver preenchido, assume "99999"
-                tPag_value = tPag_elem.text.strip() if tPag_elem is not None and tPag_elem.text.strip() != '' else "99999"
-                
-                # Mapeamento dos códigos TPag (exemplo, ajuste conforme a especificação)
-                # Os códigos numéricos do XML são mapeados para as opções definidas:
-                tpag_mapping = {
-                    "01": "DIN",    # Dinheiro
-                    "02": "CHQ",    # Cheque
-                    "03": "CRC",    # Cartão de Crédito
-                    "04": "CRD",    # Cartão de Débito
-                    "05": "CRE",    # Crediário
-                    "15": "BOL",    # Boleto (código hipotético)
-                    "16": "PIX",    # Pix (código hipotético)
-                    "99": "99999"   # Outros
-                    # Outros códigos podem ser adicionados aqui se necessário
-                }
-                
-                # Caso o código não esteja mapeado, define como "99999"
-                pagamento = tpag_mapping.get(tPag_value, "99999")
-                
-                # Extrai também o valor do pagamento (se necessário para validações financeiras)
-                vPag_elem = detPag.find('nfe:vPag', ns)
-                valor_pagamento = vPag_elem.text if vPag_elem is not None else None
-                
-                # Armazena no dicionário principal
-                nfe_data['pag'] = {
-                    'tPag': pagamento,
-                    'vPag': valor_pagamento
-                }
-        # 'dest' - Destinatário
-        dest = inf_nfe.find('nfe:dest', ns)
-        if dest is not None:
-            nfe_data['dest'] = {
-                'CPF': get_text_or_none(dest, 'nfe:CPF', ns),
-                'xNome': get_text_or_none(dest, 'nfe:xNome', ns),
-                'indIEDest': get_text_or_none(dest, 'nfe:indIEDest', ns)
-            }
-        
-        # 'det' - Detalhes dos produtos/serviços
-        det_list = []
-        for det in inf_nfe.findall('nfe:det', ns):
-            prod = det.find('nfe:prod', ns)
-            imposto = det.find('nfe:imposto', ns)
-            det_item = {
-                'nItem': det.attrib.get('nItem'),
-                'prod': {
-                    'cProd': get_text_or_none(prod, 'nfe:cProd', ns),
-                    'cEAN': get_text_or_none(prod, 'nfe:cEAN', ns),
-                    'xProd': get_text_or_none(prod, 'nfe:xProd', ns),
-                    'NCM': get_text_or_none(prod, 'nfe:NCM', ns),
-                    'CFOP': get_text_or_none(prod, 'nfe:CFOP', ns),
-                    'uCom': get_text_or_none(prod, 'nfe:uCom', ns),
-                    'qCom': get_text_or_none(prod, 'nfe:qCom', ns),
-                    'vUnCom': get_text_or_none(prod, 'nfe:vUnCom', ns),
-                    'vProd': get_text_or_none(prod, 'nfe:vProd', ns),
-                    'cEANTrib': get_text_or_none(prod, 'nfe:cEANTrib', ns),
-                    'uTrib': get_text_or_none(prod, 'nfe:uTrib', ns),
-                    'qTrib': get_text_or_none(prod, 'nfe:qTrib', ns),
-                    'vUnTrib': get_text_or_none(prod, 'nfe:vUnTrib', ns),
-                    'indTot': get_text_or_none(prod, 'nfe:indTot', ns)
-                },
-                'imposto': {
-                    'vTotTrib': get_text_or_none(imposto, 'nfe:vTotTrib', ns) if imposto is not None else None
-                }
-            }
-            det_list.append(det_item)
-        nfe_data['det'] = det_list
-
-        # 'total' - Totais da NF-e
-        total = inf_nfe.find('nfe:total', ns)
-        if total is not None:
-            icms_tot = total.find('nfe:ICMSTot', ns)
-            if icms_tot is not None:
-                nfe_data['total'] = {
-                    'vBC': get_text_or_none(icms_tot, 'nfe:vBC', ns),
-                    'vICMS': get_text_or_none(icms_tot, 'nfe:vICMS', ns),
-                    'vICMSDeson': get_text_or_none(icms_tot, 'nfe:vICMSDeson', ns),
-                    'vFCP': get_text_or_none(icms_tot, 'nfe:vFCP', ns),
-                    'vBCST': get_text_or_none(icms_tot, 'nfe:vBCST', ns),
-                    'vST': get_text_or_none(icms_tot, 'nfe:vST', ns),
-                    'vFCPST': get_text_or_none(icms_tot, 'nfe:vFCPST', ns),
-                    'vFCPSTRet': get_text_or_none(icms_tot, 'nfe:vFCPSTRet', ns),
-                    'vProd': get_text_or_none(icms_tot, 'nfe:vProd', ns),
-                    'vFrete': get_text_or_none(icms_tot, 'nfe:vFrete', ns),
-                    'vSeg': get_text_or_none(icms_tot, 'nfe:vSeg', ns),
-                    'vDesc': get_text_or_none(icms_tot, 'nfe:vDesc', ns),
-                    'vII': get_text_or_none(icms_tot, 'nfe:vII', ns),
-                    'vIPI': get_text_or_none(icms_tot, 'nfe:vIPI', ns),
-                    'vIPIDevol': get_text_or_none(icms_tot, 'nfe:vIPIDevol', ns),
-                    'vPIS': get_text_or_none(icms_tot, 'nfe:vPIS', ns),
-                    'vCOFINS': get_text_or_none(icms_tot, 'nfe:vCOFINS', ns),
-                    'vOutro': get_text_or_none(icms_tot, 'nfe:vOutro', ns),
-                    'vNF': get_text_or_none(icms_tot, 'nfe:vNF', ns),
-                    'vTotTrib': get_text_or_none(icms_tot, 'nfe:vTotTrib', ns)
-                }
+    def __init__(self, path=None):
+        self.conn = connect_db(path, synchronous='FULL')
+        self.lock = threading.Lock()
+        self.day = None
+        self.blocks = {tipo: [] for tipo in self.TIPOS}
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sequenciais (
+                dia TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                valor INTEGER NOT NULL,
+                PRIMARY KEY (dia, tipo)
+            )""")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT)')
+        self._import_legacy_file()
 
-        # 'infProt' - Protocolo de Autorização
-        prot_nfe = root.find('.//nfe:infProt', ns)
-        if prot_nfe is not None:
-            nfe_data['nProt'] = get_text_or_none(prot_nfe, 'nfe:nProt', ns)
+    def _import_legacy_file(self):
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE chave = 'legado_sequenciais_importado'").fetchone():
+                return
+            try:
+                with open(LEGACY_SEQUENCIAL_FILE, 'r') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                data = {}
+            cutoff = (datetime.now() - timedelta(days=SEQUENCIAL_RETENCAO_DIAS)).strftime('%Y-%m-%d')
+            self.conn.execute('BEGIN IMMEDIATE')
+            for dia, valores in data.items():
+                if dia < cutoff:
+                    continue
+                for tipo in self.TIPOS:
+                    self.conn.execute(
+                        """INSERT INTO sequenciais (dia, tipo, valor) VALUES (?, ?, ?)
+                           ON CONFLICT(dia, tipo) DO UPDATE SET valor = MAX(valor, excluded.valor)""",
+                        (dia, tipo, int(valores.get(tipo, 0))))
+            self.conn.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('legado_sequenciais_importado', '1')")
+            self.conn.execute('COMMIT')
 
-    else:
-        print("Elemento 'infNFe' não encontrado no XML.")
+    def _reserve(self, day, n):
+        cutoff = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=SEQUENCIAL_RETENCAO_DIAS)).strftime('%Y-%m-%d')
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            for tipo in self.TIPOS:
+                row = self.conn.execute('SELECT valor FROM sequenciais WHERE dia = ? AND tipo = ?', (day, tipo)).fetchone()
+                current = row[0] if row else 0
+                self.conn.execute('INSERT OR REPLACE INTO sequenciais (dia, tipo, valor) VALUES (?, ?, ?)', (day, tipo, current + n))
+                self.blocks[tipo].append([current + 1, current + n])
+            # Remove os dias antigos na mesma transação
+            self.conn.execute('DELETE FROM sequenciais WHERE dia < ?', (cutoff,))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _check_day(self):
+        today = datetime.now().strftime('%Y-%m-%d')
+        if today != self.day:
+            self.day = today
+            self.blocks = {tipo: [] for tipo in self.TIPOS}
+        return today
+
+    def reserve(self, n):
+        """Garante N números de cada tipo já reservados, para um lote de notas ser numerado sem
+        transação no meio; só reserva um bloco novo (de ao menos SEQUENCIAL_LOTE) se faltar."""
+        with self.lock:
+            day = self._check_day()
+            if any(sum(last - first + 1 for first, last in self.blocks[tipo]) < n for tipo in self.TIPOS):
+                self._reserve(day, max(n, SEQUENCIAL_LOTE))
+
+    def next(self, tipo):
+        with self.lock:
+            day = self._check_day()
+            if not self.blocks[tipo]:
+                self._reserve(day, SEQUENCIAL_LOTE)
+            block = self.blocks[tipo][0]
+            value = block[0]
+            block[0] += 1
+            if block[0] > block[1]:
+                self.blocks[tipo].pop(0)
+            return value
+
+    def release(self):
+        """Devolve a sobra do último bloco, se nenhum outro processo reservou depois dele."""
+        with self.lock:
+            if self.day is None or not any(self.blocks.values()):
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            for tipo in self.TIPOS:
+                if not self.blocks[tipo]:
+                    continue
+                first, last = self.blocks[tipo][-1]
+                self.conn.execute('UPDATE sequenciais SET valor = ? WHERE dia = ? AND tipo = ? AND valor = ?',
+                                  (first - 1, self.day, tipo, last))
+            self.conn.execute('COMMIT')
+            self.blocks = {tipo: [] for tipo in self.TIPOS}
+
+_sequence_allocator = None
+_sequence_allocator_lock = threading.Lock()
+
+def get_sequence_allocator():
+    global _sequence_allocator
+    with _sequence_allocator_lock:
+        if _sequence_allocator is None:
+            _sequence_allocator = SequenceAllocator()
+        return _sequence_allocator
 
-    # Converte o dicionário para JSON
-    nfe_json = json.dumps(nfe_data, indent=4, ensure_ascii=False)
-    return nfe_json, nfe_data  # Retorna o JSON e o dicionário de dados
-    
 def get_next_sequencial(tipo):
-    filename = 'sequenciais.json'
-    today = datetime.now().strftime('%Y-%m-%d')
-    
+    return get_sequence_allocator().next(tipo)
+
+# Conversão XML -> Omie em processos separados (0 = na própria thread da loja)
+CONVERSAO_PROCESSOS = int(os.getenv('CONVERSAO_PROCESSOS', '0'))
+CONVERSAO_JANELA = int(os.getenv('CONVERSAO_JANELA', str(max(CONVERSAO_PROCESSOS, 1) * 4)))
+
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
+
+def get_conversion_pool():
+    global _conversion_pool
+    if CONVERSAO_PROCESSOS <= 0:
+        return None
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            # 'spawn' evita herdar locks das threads de envio no fork
+            _conversion_pool = ProcessPoolExecutor(
+                max_workers=CONVERSAO_PROCESSOS, mp_context=multiprocessing.get_context('spawn'))
+        return _conversion_pool
+
+def convert_invoices(items, store_name=None):
+    """Converte as notas de `items` (tuplas (página, nota)) gerando (página, nota, resultado).
+
+    O resultado é o payload do Omie ou a exceção da conversão; marcadores de fim
+    de página (nota None) passam adiante com resultado None. A ordem de entrada
+    é preservada e no máximo CONVERSAO_JANELA notas ficam em conversão, então
+    um envio lento segura também o consumo da ZIG.
+    """
+    pool = get_conversion_pool()
+    if pool is None:
+        for page, invoice in items:
+            if invoice is None:
+                yield page, None, None
+                continue
+            try:
+                yield page, invoice, convert_xml_cached(invoice["xml"], store_name)
+            except Exception as e:
+                yield page, invoice, e
+        return
+
+    cache = get_conversion_cache()
+
+    def resolve(page, invoice, future, digest=None):
+        if future is None:
+            return page, invoice, None
+        if not isinstance(future, Future):
+            return page, invoice, future  # acerto do cache
+        try:
+            omie_json, parse_seconds, build_seconds = future.result()
+        except Exception as e:
+            return page, invoice, e
+        record_conversion_times(store_name, parse_seconds, build_seconds)
+        if cache is not None:
+            cache.put(digest, omie_json)
+        return page, invoice, omie_json
+
+    window = deque()
     try:
-        with open(filename, 'r') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
+        for page, invoice in items:
+            future = digest = None
+            if invoice is not None:
+                if cache is not None:
+                    digest = cache.key(invoice["xml"])
+                    future = cache.get(digest)
+                if future is None:
+                    future = pool.submit(convert_xml_timed, invoice["xml"])
+            window.append((page, invoice, future, digest))
+            if len(window) >= CONVERSAO_JANELA:
+                yield resolve(*window.popleft())
+        while window:
+            yield resolve(*window.popleft())
+    finally:
+        for _, _, future, _ in window:
+            if isinstance(future, Future):
+                future.cancel()
+
+def triage_invoice(invoice, not_before, queued, dedup):
+    """Decide, sem converter o XML, se a nota precisa seguir: retorna (descartar, dhEmi para a marca d'água).
+
+    Notas anteriores à janela incremental, já conhecidas ou já na fila
+    persistente (MD5 em `queued`) são descartadas antes da conversão.
+    """
+    xml_data = invoice["xml"]
+    dh_emi = nfce_dh_emi(xml_data)
+    if not_before is not None and dh_emi is not None and dh_emi < not_before:
+        return True, None  # fora da janela: não conta para a marca d'água
+    md5 = nfce_md5(xml_data)
+    if md5 in queued or dedup.seen(md5, nfce_chave(xml_data)):
+        return True, dh_emi
+    return False, dh_emi
+
+def run_store_pipeline(store_config, invoices, checkpoint=None, results=None, deadline=None,
+                       watermark=None, not_before=None, resume=True):
+    """Converte as notas da loja e as envia ao Omie por um pool de envio próprio.
+
+    `invoices` gera tuplas (página, nota). A conversão (na thread da loja ou no
+    pool de processos) alimenta uma fila limitada; as threads de envio consomem
+    a fila. Os números sequenciais são atribuídos na ordem das notas. Retorna a
+    contagem de resultados por status.
+
+    Com `deadline`, o prazo é conferido entre as notas: ao esgotar, nada novo é
+    enviado, a página em andamento não é confirmada no checkpoint e TimeoutError
+    é propagado. Notas emitidas antes de `not_before` são descartadas sem
+    conversão, e o WatermarkTracker `watermark` recebe o dhEmi de cada nota tratada.
+
+    Toda nota convertida passa pela fila persistente (WorkQueue) antes do envio.
+    Com `resume`, as notas que ficaram pendentes de execuções anteriores são
+    enviadas primeiro, antes de qualquer nota nova.
+    """
+    pending = queue.Queue(maxsize=LOJA_FILA_MAXIMA)
+    results = {} if results is None else results
+    dedup = get_dedup_store()
+    work_queue = get_work_queue()
+    resumed_md5s = work_queue.pending_md5s(store_config.name) if resume else []
+    results_lock = threading.Lock()
+    fim = object()
+
+    def count(status, dh_emi=None):
+        with results_lock:
+            results[status] = results.get(status, 0) + 1
+        metrics.inc('integracao_notas_total', loja=store_config.name, status=status)
+        if watermark is not None:
+            watermark.observe(dh_emi, status not in ("erro", "interrompida"))
+
+    def sender():
+        carry = None  # item que não coube no lote anterior
+        while True:
+            item, carry = (carry, None) if carry is not None else (pending.get(), None)
+            if item is fim:
+                return
+            # Junta o que já está na fila até o limite de notas/bytes do lote
+            batch = [item]
+            size = omie_payload_size(item[2])
+            while len(batch) < OMIE_LOTE_TAMANHO:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                item_size = omie_payload_size(item[2]) if item is not fim else 0
+                if item is fim or size + item_size > OMIE_LOTE_BYTES:
+                    carry = item
+                    break
+                batch.append(item)
+                size += item_size
+            metrics.set_gauge('integracao_fila_envio', pending.qsize(), loja=store_config.name)
+
+            if deadline is not None and deadline.expired():
+                for _, dh_emi, _ in batch:
+                    count("interrompida", dh_emi)
+                continue
+            try:
+                if len(batch) == 1:
+                    statuses = [process_omie_invoice(store_config, batch[0][2], deadline)]
+                else:
+                    statuses = process_omie_batch(store_config, [omie_json for _, _, omie_json in batch], deadline)
+            except Exception as e:
+                logging.error(f"[{store_config.name}] Erro ao enviar nota: {e}")
+                statuses = ["erro"] * len(batch)
+            for (page, dh_emi, omie_json), status in zip(batch, statuses):
+                record_sent(page, dh_emi, omie_json, status)
 
-    if today not in data:
-        data[today] = {'seqCaixa': 0, 'seqCupom': 0}
+    def record_sent(page, dh_emi, omie_json, status):
+        # Falha aqui não pode derrubar a thread de envio: a nota fica pendente na
+        # fila persistente (e a página sem confirmação) para a próxima execução
+        try:
+            count(status, dh_emi)
+            work_queue.finish(omie_json["nfce"]["nfceMd5"], status)
+            if checkpoint and page is not None and status != "interrompida":
+                checkpoint.done(page)
+        except Exception as e:
+            logging.error(f"[{store_config.name}] Erro ao registrar o envio da nota {omie_json['NFe']['chNFe']}: {e}")
 
-    data[today][tipo] += 1
-    next_seq = data[today][tipo]
+    senders = [
+        threading.Thread(target=sender, name=f"envio-{store_config.name}-{i}", daemon=True)
+        for i in range(max(store_config.max_envios, 1))
+    ]
+    for t in senders:
+        t.start()
 
-    with open(filename, 'w') as f:
-        json.dump(data, f)
+    queued = set(resumed_md5s)
+    numeradas = 0
+
+    def unseen():
+        for page, invoice in invoices:
+            if invoice is not None:
+                skip, dh_emi = triage_invoice(invoice, not_before, queued, dedup)
+                if skip:
+                    count("ignorada", dh_emi)
+                    continue
+            yield page, invoice
+
+    try:
+        if resumed_md5s:
+            logging.info(f"[{store_config.name}] Retomando {len(resumed_md5s)} notas pendentes da fila de envio.")
+            for dh_emi, omie_json in work_queue.iter_pending(store_config.name, resumed_md5s):
+                if deadline is not None:
+                    deadline.check()
+                pending.put((None, dh_emi, omie_json))
 
-    return next_seq
-def execute_store_integration(store_name):
+        for page, invoice, converted in convert_invoices(unseen(), store_config.name):
+            if deadline is not None:
+                deadline.check()
+            if invoice is None:
+                if checkpoint:
+                    checkpoint.close(page)
+                continue
+            dh_emi = nfce_dh_emi(invoice["xml"])
+            try:
+                if isinstance(converted, Exception):
+                    raise converted
+                if OMIE_LOTE_TAMANHO > 1 and numeradas % OMIE_LOTE_TAMANHO == 0:
+                    # Números do próximo lote reservados de uma vez, antes da primeira nota dele
+                    get_sequence_allocator().reserve(OMIE_LOTE_TAMANHO)
+                omie_json = apply_store_fields(store_config.name, converted, invoice)
+                numeradas += 1
+            except Exception as e:
+                # Segura a marca d'água antes da nota, para ela ser buscada de novo na próxima execução
+                logging.error(f"[{store_config.name}] Erro ao converter nota da página {page}: {e}")
+                count("erro", dh_emi)
+                continue
+            archive_invoice(store_config.name, invoice, omie_json, dh_emi)
+            work_queue.enqueue(store_config.name, omie_json, dh_emi)
+            if checkpoint:
+                checkpoint.add(page)
+            pending.put((page, dh_emi, omie_json))
+            metrics.set_gauge('integracao_fila_envio', pending.qsize(), loja=store_config.name)
+    finally:
+        for _ in senders:
+            pending.put(fim)
+        for t in senders:
+            t.join()
+    if results.get("interrompida"):
+        raise TimeoutError("Operation timed out.")
+    return results
+
+def execute_store_integration(store_name, from_date=None, to_date=None):
+    """Integra as notas novas da loja desde a marca d'água salva.
+
+    Com `from_date`/`to_date` roda em modo backfill: busca o período inteiro
+    informado, sem descartar notas pela marca d'água.
+    """
     store_config = config.stores[store_name]
     logging.info(f"Iniciando integração para loja {store_name}...")
-    
-    now = datetime.now()
-    last_run = now - timedelta(days=1)
+    refresh_store_catalog(store_config)
+
+    tracker = WatermarkTracker()
+    last_run, now, not_before = store_window(store_name, from_date, to_date)
+    results = {}
+    inicio_envio = time.time()
+    completa = False
     try:
-        with timeout(900):  # Timeout de 4 minutos
-            invoices = fetch_invoices(store_config, last_run, now, 1)
-            for invoice in invoices:
-                omie_json = build_omie_json(store_name, invoice)
-                process_omie_invoice(store_config, omie_json)
+        with timeout(INTEGRACAO_TIMEOUT) as deadline, active_run(store_name, deadline):  # Timeout de 15 minutos
+            start_page = load_page_cursor(store_name, last_run, now)
+            if start_page > 1:
+                logging.info(f"[{store_name}] Retomando a partir da página {start_page}.")
+            checkpoint = PageCheckpoint(lambda page: save_page_cursor(store_name, last_run, now, page + 1))
+            invoices = iter_invoices(store_config, last_run, now, start_page, deadline)
+            run_store_pipeline(store_config, invoices, checkpoint, results, deadline, tracker, not_before)
+            clear_page_cursor(store_name)
+            completa = True
 
             logging.info(f"[{store_name}] Remessa de vendas finalizada. Aguardando a próxima remessa em algumas horas.")
             print(f"[{store_name}] Remessa de vendas finalizada. Aguardando a próxima remessa em algumas horas.")
     except TimeoutError:
-        logging.error(f"[{store_name}] O tempo limite foi atingido.")
+        proxima = load_page_cursor(store_name, last_run, now)
+        logging.error(f"[{store_name}] O tempo limite foi atingido. A próxima execução retoma da página {proxima}.")
+        print(f"[{store_name}] O tempo limite foi atingido. A próxima execução retoma da página {proxima}.")
     except Exception as e:
         logging.error(f"[{store_name}] Erro na integração: {e}")
         print(f"[{store_name}] Erro na integração: {e}")
     finally:
-        logging.info(f"[{store_name}] Processamento concluído.")
+        finish_store_run(store_config, results, inicio_envio, tracker, completa)
+    return results
 
-def execute_all_integrations():
-    for store_name in config.stores:
-        execute_store_integration(store_name)
+def store_window(store_name, from_date=None, to_date=None):
+    """Período a buscar na ZIG: retorna (início, fim, descartar notas anteriores a)."""
+    now = to_date or datetime.now()
+    if from_date is not None:
+        logging.info(f"[{store_name}] Backfill de {from_date:%Y-%m-%d} a {now:%Y-%m-%d}.")
+        return from_date, now, None
+    marca = get_watermark_store().load(store_name)
+    if marca is not None:
+        not_before = marca - timedelta(hours=ZIG_SOBREPOSICAO_HORAS)
+        return not_before, now, not_before
+    return now - timedelta(days=ZIG_LOOKBACK_DIAS), now, None
 
-if __name__ == "__main__":
+def finish_store_run(store_config, results, inicio_envio, tracker, completa):
+    # Avança a marca d'água, publica a vazão da execução e salva o limitador. A marca
+    # só avança se a janela inteira foi percorrida: a ZIG não garante as notas em ordem
+    # de dhEmi, e as páginas não buscadas podem ter notas anteriores à nova marca
+    store_name = store_config.name
+    nova_marca = tracker.value() if completa else None
+    if nova_marca is not None:
+        get_watermark_store().advance(store_name, nova_marca)
+    elif not completa:
+        logging.info(f"[{store_name}] Execução incompleta; marca d'água mantida.")
+    enviadas = results.get("enviada", 0)
+    duracao = time.time() - inicio_envio
+    taxa = enviadas / duracao if duracao > 0 else 0
+    metrics.set_gauge('integracao_notas_por_segundo', round(taxa, 3), loja=store_name)
+    metrics.set_gauge('integracao_fila_envio', 0, loja=store_name)
+    limiter = get_rate_limiter(store_config.omie_app_key)
+    logging.info(f"[{store_name}] {enviadas} notas enviadas em {duracao:.1f}s ({taxa:.2f} notas/s, limite atual {limiter.rate:.2f} req/s); "
+                 f"{results.get('ignorada', 0)} já tratadas, {results.get('erro', 0)} com erro.")
+    print(f"[{store_name}] {enviadas} notas enviadas em {duracao:.1f}s ({taxa:.2f} notas/s).")
+    save_rate_limiters()
+    logging.info(f"[{store_name}] Processamento concluído.")
+
+def execute_all_integrations(store_names=None, from_date=None, to_date=None, mode=None):
+    dedup = get_dedup_store()
+    dedup.load()
+    metrics.reset_run()
+    try:
+        run_all_stores(store_names, from_date, to_date, mode)
+    finally:
+        run_maintenance()
+
+def run_maintenance():
+    """Fecha um ciclo de execuções: devolve sequenciais, compacta o estado local e registra as estatísticas."""
+    get_sequence_allocator().release()
+    get_dedup_store().compact()
+    get_work_queue().compact()
+    archive = get_archive()
+    if archive is not None:
+        archive.compact()
+    cache = get_conversion_cache()
+    if cache is not None:
+        cache.compact()
+        cache.log_stats()
+    log_endpoint_stats()
+    log_metrics_summary()
+    metrics.reset_run()
+
+def run_all_stores(store_names=None, from_date=None, to_date=None, mode=None):
+    store_names = list(store_names or config.stores)
+    mode = mode or INTEGRACAO_MODO
+    if mode == 'async':
+        run_all_stores_async(store_names, from_date, to_date)
+        return
+    if mode == 'sequencial':
+        for store_name in store_names:
+            execute_store_integration(store_name, from_date, to_date)
+        return
+
+    # Cada loja roda isolada na sua própria thread; falhas ou lentidão
+    # de uma loja não atrasam as demais.
+    workers = max(min(len(store_names), LOJAS_MAX_SIMULTANEAS), 1)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="loja") as executor:
+        futures = {executor.submit(execute_store_integration, name, from_date, to_date): name for name in store_names}
+        for future, store_name in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"[{store_name}] Erro na integração: {e}")
+
+# Conciliação: notas da ZIG em colunas, comparadas com o que foi registrado como enviado ao Omie
+CONCILIACAO_TOLERANCIA = float(os.getenv('CONCILIACAO_TOLERANCIA', '0.01'))  # R$
+CONCILIACAO_DIMENSOES = (('tpag', "Forma de pagamento"), ('cfop', "CFOP"), ('ncm', "NCM"))
+
+# Leitura só dos campos da conciliação, sem montar a árvore XML: o esquema da
+# NF-e fixa a ordem NCM → CFOP → vProd dentro de cada <prod>
+_ITEM_RE = re.compile(r'<NCM>([^<]*)</NCM>.*?<CFOP>([^<]*)</CFOP>.*?<vProd>([^<]*)</vProd>', re.S)
+_NNF_RE = re.compile(r'<nNF>([^<]*)</nNF>')
+_TPAG_RE = re.compile(r'<detPag>.*?<tPag>([^<]*)</tPag>', re.S)
+_VNF_RE = re.compile(r'<vNF>([^<]*)</vNF>')
+_VDESC_RE = re.compile(r'<vDesc>([^<]*)</vDesc>')
+
+def reconciliation_row(xml_data, md5=None):
+    """Valores da nota usados na conciliação: (chave, MD5, nNF, dhEmi, tPag, vNF, vDesc, itens).
+
+    `itens` traz (CFOP, NCM, vProd) de cada item; `md5`, se já conhecido,
+    evita recalcular o hash. XML com prefixos de namespace ou fora do padrão
+    cai na leitura completa (parse_nfe_record). Roda também nos processos do
+    pool de conversão.
+    """
+    md5 = md5 or nfce_md5(xml_data)
+    inicio = xml_data.rfind('<ICMSTot>')  # perto do fim do XML
+    fim = xml_data.find('</ICMSTot>', inicio)
+    nnf = _NNF_RE.search(xml_data)
+    vnf = inicio >= 0 and fim >= 0 and _VNF_RE.search(xml_data, inicio, fim)
+    if not (nnf and vnf):
+        nfe = parse_nfe_record(xml_data)
+        itens = [(item.CFOP or "", item.NCM or "", float(item.vProd or 0)) for item in nfe.det]
+        return ((nfe.Id or "")[3:], md5, nfe.nNF, nfe.dhEmi, nfe.tPag,
+                float(nfe.vNF or 0), float(nfe.vDesc or 0), itens)
+    vdesc = _VDESC_RE.search(xml_data, inicio, fim)
+    tpag = _TPAG_RE.search(xml_data, fim)
+    tpag = TPAG_MAPPING.get(tpag.group(1).strip(), "99999") if tpag else "99999"
+    dh_emi = _DHEMI_RE.search(xml_data)
+    itens = [(cfop, ncm, float(vprod or 0)) for ncm, cfop, vprod in _ITEM_RE.findall(xml_data, 0, inicio)]
+    return (nfce_chave(xml_data) or "", md5, nnf.group(1), dh_emi.group(1).strip() if dh_emi else None,
+            tpag, float(vnf.group(1) or 0), float(vdesc.group(1) or 0) if vdesc else 0.0, itens)
+
+def payload_row(omie_json, dh_emi=None):
+    """Os mesmos valores de reconciliation_row, lidos do payload enviado ao Omie."""
+    nfe = omie_json["NFe"]
+    tpag = omie_json["formasPag"][0]["pagIdent"]["cTipoPag"] if omie_json.get("formasPag") else "99999"
+    itens = [(det["prod"]["CFOP"] or "", det["prod"]["NCM"] or "", float(det["prod"]["vItem"] or 0))
+             for det in nfe["det"]]
+    return (nfe["chNFe"], omie_json["nfce"]["nfceMd5"], nfe["nNF"], dh_emi, tpag,
+            float(nfe["total"]["vCF"] or 0), float(nfe["total"]["vDesc"] or 0), itens)
+
+def reconcile_segment(directory, segmento, entries):
+    """reconciliation_row do XML da ZIG de cada nota de um segmento do arquivo.
+
+    Roda também nos processos do pool de conversão, que leem o segmento
+    direto do disco.
+    """
+    with open(os.path.join(directory, segmento), 'rb') as f:
+        return [reconciliation_row(read_archive_xml(f, posicao, tamanho), md5) for posicao, tamanho, md5 in entries]
+
+def archived_reconciliation_rows(archive, store_name, from_date, to_date):
+    """Gera reconciliation_row das notas arquivadas no período, um segmento (dia) por tarefa no pool, se configurado."""
+    segments = {}
+    for segmento, posicao, tamanho, _, md5 in archive.entries(store_name, from_date, to_date, with_md5=True):
+        segments.setdefault(segmento, []).append((posicao, tamanho, md5))
+    pool = get_conversion_pool()
+    if pool is None or len(segments) < 2:
+        results = (reconcile_segment(archive.directory, segmento, entries) for segmento, entries in segments.items())
+    else:
+        results = pool.map(reconcile_segment, [archive.directory] * len(segments), list(segments),
+                           list(segments.values()))
+    for rows in results:
+        yield from rows
+
+class InvoiceColumns:
+    """Notas em colunas: um array por campo, com um elemento por nota ou por item.
+
+    Forma de pagamento, CFOP e NCM são guardados como códigos inteiros; os
+    totais de cada dimensão são somas agrupadas por código (numpy.bincount,
+    se o numpy estiver instalado).
+    """
+
+    def __init__(self):
+        self.chaves = []
+        self.nnfs = []
+        self.vnf = array('d')
+        self.tpag = array('l')
+        self.item_valor = array('d')
+        self.cfop = array('l')
+        self.ncm = array('l')
+        self.categorias = {dimension: {} for dimension, _ in CONCILIACAO_DIMENSOES}
+
+    def __len__(self):
+        return len(self.chaves)
+
+    def _code(self, dimension, value):
+        codes = self.categorias[dimension]
+        return codes.setdefault(value, len(codes))
+
+    def append(self, row):
+        chave, _, nnf, _, tpag, vnf, _, itens = row
+        self.chaves.append(chave)
+        self.nnfs.append(nnf)
+        self.vnf.append(vnf)
+        self.tpag.append(self._code('tpag', tpag))
+        for cfop, ncm, valor in itens:
+            self.item_valor.append(valor)
+            self.cfop.append(self._code('cfop', cfop))
+            self.ncm.append(self._code('ncm', ncm))
+
+    def total(self):
+        return math.fsum(self.vnf)
+
+    def totals(self, dimension):
+        """Soma por categoria: vNF por forma de pagamento, valor dos itens por CFOP ou NCM."""
+        codes, values = (self.tpag, self.vnf) if dimension == 'tpag' else (getattr(self, dimension), self.item_valor)
+        names = list(self.categorias[dimension])
+        if np is not None:
+            sums = np.bincount(np.asarray(codes, dtype=np.intp), weights=np.asarray(values),
+                               minlength=len(names)).tolist()
+        else:
+            sums = [0.0] * len(names)
+            for code, value in zip(codes, values):
+                sums[code] += value
+        return dict(zip(names, sums))
+
+def _row_differences(zig_row, sent_row, tolerance):
+    differences = []
+    if zig_row[4] != sent_row[4]:
+        differences.append(f"tPag {zig_row[4]} ≠ {sent_row[4]}")
+    for nome, i in (("vNF", 5), ("vDesc", 6)):
+        if abs(zig_row[i] - sent_row[i]) > tolerance:
+            differences.append(f"{nome} {zig_row[i]:.2f} ≠ {sent_row[i]:.2f}")
+    itens_zig = math.fsum(valor for _, _, valor in zig_row[7])
+    itens_omie = math.fsum(valor for _, _, valor in sent_row[7])
+    if len(zig_row[7]) != len(sent_row[7]) or abs(itens_zig - itens_omie) > tolerance:
+        differences.append(f"itens {len(zig_row[7])} / {itens_zig:.2f} ≠ {len(sent_row[7])} / {itens_omie:.2f}")
+    return differences
+
+def reconcile_store(store_name, from_date, to_date, source='zig', tolerance=None):
+    """Concilia as notas emitidas na loja entre as datas (inclusive) com os envios registrados.
+
+    As notas vêm da ZIG (`source='zig'`) ou do arquivo local ('arquivo'). Cada
+    nota é comparada com o status no índice de notas e, quando arquivado, com
+    o payload enviado: o lado Omie usa o payload arquivado e, sem ele, os
+    valores da ZIG das notas com status final. Retorna os totais por dimensão
+    nos dois lados e a lista de notas não enviadas, divergentes ou arquivadas
+    mas ausentes da ZIG.
+    """
+    tolerance = CONCILIACAO_TOLERANCIA if tolerance is None else tolerance
+    store_config = config.stores[store_name]
+    archive = get_archive()
+    if source == 'arquivo' and archive is None:
+        raise ValueError("Arquivo de notas desligado (ARQUIVO_DIR vazio).")
+    first_day, last_day = f"{from_date:%Y-%m-%d}", f"{to_date:%Y-%m-%d}"
+    md5_status, chave_status = get_dedup_store().statuses(store_name)
+
+    # Valores enviados das notas arquivadas no período, pela chave
+    archived = {}
+    if archive is not None:
+        archived = {row[0] or row[1]: row for row in archive.sent_rows(store_name, from_date, to_date)}
+    if source == 'arquivo':
+        zig_rows = archived_reconciliation_rows(archive, store_name, from_date, to_date)
+    else:
+        zig_rows = (reconciliation_row(invoice["xml"])
+                    for _, invoice in iter_invoices(store_config, from_date, to_date) if invoice is not None)
+
+    zig, omie = InvoiceColumns(), InvoiceColumns()
+    seen, problems = set(), []
+
+    def problem(row, kind, status, detail=""):
+        problems.append({"chave": row[0], "nNF": row[2], "dhEmi": row[3], "problema": kind,
+                         "status": status, "detalhe": detail})
+
+    for row in zig_rows:
+        key = row[0] or row[1]
+        if key in seen or not first_day <= (row[3] or "")[:10] <= last_day:
+            continue
+        seen.add(key)
+        zig.append(row)
+        status = md5_status.get(row[1]) or chave_status.get(row[0])
+        if status not in DedupStore.STATUS_FINAIS:
+            problem(row, "nao_enviada", status)
+            continue
+        sent_row = archived.pop(key, None)
+        if sent_row is None:
+            omie.append(row)
+            continue
+        omie.append(sent_row)
+        differences = _row_differences(row, sent_row, tolerance)
+        if differences:
+            problem(row, "divergente", status, "; ".join(differences))
+    for key, sent_row in archived.items():
+        if key not in seen:
+            problem(sent_row, "ausente_na_zig", md5_status.get(sent_row[1]) or chave_status.get(sent_row[0]))
+
+    totals = {}
+    for dimension, _ in CONCILIACAO_DIMENSOES:
+        zig_totals, omie_totals = zig.totals(dimension), omie.totals(dimension)
+        totals[dimension] = {
+            name: {"zig": round(zig_totals.get(name, 0.0), 2), "omie": round(omie_totals.get(name, 0.0), 2),
+                   "diferenca": round(zig_totals.get(name, 0.0) - omie_totals.get(name, 0.0), 2)}
+            for name in sorted(set(zig_totals) | set(omie_totals))
+        }
+    return {
+        "loja": store_name,
+        "de": first_day,
+        "ate": last_day,
+        "fonte": source,
+        "notas_zig": len(zig),
+        "notas_omie": len(omie),
+        "total_zig": round(zig.total(), 2),
+        "total_omie": round(omie.total(), 2),
+        "totais": totals,
+        "problemas": problems,
+    }
+
+def print_reconciliation(report, tolerance=None, limit=50):
+    tolerance = CONCILIACAO_TOLERANCIA if tolerance is None else tolerance
+    store_name = report["loja"]
+    print(f"[{store_name}] Conciliação de {report['de']} a {report['ate']} ({report['fonte']}): "
+          f"{report['notas_zig']} notas na ZIG (R$ {report['total_zig']:.2f}), "
+          f"{report['notas_omie']} enviadas ao Omie (R$ {report['total_omie']:.2f}).")
+    for dimension, titulo in CONCILIACAO_DIMENSOES:
+        rows = report["totais"][dimension]
+        # Forma de pagamento sempre completa; CFOP e NCM só com diferença
+        shown = {name: r for name, r in rows.items() if dimension == 'tpag' or abs(r["diferenca"]) > tolerance}
+        if not shown:
+            print(f"  {titulo}: {len(rows)} grupos, sem diferenças.")
+            continue
+        print(f"  {titulo:<20} {'ZIG':>14} {'Omie':>14} {'Diferença':>14}")
+        for name, r in shown.items():
+            print(f"  {name or '-':<20} {r['zig']:>14.2f} {r['omie']:>14.2f} {r['diferenca']:>14.2f}")
+    problems = report["problemas"]
+    if not problems:
+        print("  Nenhuma nota faltando ou divergente.")
+        return
+    kinds = {}
+    for p in problems:
+        kinds[p["problema"]] = kinds.get(p["problema"], 0) + 1
+    print(f"  {len(problems)} notas com problema: " + ", ".join(f"{n} {k}" for k, n in sorted(kinds.items())))
+    for p in problems[:limit]:
+        detalhe = f" — {p['detalhe']}" if p["detalhe"] else ""
+        print(f"    nNF {p['nNF']} {p['chave']} {p['problema']} ({p['status'] or 'sem status'}){detalhe}")
+    if len(problems) > limit:
+        print(f"    ... mais {len(problems) - limit} notas (use --saida para a lista completa).")
+
+# Motor assíncrono: busca e envio de todas as lojas num único event loop (INTEGRACAO_MODO=async)
+class AsyncResponse:
+    """Resposta do aiohttp com a mesma interface usada das respostas do requests.
+
+    Com stream=True o corpo não é lido: raw fica aberto para leitura em blocos
+    e quem pediu a resposta chama release() ao terminar.
+    """
+
+    def __init__(self, status_code, headers, content, raw=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.raw = raw
+
+    def release(self):
+        if self.raw is not None:
+            self.raw.release()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncEngine:
+    """Executa as lojas como tarefas de um event loop, compartilhando uma ClientSession do aiohttp.
+
+    A espera de rede não ocupa threads: só a conversão do XML (CPU) vai para
+    um executor (o pool de processos, se configurado, ou threads). O limite de
+    conexões por host fica no conector; semáforos por app_key e o
+    OmieRateLimiter (via reserve()) controlam o envio ao Omie como no modo com
+    threads, mas sempre uma nota por chamada (OMIE_LOTE_TAMANHO não se aplica).
+    Dedup, fila persistente, sequenciais e marca d'água são os mesmos; a
+    triagem das notas, o cache de conversão e as gravações em SQLite e arquivo
+    rodam numa thread de gravação (`writer`), fora do event loop. Uma só
+    thread basta, e várias disputariam o GIL com a conversão e os locks das
+    conexões SQLite.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.app_key_semaphores = {}
+        self.store_semaphore = asyncio.Semaphore(max(LOJAS_MAX_SIMULTANEAS, 1))
+        self.executor = get_conversion_pool()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-gravacao')
+        if OMIE_LOTE_TAMANHO > 1:
+            logging.warning("OMIE_LOTE_TAMANHO não se aplica ao modo async: as notas são enviadas uma por chamada.")
+
+    async def blocking(self, fn, *args):
+        """Executa fn(*args) (SQLite, arquivos) na thread de gravação e aguarda o resultado."""
+        return await asyncio.get_running_loop().run_in_executor(self.writer, fn, *args)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+
+    def app_key_semaphore(self, app_key):
+        if app_key not in self.app_key_semaphores:
+            self.app_key_semaphores[app_key] = asyncio.Semaphore(OMIE_MAX_CONCORRENCIA)
+        return self.app_key_semaphores[app_key]
+
+    async def sleep(self, seconds, deadline=None):
+        if deadline is not None:
+            seconds = min(seconds, deadline.remaining())
+        await asyncio.sleep(seconds)
+        if deadline is not None:
+            deadline.check()
+
+    async def request(self, method, url, endpoint, retry_status=(500, 502, 503, 504), deadline=None, stream=False,
+                      **kwargs):
+        """Equivalente assíncrono de http_request: mesmos timeouts, novas tentativas e estatísticas."""
+        stats = get_endpoint_stats(endpoint)
+        for tentativa in range(1, HTTP_MAX_TENTATIVAS + 1):
+            conexao, leitura = HTTP_TIMEOUT_CONEXAO, HTTP_TIMEOUT_LEITURA
+            if deadline is not None:
+                deadline.check()
+                conexao, leitura = min(conexao, deadline.remaining()), min(leitura, deadline.remaining())
+            inicio = time.perf_counter()
+            try:
+                resp = await self.session.request(
+                    method, url, timeout=aiohttp.ClientTimeout(sock_connect=conexao, sock_read=leitura), **kwargs)
+                if stream and resp.status not in retry_status:
+                    response = AsyncResponse(resp.status, resp.headers, None, raw=resp)
+                else:
+                    try:
+                        response = AsyncResponse(resp.status, resp.headers, await resp.read())
+                    finally:
+                        resp.release()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                stats.record(time.perf_counter() - inicio, ok=False, retry=tentativa > 1)
+                if tentativa == HTTP_MAX_TENTATIVAS:
+                    raise
+                logging.warning(f"[http] {endpoint}: {e.__class__.__name__} (tentativa {tentativa}/{HTTP_MAX_TENTATIVAS})")
+                await self.sleep(retry_delay(tentativa), deadline)
+                continue
+            ok = response.status_code not in retry_status
+            stats.record(time.perf_counter() - inicio, ok=ok, retry=tentativa > 1)
+            if ok or tentativa == HTTP_MAX_TENTATIVAS:
+                return response
+            logging.warning(f"[http] {endpoint}: status {response.status_code} (tentativa {tentativa}/{HTTP_MAX_TENTATIVAS})")
+            await self.sleep(retry_delay(tentativa), deadline)
+
+    async def stream_invoices(self, store_config, from_date, to_date, page, deadline=None):
+        """Como stream_invoices: gera as notas da página à medida que os blocos chegam."""
+        params = {
+            "dtinicio": from_date.strftime('%Y-%m-%d'),
+            "dtfim": to_date.strftime('%Y-%m-%d'),
+            "loja": store_config.zig_rede,
+            "page": str(page)
+        }
+        with observe_stage('zig_busca', store_config.name):
+            response = await self.request("GET", ZIG_API_URL, "zig.invoice", deadline=deadline, stream=True,
+                                          headers={"Authorization": store_config.zig_token}, params=params)
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Unexpected status: {response.status_code}")
+            parser = JsonArrayStream()
+            async for chunk in response.raw.content.iter_chunked(ZIG_BLOCO_BYTES):
+                for invoice in parser.feed(chunk):
+                    yield invoice
+            parser.close()
+        finally:
+            response.release()
+
+    async def iter_invoices(self, store_config, from_date, to_date, start_page=1, deadline=None):
+        """Como iter_invoices: gera (página, nota) e (página, None) no fim de cada página, com busca antecipada."""
+        buffer = asyncio.Queue(maxsize=ZIG_PREFETCH_NOTAS)
+        fim = object()
+
+        async def producer():
+            page = start_page
+            previous_first = None
+            try:
+                while True:
+                    first = fim
+                    invoices = self.stream_invoices(store_config, from_date, to_date, page, deadline)
+                    try:
+                        async for invoice in invoices:
+                            if first is fim:
+                                first = invoice.get("xml")
+                                if first is not None and first == previous_first:
+                                    logging.warning(f"[{store_config.name}] Página {page} repetiu a anterior; "
+                                                    f"encerrando paginação.")
+                                    break
+                            await buffer.put((page, invoice))
+                            invoice = None  # só o buffer guarda a nota
+                    finally:
+                        await invoices.aclose()
+                    if first is fim or first is not None and first == previous_first:
+                        break
+                    previous_first = first
+                    await buffer.put((page, None))
+                    page += 1
+                await buffer.put(fim)
+            except Exception as e:
+                await buffer.put(e)
+
+        task = asyncio.ensure_future(producer())
+        try:
+            while True:
+                item = await buffer.get()
+                if item is fim:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
+
+    async def convert_invoices(self, store_name, items):
+        """Como convert_invoices: converte no executor até CONVERSAO_JANELA notas por vez, preservando a ordem."""
+        loop = asyncio.get_running_loop()
+        cache = get_conversion_cache()
+
+        async def resolve(page, invoice, pending, digest):
+            if pending is None or not isinstance(pending, asyncio.Future):
+                return page, invoice, pending  # marcador de página ou acerto do cache
+            try:
+                omie_json, parse_seconds, build_seconds = await pending
+            except Exception as e:
+                return page, invoice, e
+            record_conversion_times(store_name, parse_seconds, build_seconds)
+            if cache is not None:
+                await self.blocking(cache.put, digest, omie_json)
+            return page, invoice, omie_json
+
+        def lookup(xml_data):
+            digest = cache.key(xml_data)
+            return digest, cache.get(digest)
+
+        window = deque()
+        try:
+            async for page, invoice in items:
+                pending = digest = None
+                if invoice is not None:
+                    if cache is not None:
+                        # SHA-1 do XML e, com CACHE_CONVERSAO_DISCO, consulta ao SQLite: fora do event loop
+                        digest, pending = await self.blocking(lookup, invoice["xml"])
+                    if pending is None:
+                        pending = loop.run_in_executor(self.executor, convert_xml_timed, invoice["xml"])
+                window.append((page, invoice, pending, digest))
+                if len(window) >= CONVERSAO_JANELA:
+                    yield await resolve(*window.popleft())
+            while window:
+                yield await resolve(*window.popleft())
+        finally:
+            for _, _, pending, _ in window:
+                if isinstance(pending, asyncio.Future):
+                    pending.cancel()
+
+    async def post_omie_nfce(self, store_config, param, deadline=None):
+        body = {
+            "call": "IncluirNfce",
+            "app_key": store_config.omie_app_key,
+            "app_secret": store_config.omie_app_secret,
+            "param": param
+        }
+        limiter = get_rate_limiter(store_config.omie_app_key)
+        semaphore = self.app_key_semaphore(store_config.omie_app_key)
+        for tentativa in range(1, OMIE_MAX_TENTATIVAS + 1):
+            wait = limiter.reserve()
+            while wait > 0:
+                await self.sleep(wait, deadline)
+                wait = limiter.reserve()
+            async with semaphore:
+                with observe_stage('omie_envio', store_config.name):
+                    response = await self.request("POST", OMIE_API_URL, "omie.IncluirNfce", retry_status=(502, 503, 504),
+                                                  deadline=deadline, json=body)
+            try:
+                response_data = response.json()
+            except ValueError:
+                response_data = {}
+
+            wait = omie_throttle_wait(response, response_data)
+            if wait is None:
+                return response, response_data
+            limiter.on_throttle(wait)
+            metrics.inc('integracao_omie_limites_total', loja=store_config.name)
+            logging.warning(f"[{store_config.name}] Omie limitou o consumo (tentativa {tentativa}/{OMIE_MAX_TENTATIVAS}). Nova taxa: {limiter.rate:.2f} req/s")
+        raise Exception(f"Limite de consumo do Omie persistiu após {OMIE_MAX_TENTATIVAS} tentativas")
+
+    async def process_omie_invoice(self, store_config, omie_json, deadline=None):
+        md5_value = omie_json["nfce"]["nfceMd5"]
+        chave = omie_json["NFe"]["chNFe"]
+        dedup = get_dedup_store()
+        if dedup.seen(md5_value, chave):
+            return "ignorada"
+        await self.blocking(dedup.mark, md5_value, "pendente", chave, store_config.name)
+        try:
+            response, response_data = await self.post_omie_nfce(store_config, [omie_json], deadline)
+            return await self.blocking(record_omie_response, store_config, omie_json, response, response_data)
+        except TimeoutError:
+            logging.warning(f"[{store_config.name}] Envio interrompido pelo tempo limite (MD5: {md5_value}).")
+            return "interrompida"
+        except Exception as e:
+            logging.error(f"[{store_config.name}] Erro ao enviar nota: {str(e)}")
+            await self.blocking(dedup.mark, md5_value, "erro", chave, store_config.name)
+            return "erro"
+
+    async def run_store_pipeline(self, store_config, invoices, checkpoint, results, deadline, watermark=None,
+                                 not_before=None, resume=True):
+        """Versão assíncrona de run_store_pipeline, com tarefas de envio no lugar das threads."""
+        pending = asyncio.Queue(maxsize=LOJA_FILA_MAXIMA)
+        dedup = get_dedup_store()
+        work_queue = get_work_queue()
+        resumed_md5s = await self.blocking(work_queue.pending_md5s, store_config.name) if resume else []
+        queued = set(resumed_md5s)
+
+        def count(status, dh_emi=None):
+            results[status] = results.get(status, 0) + 1
+            metrics.inc('integracao_notas_total', loja=store_config.name, status=status)
+            if watermark is not None:
+                watermark.observe(dh_emi, status not in ("erro", "interrompida"))
+
+        def finish(page, md5, status):
+            work_queue.finish(md5, status)
+            if checkpoint and page is not None and status != "interrompida":
+                checkpoint.done(page)  # pode gravar o cursor de página
+
+        def register(page, invoice, omie_json, dh_emi):
+            archive_invoice(store_config.name, invoice, omie_json, dh_emi)
+            work_queue.enqueue(store_config.name, omie_json, dh_emi)
+            if checkpoint:
+                checkpoint.add(page)
+
+        async def sender():
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                page, dh_emi, omie_json = item
+                metrics.set_gauge('integracao_fila_envio', pending.qsize(), loja=store_config.name)
+                if deadline.expired():
+                    status = "interrompida"
+                else:
+                    try:
+                        status = await self.process_omie_invoice(store_config, omie_json, deadline)
+                    except Exception as e:
+                        logging.error(f"[{store_config.name}] Erro ao enviar nota: {e}")
+                        status = "erro"
+                try:
+                    count(status, dh_emi)
+                    await self.blocking(finish, page, omie_json["nfce"]["nfceMd5"], status)
+                except Exception as e:
+                    logging.error(f"[{store_config.name}] Erro ao registrar o envio da nota {omie_json['NFe']['chNFe']}: {e}")
+
+        async def unseen():
+            async for page, invoice in invoices:
+                if invoice is not None:
+                    # unescape e MD5 do XML inteiro, mais a consulta ao dedup
+                    skip, dh_emi = await self.blocking(triage_invoice, invoice, not_before, queued, dedup)
+                    if skip:
+                        count("ignorada", dh_emi)
+                        continue
+                yield page, invoice
+
+        senders = [asyncio.ensure_future(sender()) for _ in range(max(store_config.max_envios, 1))]
+        try:
+            if resumed_md5s:
+                logging.info(f"[{store_config.name}] Retomando {len(resumed_md5s)} notas pendentes da fila de envio.")
+                fim = object()
+                resumed = work_queue.iter_pending(store_config.name, resumed_md5s)
+                while True:
+                    item = await self.blocking(next, resumed, fim)
+                    if item is fim:
+                        break
+                    deadline.check()
+                    await pending.put((None, *item))
+
+            async for page, invoice, converted in self.convert_invoices(store_config.name, unseen()):
+                deadline.check()
+                if invoice is None:
+                    if checkpoint:
+                        await self.blocking(checkpoint.close, page)
+                    continue
+                dh_emi = nfce_dh_emi(invoice["xml"])
+                try:
+                    if isinstance(converted, Exception):
+                        raise converted
+                    # Reserva seqCaixa/seqCupom no SQLite: fora do event loop
+                    omie_json = await self.blocking(apply_store_fields, store_config.name, converted, invoice)
+                except Exception as e:
+                    logging.error(f"[{store_config.name}] Erro ao converter nota da página {page}: {e}")
+                    count("erro", dh_emi)
+                    continue
+                await self.blocking(register, page, invoice, omie_json, dh_emi)
+                await pending.put((page, dh_emi, omie_json))
+                metrics.set_gauge('integracao_fila_envio', pending.qsize(), loja=store_config.name)
+        finally:
+            for _ in senders:
+                await pending.put(None)
+            await asyncio.gather(*senders)
+        if results.get("interrompida"):
+            raise TimeoutError("Operation timed out.")
+        return results
+
+    async def execute_store_integration(self, store_name, from_date=None, to_date=None):
+        store_config = config.stores[store_name]
+        logging.info(f"Iniciando integração assíncrona para loja {store_name}...")
+        # Chamadas síncronas ao Omie: no executor padrão, sem ocupar a thread de gravação
+        await asyncio.get_running_loop().run_in_executor(None, refresh_store_catalog, store_config)
+        tracker = WatermarkTracker()
+        last_run, now, not_before = await self.blocking(store_window, store_name, from_date, to_date)
+        results = {}
+        inicio_envio = time.time()
+        completa = False
+        try:
+            with timeout(INTEGRACAO_TIMEOUT) as deadline, active_run(store_name, deadline):
+                start_page = await self.blocking(load_page_cursor, store_name, last_run, now)
+                if start_page > 1:
+                    logging.info(f"[{store_name}] Retomando a partir da página {start_page}.")
+                checkpoint = PageCheckpoint(lambda page: save_page_cursor(store_name, last_run, now, page + 1))
+                invoices = self.iter_invoices(store_config, last_run, now, start_page, deadline)
+                await self.run_store_pipeline(store_config, invoices, checkpoint, results, deadline, tracker, not_before)
+                await self.blocking(clear_page_cursor, store_name)
+                completa = True
+                logging.info(f"[{store_name}] Remessa de vendas finalizada.")
+        except TimeoutError:
+            proxima = await self.blocking(load_page_cursor, store_name, last_run, now)
+            logging.error(f"[{store_name}] O tempo limite foi atingido. A próxima execução retoma da página {proxima}.")
+        except Exception as e:
+            logging.error(f"[{store_name}] Erro na integração: {e}")
+        finally:
+            await self.blocking(finish_store_run, store_config, results, inicio_envio, tracker, completa)
+        return results
+
+    async def run_stores(self, store_names, from_date=None, to_date=None):
+        """Integra as lojas, até LOJAS_MAX_SIMULTANEAS ao mesmo tempo; retorna a contagem por status de cada uma."""
+        async def run(store_name):
+            async with self.store_semaphore:
+                return await self.execute_store_integration(store_name, from_date, to_date)
+
+        return dict(zip(store_names, await asyncio.gather(*(run(name) for name in store_names))))
+
+def new_client_session():
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=HTTP_POOL_MAXIMO)
+    return aiohttp.ClientSession(connector=connector)
+
+async def _run_all_stores_async(store_names, from_date=None, to_date=None):
+    async with new_client_session() as session:
+        engine = AsyncEngine(session)
+        try:
+            return await engine.run_stores(store_names, from_date, to_date)
+        finally:
+            engine.close()
+
+def run_all_stores_async(store_names=None, from_date=None, to_date=None):
+    """Integra as lojas num event loop; retorna a contagem por status de cada loja."""
+    if aiohttp is None:
+        raise RuntimeError("O modo async requer o pacote aiohttp (pip install aiohttp).")
+    store_names = list(store_names or config.stores)
+    if _async_runner is not None:
+        return _async_runner.run(store_names, from_date, to_date)
+    return asyncio.run(_run_all_stores_async(store_names, from_date, to_date))
+
+class AsyncRunner:
+    """Event loop numa thread própria, com ClientSession e AsyncEngine que duram o serviço todo.
+
+    No serviço cada loja roda como job do agendador; em vez de criar um event
+    loop e uma sessão (e abrir conexões novas) a cada execução, os jobs
+    submetem a integração a este loop e aguardam o resultado.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-loop', daemon=True)
+        self.thread.start()
+        self.engine = self.submit(self._open()).result()
+
+    async def _open(self):
+        return AsyncEngine(new_client_session())
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, store_names, from_date=None, to_date=None):
+        return self.submit(self.engine.run_stores(store_names, from_date, to_date)).result()
+
+    def close(self):
+        self.submit(self.engine.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.engine.close()
+
+_async_runner = None
+_async_runner_lock = threading.Lock()
+
+def start_async_runner():
+    global _async_runner
+    if aiohttp is None:
+        raise RuntimeError("O modo async requer o pacote aiohttp (pip install aiohttp).")
+    with _async_runner_lock:
+        if _async_runner is None:
+            _async_runner = AsyncRunner()
+        return _async_runner
+
+def stop_async_runner():
+    global _async_runner
+    with _async_runner_lock:
+        runner, _async_runner = _async_runner, None
+    if runner is not None:
+        runner.close()
+
+def configure_logging():
     # Configurar logging para cada loja
     for store_name in config.stores:
         logging.basicConfig(
@@ -623,11 +4065,563 @@ if __name__ == "__main__":
             level=logging.INFO,
             format=f'%(asctime)s [%(levelname)s] [{store_name}] %(message)s'
         )
-    
-    # Executa a integração imediatamente
-    logging.info("Executando integração imediatamente...")
-    execute_all_integrations()
 
-    # Agenda a execução periódica
-    scheduler.add_job(execute_all_integrations, 'interval', seconds=21600)
-    scheduler.start()
+# Agendamento do serviço: 'intervalo' (cada loja no seu intervalo fixo) ou
+# 'adaptativo' (consultas curtas no horário de funcionamento, espaçadas com a loja parada)
+INTEGRACAO_AGENDAMENTO = os.getenv('INTEGRACAO_AGENDAMENTO', 'intervalo')
+AGENDA_HORARIO = os.getenv('AGENDA_HORARIO', '')  # ex.: "11:00-03:00"; vazio = o dia todo
+AGENDA_MINIMO = int(os.getenv('AGENDA_MINIMO', '120'))  # segundos entre consultas com a loja vendendo
+AGENDA_OCIOSO_MAXIMO = int(os.getenv('AGENDA_OCIOSO_MAXIMO', '1800'))  # teto do espaçamento no horário
+AGENDA_JITTER = float(os.getenv('AGENDA_JITTER', '0.2'))  # variação aleatória, em fração do espaçamento
+AGENDA_WEBHOOK_TOKEN = os.getenv('AGENDA_WEBHOOK_TOKEN', '')  # exigido como "Authorization: Bearer" se definido
+
+def seconds_until_open(faixas, now):
+    """0 se `now` cai numa das faixas de parse_trading_hours (ou não há faixas); senão, segundos até a abertura."""
+    minuto = now.hour * 60 + now.minute + now.second / 60
+    esperas = []
+    for inicio, fim in faixas:
+        if inicio == fim or (inicio <= minuto < fim if inicio < fim else (minuto >= inicio or minuto < fim)):
+            return 0
+        esperas.append((inicio - minuto) % 1440)
+    return min(esperas) * 60 if esperas else 0
+
+class StoreSchedule:
+    """Execuções em andamento, pedidos do webhook e espaçamento adaptativo de cada loja.
+
+    No agendamento adaptativo a loja é consultada a cada AGENDA_MINIMO
+    segundos enquanto aparecem notas novas; cada execução sem notas dobra o
+    espaçamento, até AGENDA_OCIOSO_MAXIMO. Fora do horário de funcionamento
+    vale o intervalo da loja, encurtado para acordar na abertura. O jitter
+    evita que lojas agendadas juntas continuem alinhadas.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}  # loja -> execuções seguidas sem notas novas
+        self.running = set()
+        self.requested = set()  # lojas com pedido do webhook durante a execução
+
+    def started(self, store_name):
+        with self.lock:
+            self.running.add(store_name)
+            self.requested.discard(store_name)  # a execução que começa atende os pedidos anteriores
+
+    def finished(self, store_name):
+        """Retorna True se o webhook pediu outra execução enquanto a loja rodava."""
+        with self.lock:
+            self.running.discard(store_name)
+            pedido = store_name in self.requested
+            self.requested.discard(store_name)
+            return pedido
+
+    def request(self, store_name):
+        """Registra o pedido se a loja está rodando (ela roda de novo ao terminar); senão retorna False."""
+        with self.lock:
+            if store_name not in self.running:
+                return False
+            self.requested.add(store_name)
+            return True
+
+    def next_delay(self, store_config, results=None, now=None):
+        """Segundos até a próxima execução; `results` é a contagem por status da execução que terminou."""
+        if results is not None:
+            novas = sum(n for status, n in results.items() if status != "ignorada")
+            with self.lock:
+                self.idle[store_config.name] = 0 if novas else self.idle.get(store_config.name, 0) + 1
+        fechada = seconds_until_open(parse_trading_hours(store_config.horario or AGENDA_HORARIO), now or datetime.now())
+        if fechada:
+            delay = min(store_config.intervalo, fechada)
+        else:
+            with self.lock:
+                ociosas = self.idle.get(store_config.name, 0)
+            delay = min(AGENDA_MINIMO * 2 ** min(ociosas, 16), max(AGENDA_OCIOSO_MAXIMO, AGENDA_MINIMO))
+        return delay * random.uniform(1 - AGENDA_JITTER, 1 + AGENDA_JITTER)
+
+_store_schedule = StoreSchedule()
+
+def get_store_schedule():
+    return _store_schedule
+
+def run_store_job(store_name):
+    # A loja pode ter saído do cadastro, ou estar com outra réplica, depois do agendamento
+    if store_name not in config.stores:
+        return
+    coordinator = get_coordinator()
+    if coordinator is not None and not coordinator.owns(store_name):
+        return
+    schedule = get_store_schedule()
+    results = {}
+    falhou = False
+    try:
+        repetir = True
+        while repetir:  # pedido do webhook durante a execução: roda de novo em seguida
+            schedule.started(store_name)
+            try:
+                if INTEGRACAO_MODO == 'async':
+                    run = run_all_stores_async([store_name]).get(store_name)
+                else:
+                    run = execute_store_integration(store_name)
+                for status, n in (run or {}).items():
+                    results[status] = results.get(status, 0) + n
+            finally:
+                repetir = schedule.finished(store_name)
+    except Exception as e:
+        falhou = True
+        logging.error(f"[{store_name}] Erro na execução agendada: {e}")
+        print(f"[{store_name}] Erro na execução agendada: {e}")
+    finally:
+        # No adaptativo cada execução agenda a seguinte: sem isto, uma falha tiraria a loja da agenda
+        store_config = config.stores.get(store_name)
+        if INTEGRACAO_AGENDAMENTO == 'adaptativo' and store_config is not None:
+            delay = store_config.intervalo if falhou else schedule.next_delay(store_config, results)
+            schedule_store(store_config, delay=delay)
+
+def request_store_sync(store_name):
+    """Antecipa a execução da loja (webhook POST /sync/<loja>); retorna a situação do pedido."""
+    if store_name not in config.stores:
+        return 'desconhecida'
+    coordinator = get_coordinator()
+    if coordinator is not None and not coordinator.owns(store_name):
+        return 'outra_replica'
+    if not scheduler.running:
+        return 'parado'
+    if get_store_schedule().request(store_name):
+        situacao = 'em_execucao'
+    else:
+        try:
+            scheduler.modify_job(f"loja-{store_name}", next_run_time=datetime.now())
+        except JobLookupError:
+            pass  # disparo agendado acabou de sair da fila para rodar
+        situacao = 'agendada'
+    logging.info(f"[{store_name}] Sincronização pedida pelo webhook ({situacao}).")
+    return situacao
+
+def schedule_store(store_config, run_now=False, delay=None):
+    if INTEGRACAO_AGENDAMENTO == 'adaptativo':
+        # Um disparo por vez: cada execução agenda a seguinte ao terminar
+        if delay is None:
+            delay = 0 if run_now else get_store_schedule().next_delay(store_config)
+        metrics.set_gauge('integracao_proxima_execucao_segundos', round(delay), loja=store_config.name)
+        scheduler.add_job(run_store_job, 'date', run_date=datetime.now() + timedelta(seconds=delay),
+                          args=[store_config.name], id=f"loja-{store_config.name}", replace_existing=True,
+                          misfire_grace_time=3600)
+        return
+    # Uma execução por loja de cada vez; disparos perdidos enquanto ela roda
+    # são agrupados em um só. O jitter espalha o início de lojas com o mesmo intervalo.
+    scheduler.add_job(run_store_job, 'interval', seconds=store_config.intervalo, args=[store_config.name],
+                      id=f"loja-{store_config.name}", replace_existing=True, max_instances=1, coalesce=True,
+                      misfire_grace_time=3600, jitter=min(300, store_config.intervalo // 10),
+                      **({'next_run_time': datetime.now()} if run_now else {}))
+
+def reload_stores():
+    added, removed, changed = config.reload()
+    for store_name in removed:
+        try:
+            scheduler.remove_job(f"loja-{store_name}")
+        except JobLookupError:
+            pass
+    for store_name in added:
+        schedule_store(config.stores[store_name], run_now=True)
+    for store_name in changed:
+        # Credenciais e IDs são lidos do cadastro a cada execução; só o intervalo exige reagendar
+        if INTEGRACAO_AGENDAMENTO == 'adaptativo':
+            continue  # o espaçamento é recalculado ao fim de cada execução
+        job = scheduler.get_job(f"loja-{store_name}")
+        if job is None or job.trigger.interval.total_seconds() != config.stores[store_name].intervalo:
+            schedule_store(config.stores[store_name])
+
+def serve(args):
+    start_metrics_server()
+    scheduler.configure(executors={'default': {'type': 'threadpool', 'max_workers': LOJAS_MAX_SIMULTANEAS + 2}})
+    if INTEGRACAO_MODO == 'async':
+        start_async_runner()  # um event loop e uma sessão HTTP para todas as execuções
+    coordinator = get_coordinator()
+    store_names = None
+    if coordinator is not None:
+        # SIGTERM do orquestrador encerra pelo caminho normal e devolve as concessões
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        coordinator.start(lambda: list(config.stores))
+        store_names = sorted(coordinator.owned)
+        logging.info(f"[coordenação] {coordinator.worker_id} integra {len(store_names)} de {len(config.stores)} lojas.")
+    if INTEGRACAO_AGENDAMENTO == 'adaptativo':
+        # Sem rodada inicial conjunta: as primeiras execuções se espalham pelo primeiro espaçamento
+        get_dedup_store().load()
+        for store_config in config.stores.values():
+            schedule_store(store_config, delay=random.uniform(0, AGENDA_MINIMO))
+    else:
+        # Executa a integração imediatamente
+        logging.info("Executando integração imediatamente...")
+        if store_names is None or store_names:
+            execute_all_integrations(store_names)
+        # Agenda a execução periódica de cada loja
+        for store_config in config.stores.values():
+            schedule_store(store_config)
+
+    # Manutenção e releitura do cadastro
+    scheduler.add_job(run_maintenance, 'interval', seconds=INTEGRACAO_INTERVALO, id='manutencao',
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(reload_stores, 'interval', seconds=LOJAS_RECARGA_SEGUNDOS, id='cadastro-lojas',
+                      max_instances=1, coalesce=True)
+    if CATALOGO_PRODUTOS:
+        # Catálogo atualizado fora das execuções; códigos novos vistos nas notas entram no refresh seguinte
+        scheduler.add_job(lambda: refresh_catalogs(None if coordinator is None else sorted(coordinator.owned)),
+                          'interval', seconds=min(CATALOGO_TTL, 600), id='catalogo-produtos',
+                          max_instances=1, coalesce=True,
+                          **({'next_run_time': datetime.now()} if INTEGRACAO_AGENDAMENTO == 'adaptativo' else {}))
+    if coordinator is not None:
+        # Loja assumida de outra réplica roda na hora, sem esperar o próprio intervalo
+        coordinator.on_claim = lambda names: [
+            schedule_store(config.stores[name], run_now=True) for name in names if name in config.stores]
+    try:
+        scheduler.start()
+    finally:
+        if coordinator is not None:
+            coordinator.stop()
+        stop_async_runner()
+
+def backfill(args):
+    start_metrics_server()
+    from_date = datetime.strptime(args.de, '%Y-%m-%d')
+    to_date = datetime.strptime(args.ate, '%Y-%m-%d') if args.ate else datetime.now()
+    execute_all_integrations(args.loja, from_date, to_date)
+
+def run_async(args):
+    execute_all_integrations(args.loja, mode='async')
+
+def _date_range(args):
+    from_date = datetime.strptime(args.de, '%Y-%m-%d') if args.de else None
+    to_date = datetime.strptime(args.ate, '%Y-%m-%d') if args.ate else None
+    return from_date, to_date
+
+def run_once(args):
+    start_metrics_server()
+    from_date, to_date = _date_range(args)
+    execute_all_integrations(args.loja, from_date, to_date, mode=args.modo)
+
+def dry_run_store(store_name, from_date=None, to_date=None, results=None):
+    """Busca e converte as notas da loja como uma execução normal, gerando os payloads sem enviá-los.
+
+    seqCaixa/seqCupom não são reservados, e nada vai para a fila de envio, o
+    arquivo de notas, o índice de notas ou a marca d'água. `results` recebe
+    a contagem por status (convertida, ignorada, erro).
+    """
+    store_config = config.stores[store_name]
+    refresh_store_catalog(store_config)
+    last_run, now, not_before = store_window(store_name, from_date, to_date)
+    results = {} if results is None else results
+    dedup = get_dedup_store()
+    queued = set(get_work_queue().pending_md5s(store_name))
+
+    def count(status):
+        results[status] = results.get(status, 0) + 1
+
+    def unseen():
+        for page, invoice in iter_invoices(store_config, last_run, now):
+            if invoice is not None:
+                if triage_invoice(invoice, not_before, queued, dedup)[0]:
+                    count("ignorada")
+                    continue
+                yield page, invoice
+
+    for page, invoice, converted in convert_invoices(unseen(), store_name):
+        try:
+            if isinstance(converted, Exception):
+                raise converted
+            omie_json = apply_store_fields(store_name, converted, invoice, sequencial=False)
+        except Exception as e:
+            logging.error(f"[{store_name}] Erro ao converter nota da página {page}: {e}")
+            count("erro")
+            continue
+        count("convertida")
+        yield omie_json
+
+def dry_run(args):
+    dedup = get_dedup_store()
+    dedup.load()
+    from_date, to_date = _date_range(args)
+
+    def payloads():
+        for store_name in args.loja or sorted(config.stores):
+            results = {}
+            inicio = time.time()
+            try:
+                yield from dry_run_store(store_name, from_date, to_date, results)
+            except Exception as e:
+                logging.error(f"[{store_name}] Erro no dry-run: {e}")
+                print(f"[{store_name}] Erro no dry-run: {e}")
+            logging.info(f"[{store_name}] Dry-run: {results.get('convertida', 0)} notas seriam enviadas, "
+                         f"{results.get('ignorada', 0)} já tratadas, {results.get('erro', 0)} com erro.")
+            print(f"[{store_name}] Dry-run: {results.get('convertida', 0)} notas seriam enviadas, "
+                  f"{results.get('ignorada', 0)} já tratadas, {results.get('erro', 0)} com erro "
+                  f"({time.time() - inicio:.1f}s).")
+
+    if args.saida:
+        print(f"Payloads gravados em {export_omie_ndjson(payloads(), args.saida)}.")
+    else:
+        for _ in payloads():
+            pass
+    log_metrics_summary()
+
+def iter_invoice_files(paths):
+    """Notas da ZIG lidas de arquivos: XML (uma nota), JSON (uma nota {"xml": ...} ou a lista de uma página)
+    ou NDJSON (.ndjson/.ndjson.gz/.jsonl), o que inclui os segmentos do arquivo de notas."""
+    for path in paths:
+        if path.endswith('.xml'):
+            with open(path, 'r', encoding='utf-8') as f:
+                yield {"xml": f.read()}
+        elif path.endswith(('.ndjson', '.ndjson.gz', '.jsonl')):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            yield from (data if isinstance(data, list) else [data])
+
+def convert_files(args):
+    """Converte notas de arquivos locais, sem ZIG nem Omie (para medir e depurar a conversão)."""
+    invoices = iter_invoice_files(args.entradas)
+    if args.repeticoes > 1:
+        invoices = list(invoices)  # as repetições convertem as mesmas notas de novo
+    tempos = {'leitura_xml': 0.0, 'conversao': 0.0}
+    results = {}
+
+    def count(status):
+        results[status] = results.get(status, 0) + 1
+
+    def payloads():
+        for rodada in range(args.repeticoes):
+            for invoice in invoices:
+                try:
+                    omie_json, parse_seconds, build_seconds = convert_xml_timed(invoice["xml"])
+                    record_conversion_times(args.loja, parse_seconds, build_seconds)
+                    tempos['leitura_xml'] += parse_seconds
+                    tempos['conversao'] += build_seconds
+                    if args.loja:
+                        omie_json = apply_store_fields(args.loja, omie_json, invoice, sequencial=False)
+                except Exception as e:
+                    logging.error(f"Erro ao converter nota: {e}")
+                    count("erro")
+                    continue
+                count("convertida")
+                if rodada == 0:
+                    yield omie_json
+
+    inicio = time.perf_counter()
+    if args.saida:
+        print(f"Payloads gravados em {export_omie_ndjson(payloads(), args.saida)}.")
+    else:
+        for _ in payloads():
+            pass
+    duracao = time.perf_counter() - inicio
+    convertidas = results.get("convertida", 0)
+    print(f"{convertidas} conversões em {duracao:.2f}s ({convertidas / duracao if duracao > 0 else 0:.0f} notas/s), "
+          f"{results.get('erro', 0)} com erro; leitura do XML {tempos['leitura_xml']:.2f}s, "
+          f"montagem do payload {tempos['conversao']:.2f}s.")
+
+def replay_invoices(records, force=False, deadline=None):
+    """Reenvia ao Omie os payloads arquivados, sem consultar a ZIG; retorna a contagem por status.
+
+    Sem `force`, notas que o índice já registra como enviadas ou duplicadas
+    são puladas. Os payloads vão como foram arquivados, com os mesmos
+    números sequenciais.
+    """
+    dedup = get_dedup_store()
+    dedup.load()
+    results = {}
+    for record in records:
+        store_config = config.stores.get(record["loja"])
+        if store_config is None:
+            logging.error(f"[{record['loja']}] Loja fora do cadastro; nota {record['chave']} não reenviada.")
+            status = "erro"
+        else:
+            status = process_omie_invoice(store_config, record["payload"], deadline, force=force)
+        results[status] = results.get(status, 0) + 1
+        metrics.inc('integracao_notas_total', loja=record["loja"], status=status)
+    save_rate_limiters()
+    return results
+
+def _archive_records(args):
+    archive = get_archive()
+    if archive is None:
+        raise SystemExit("Arquivo de notas desligado (ARQUIVO_DIR vazio).")
+    if args.chave or args.nnf:
+        records = []
+        for chave in args.chave or []:
+            records += archive.lookup(chave=chave, store_name=args.loja)
+        for nnf in args.nnf or []:
+            records += archive.lookup(nnf=nnf, serie=args.serie, store_name=args.loja)
+        return records
+    if not (args.loja and args.de):
+        raise SystemExit("Informe --chave, --nnf ou --loja com --de.")
+    from_date = datetime.strptime(args.de, '%Y-%m-%d')
+    to_date = datetime.strptime(args.ate, '%Y-%m-%d') if args.ate else from_date
+    return archive.iter_range(args.loja, from_date, to_date)
+
+def show_archive(args):
+    found = False
+    for record in _archive_records(args):
+        found = True
+        if args.xml:
+            print(record["xml"])
+        elif args.payload:
+            print(json.dumps(record["payload"], ensure_ascii=False, indent=4))
+        else:
+            print(f"{record['loja']}\t{record['chave']}\tnNF {record['nNF']}/{record['serie']}\t"
+                  f"{record['dhEmi']}\t{record['status'] or 'sem status'}")
+    if not found:
+        print("Nenhuma nota encontrada no arquivo.")
+
+def replay(args):
+    results = replay_invoices(_archive_records(args), force=args.forcar)
+    resumo = ", ".join(f"{count} {status}" for status, count in sorted(results.items())) or "nenhuma nota"
+    logging.info(f"Reenvio do arquivo concluído: {resumo}.")
+    print(f"Reenvio do arquivo concluído: {resumo}.")
+
+def reconcile(args):
+    from_date = datetime.strptime(args.de, '%Y-%m-%d')
+    to_date = datetime.strptime(args.ate, '%Y-%m-%d') if args.ate else from_date
+    reports = []
+    for store_name in args.loja or sorted(config.stores):
+        inicio = time.perf_counter()
+        report = reconcile_store(store_name, from_date, to_date, args.fonte, args.tolerancia)
+        logging.info(f"[{store_name}] Conciliação: {report['notas_zig']} notas, "
+                     f"{len(report['problemas'])} com problema, em {time.perf_counter() - inicio:.2f}s.")
+        print_reconciliation(report, args.tolerancia)
+        reports.append(report)
+    if args.saida:
+        write_json_atomic(args.saida, reports)
+        print(f"Conciliação salva em {args.saida}")
+    if any(report["problemas"] for report in reports):
+        sys.exit(1)
+
+def sync_catalogs(args):
+    if not CATALOGO_PRODUTOS:
+        raise SystemExit("Catálogo de produtos desligado (CATALOGO_PRODUTOS=0).")
+    catalogs = refresh_catalogs(args.loja, full=True if args.completo else None, force=True)
+    for app_key, catalog in catalogs.items():
+        print(f"[{catalog.store_config.name}] Catálogo do Omie: {len(catalog.by_code)} códigos e "
+              f"{len(catalog.by_ean)} EANs no índice.")
+
+def export(args):
+    if args.de:
+        payloads = (record["payload"] for record in _archive_records(args))
+    elif args.entradas:
+        payloads = iter_omie_json_files(args.entradas)
+    else:
+        raise SystemExit("Informe os arquivos de entrada ou --loja com --de para ler do arquivo de notas.")
+    if args.formato == 'xlsx':
+        filename = export_omie_xlsx(payloads, args.saida)
+    else:
+        filename = export_omie_ndjson(payloads, args.saida)
+    print(f"Relatório gerado: {filename}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Integração ZIG-Omie")
+    sub = parser.add_subparsers(dest='comando')
+
+    serve_parser = sub.add_parser('serve', help="executa agora e agenda as próximas execuções (padrão)")
+    serve_parser.set_defaults(func=serve)
+
+    backfill_parser = sub.add_parser('backfill', help="reprocessa um período, sem considerar a marca d'água")
+    backfill_parser.add_argument('--de', required=True, help="data inicial (AAAA-MM-DD)")
+    backfill_parser.add_argument('--ate', help="data final (AAAA-MM-DD); padrão: hoje")
+    backfill_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                                 help="loja a reprocessar (pode repetir); padrão: todas")
+    backfill_parser.set_defaults(func=backfill)
+
+    async_parser = sub.add_parser('async', help="executa uma vez, com busca e envio de todas as lojas num event loop")
+    async_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                              help="loja a integrar (pode repetir); padrão: todas")
+    async_parser.set_defaults(func=run_async)
+
+    def profiling_options(p):
+        p.add_argument('--profile', metavar='DIR', help="grava um perfil cProfile por etapa em DIR (<etapa>.prof e .txt)")
+        p.add_argument('--tracemalloc', action='store_true', help="mede a memória com tracemalloc (pico e maiores alocações)")
+
+    profiling_options(backfill_parser)
+    profiling_options(async_parser)
+
+    run_once_parser = sub.add_parser('run-once', help="executa a integração uma vez e sai, sem agendar")
+    run_once_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                                 help="loja a integrar (pode repetir); padrão: todas")
+    run_once_parser.add_argument('--de', help="data inicial (AAAA-MM-DD); padrão: desde a marca d'água")
+    run_once_parser.add_argument('--ate', help="data final (AAAA-MM-DD), junto com --de; padrão: agora")
+    run_once_parser.add_argument('--modo', choices=['paralelo', 'sequencial', 'async'], help="padrão: INTEGRACAO_MODO")
+    profiling_options(run_once_parser)
+    run_once_parser.set_defaults(func=run_once)
+
+    dry_run_parser = sub.add_parser('dry-run', help="busca e converte as notas da ZIG sem enviar ao Omie")
+    dry_run_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                                help="loja a converter (pode repetir); padrão: todas")
+    dry_run_parser.add_argument('--de', help="data inicial (AAAA-MM-DD); padrão: desde a marca d'água")
+    dry_run_parser.add_argument('--ate', help="data final (AAAA-MM-DD), junto com --de; padrão: agora")
+    dry_run_parser.add_argument('--saida', help="grava os payloads que seriam enviados em NDJSON (.gz compacta)")
+    profiling_options(dry_run_parser)
+    dry_run_parser.set_defaults(func=dry_run)
+
+    convert_parser = sub.add_parser('convert', help="converte notas de arquivos XML, JSON ou NDJSON, sem consultar a ZIG nem enviar ao Omie")
+    convert_parser.add_argument('entradas', nargs='+',
+                                help="arquivos .xml, .json (nota ou página da ZIG) ou .ndjson(.gz), como os do arquivo de notas")
+    convert_parser.add_argument('--loja', choices=sorted(config.stores),
+                                help="aplica os campos da loja, inclusive o catálogo de produtos (sem reservar seqCaixa/seqCupom)")
+    convert_parser.add_argument('--saida', help="grava os payloads em NDJSON (.gz compacta)")
+    convert_parser.add_argument('--repeticoes', type=int, default=1, help="converte as notas N vezes (para perfis)")
+    profiling_options(convert_parser)
+    convert_parser.set_defaults(func=convert_files)
+
+    export_parser = sub.add_parser('export', help="gera relatório XLSX ou NDJSON a partir de payloads salvos")
+    export_parser.add_argument('entradas', nargs='*', help="arquivos JSON (um por nota) ou NDJSON")
+    export_parser.add_argument('--formato', choices=['xlsx', 'ndjson'], default='xlsx')
+    export_parser.add_argument('--saida', help="arquivo de saída")
+    export_parser.add_argument('--loja', help="lê os payloads do arquivo de notas desta loja (com --de)")
+    export_parser.add_argument('--de', help="data inicial de emissão (AAAA-MM-DD)")
+    export_parser.add_argument('--ate', help="data final de emissão (AAAA-MM-DD); padrão: --de")
+    export_parser.set_defaults(func=export, chave=None, nnf=None, serie=None)
+
+    def archive_filters(p):
+        p.add_argument('--chave', action='append', help="chave da NF-e (pode repetir)")
+        p.add_argument('--nnf', action='append', help="número da NF (pode repetir)")
+        p.add_argument('--serie', help="série, junto com --nnf")
+        p.add_argument('--loja', help="loja das notas")
+        p.add_argument('--de', help="data inicial de emissão (AAAA-MM-DD), junto com --loja")
+        p.add_argument('--ate', help="data final de emissão (AAAA-MM-DD); padrão: --de")
+
+    arquivo_parser = sub.add_parser('arquivo', help="consulta notas no arquivo local (XML da ZIG e payload enviado)")
+    archive_filters(arquivo_parser)
+    arquivo_parser.add_argument('--xml', action='store_true', help="mostra o XML da ZIG")
+    arquivo_parser.add_argument('--payload', action='store_true', help="mostra o payload enviado ao Omie")
+    arquivo_parser.set_defaults(func=show_archive)
+
+    catalogo_parser = sub.add_parser('catalogo', help="sincroniza o catálogo de produtos do Omie usado no idProduto")
+    catalogo_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                                 help="loja cujo app_key sincronizar (pode repetir); padrão: todas")
+    catalogo_parser.add_argument('--completo', action='store_true', help="recarrega o catálogo inteiro")
+    catalogo_parser.set_defaults(func=sync_catalogs)
+
+    reconcile_parser = sub.add_parser('reconcile', help="concilia as notas da ZIG com os envios registrados ao Omie")
+    reconcile_parser.add_argument('--de', required=True, help="data inicial de emissão (AAAA-MM-DD)")
+    reconcile_parser.add_argument('--ate', help="data final de emissão (AAAA-MM-DD); padrão: --de")
+    reconcile_parser.add_argument('--loja', action='append', choices=sorted(config.stores),
+                                  help="loja a conciliar (pode repetir); padrão: todas")
+    reconcile_parser.add_argument('--fonte', choices=['zig', 'arquivo'], default='zig',
+                                  help="de onde vêm as notas emitidas: API da ZIG ou arquivo local")
+    reconcile_parser.add_argument('--tolerancia', type=float, default=CONCILIACAO_TOLERANCIA,
+                                  help="diferença em R$ aceita por nota e por grupo")
+    reconcile_parser.add_argument('--saida', help="salva o relatório completo em JSON")
+    reconcile_parser.set_defaults(func=reconcile)
+
+    replay_parser = sub.add_parser('replay', help="reenvia ao Omie notas do arquivo local, sem consultar a ZIG")
+    archive_filters(replay_parser)
+    replay_parser.add_argument('--forcar', action='store_true', help="reenvia também as notas já enviadas")
+    replay_parser.set_defaults(func=replay)
+
+    args = parser.parse_args(argv)
+    configure_logging()
+    with profiling(getattr(args, 'profile', None), getattr(args, 'tracemalloc', False), args.comando or 'serve'):
+        getattr(args, 'func', serve)(args)
+
+if __name__ == "__main__":
+    main()
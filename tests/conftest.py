@@ -0,0 +1,65 @@
+import pytest
+
+import integracao
+
+# Singletons do módulo recriados a cada teste, para nenhum estado vazar entre eles
+SINGLETONS = ('_dedup_store', '_work_queue', '_watermark_store', '_sequence_allocator', '_archive', '_coordinator',
+              '_conversion_cache', '_stage_profiler', '_rate_limiter_store', '_page_cursor_store')
+REGISTROS = ('_rate_limiters', '_app_key_semaphores', '_http_sessions', '_endpoint_stats', '_active_runs',
+             '_product_catalogs')
+
+
+@pytest.fixture(autouse=True)
+def estado(tmp_path, monkeypatch):
+    """Banco, arquivos de estado e singletons novos em um diretório temporário para cada teste."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(integracao, 'INTEGRACAO_DB', str(tmp_path / 'integracao.db'))
+    for nome in SINGLETONS:
+        monkeypatch.setattr(integracao, nome, None)
+    for nome in REGISTROS:
+        monkeypatch.setattr(integracao, nome, {})
+    # Sem catálogo, as execuções não chamam o Omie; os testes do catálogo o religam
+    monkeypatch.setattr(integracao, 'CATALOGO_PRODUTOS', False)
+    yield tmp_path
+    for session in integracao._http_sessions.values():
+        session.close()
+
+
+@pytest.fixture
+def loja():
+    return integracao.StoreConfig('teste', 'token', 'rede', 'app-key-teste', 'secret', 'cc', max_envios=1)
+
+
+def make_nota(n):
+    """Payload mínimo do Omie com os campos lidos no envio: MD5, chave, XML e itens."""
+    return {"nfce": {"nfceMd5": f"md5-{n}", "nfceXml": "<nfeProc/>"}, "NFe": {"chNFe": f"{n:044d}", "det": []}}
+
+
+@pytest.fixture
+def nota():
+    return make_nota
+
+
+def make_xml(n, dh_emi='2024-10-23T20:15:30-03:00', itens=2, tpag='03'):
+    """XML de NFC-e da ZIG com os campos lidos na conversão e na conciliação; cada item vale 20,00."""
+    det = ''.join(
+        f'<det nItem="{i}"><prod><cProd>P{i}</cProd><cEAN>SEM GTIN</cEAN><xProd>Cerveja &amp; Cia {i}</xProd>'
+        f'<NCM>22030000</NCM><CFOP>5102</CFOP><uCom>UN</uCom><qCom>2.0000</qCom><vUnCom>10.00</vUnCom>'
+        f'<vProd>20.00</vProd><indTot>1</indTot></prod><imposto><vTotTrib>1.00</vTotTrib></imposto></det>'
+        for i in range(1, itens + 1))
+    total = f'{20 * itens:.2f}'
+    ns = 'http://www.portalfiscal.inf.br/nfe'
+    return (
+        f'<nfeProc xmlns="{ns}" versao="4.00"><NFe xmlns="{ns}"><infNFe Id="NFe3524{n:040d}" versao="4.00">'
+        f'<ide><cUF>35</cUF><mod>65</mod><serie>1</serie><nNF>{n}</nNF><dhEmi>{dh_emi}</dhEmi><tpEmis>1</tpEmis>'
+        f'<tpAmb>1</tpAmb><verProc>ZIG 1.0</verProc></ide>'
+        f'<emit><CNPJ>123</CNPJ><xNome>X</xNome><xFant>COMERCIO DE BAR LTDA</xFant></emit>{det}'
+        f'<total><ICMSTot><vBC>0.00</vBC><vICMS>0.00</vICMS><vProd>{total}</vProd><vDesc>0.00</vDesc>'
+        f'<vNF>{total}</vNF><vTotTrib>{itens:.2f}</vTotTrib></ICMSTot></total>'
+        f'<pag><detPag><tPag>{tpag}</tPag><vPag>{total}</vPag></detPag></pag></infNFe></NFe>'
+        f'<protNFe versao="4.00"><infProt><nProt>135{n:012d}</nProt></infProt></protNFe></nfeProc>')
+
+
+@pytest.fixture
+def xml_nfce():
+    return make_xml
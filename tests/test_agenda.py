@@ -0,0 +1,110 @@
+from datetime import datetime
+
+import pytest
+
+import integracao
+
+
+@pytest.fixture
+def agenda(monkeypatch):
+    monkeypatch.setattr(integracao, 'AGENDA_JITTER', 0)
+    monkeypatch.setattr(integracao, 'AGENDA_MINIMO', 120)
+    monkeypatch.setattr(integracao, 'AGENDA_OCIOSO_MAXIMO', 1000)
+    monkeypatch.setattr(integracao, 'AGENDA_HORARIO', '')
+    return integracao.StoreSchedule()
+
+
+def as_(hora, minuto=0):
+    return datetime(2024, 10, 23, hora, minuto)
+
+
+def test_parse_trading_hours():
+    assert integracao.parse_trading_hours('11:00-15:00, 18:30-03:00') == [(660, 900), (1110, 180)]
+    assert integracao.parse_trading_hours('') == []
+    assert integracao.parse_trading_hours(None) == []
+    for texto in ('11h-15h', '11:00', '25:00-26:00'):
+        with pytest.raises(ValueError):
+            integracao.parse_trading_hours(texto)
+
+
+@pytest.mark.parametrize('horario, agora, espera', [
+    ('', as_(4), 0),
+    ('11:00-15:00', as_(12), 0),
+    ('11:00-15:00', as_(10, 30), 1800),
+    ('11:00-15:00', as_(15), 20 * 3600),
+    ('18:00-03:00', as_(2), 0),  # faixa que passa da meia-noite
+    ('18:00-03:00', as_(23), 0),
+    ('18:00-03:00', as_(3), 15 * 3600),
+    ('11:00-15:00,18:00-23:00', as_(16), 2 * 3600),
+    ('00:00-00:00', as_(8), 0),  # início igual ao fim: o dia todo
+])
+def test_seconds_until_open(horario, agora, espera):
+    assert integracao.seconds_until_open(integracao.parse_trading_hours(horario), agora) == espera
+
+
+def test_idle_runs_double_the_delay_up_to_the_ceiling(agenda, loja):
+    atrasos = [agenda.next_delay(loja, {"ignorada": 5}, as_(12)) for _ in range(5)]
+    assert atrasos == [240, 480, 960, 1000, 1000]
+    assert agenda.next_delay(loja, {"enviada": 1, "ignorada": 5}, as_(12)) == 120
+    assert agenda.next_delay(loja, now=as_(12)) == 120  # sem resultado, o espaçamento não muda
+
+
+def test_closed_store_waits_for_opening_or_its_interval(agenda, loja):
+    loja.horario, loja.intervalo = '18:00-02:00', 3600
+    assert agenda.next_delay(loja, {}, as_(17, 30)) == 1800
+    assert agenda.next_delay(loja, {}, as_(10)) == 3600
+
+
+def test_store_schedule_tracks_webhook_requests(agenda):
+    assert not agenda.request('teste')  # parada: o webhook antecipa o job
+    agenda.started('teste')
+    assert agenda.request('teste')
+    assert agenda.finished('teste')
+    agenda.started('teste')
+    assert not agenda.finished('teste')
+
+
+@pytest.fixture
+def adaptativo(monkeypatch, agenda, loja):
+    monkeypatch.setattr(integracao, 'INTEGRACAO_AGENDAMENTO', 'adaptativo')
+    monkeypatch.setattr(integracao, 'INTEGRACAO_MODO', 'paralelo')
+    monkeypatch.setattr(integracao, '_store_schedule', agenda)
+    monkeypatch.setattr(integracao.config, 'stores', {loja.name: loja})
+    agendadas = []
+    monkeypatch.setattr(integracao, 'schedule_store', lambda store_config, run_now=False, delay=None:
+                        agendadas.append((store_config.name, delay)))
+    return agendadas
+
+
+def test_adaptive_job_schedules_the_next_run(monkeypatch, adaptativo, loja):
+    monkeypatch.setattr(integracao, 'execute_store_integration', lambda store_name: {"enviada": 3})
+    integracao.run_store_job(loja.name)
+    assert adaptativo == [(loja.name, 120)]
+
+
+def test_adaptive_job_reschedules_after_a_failure(monkeypatch, adaptativo, loja, caplog):
+    loja.intervalo = 900
+
+    def falha(store_name):
+        raise KeyError(store_name)
+
+    monkeypatch.setattr(integracao, 'execute_store_integration', falha)
+    integracao.run_store_job(loja.name)
+    assert adaptativo == [(loja.name, 900)]
+    assert "Erro na execução agendada" in caplog.text
+    assert integracao.get_store_schedule().running == set()
+
+
+def test_adaptive_job_runs_again_when_requested_during_the_run(monkeypatch, adaptativo, loja):
+    execucoes = []
+
+    def execute(store_name):
+        execucoes.append(store_name)
+        if len(execucoes) == 1:
+            integracao.get_store_schedule().request(store_name)
+        return {"ignorada": 1}
+
+    monkeypatch.setattr(integracao, 'execute_store_integration', execute)
+    integracao.run_store_job(loja.name)
+    assert execucoes == [loja.name, loja.name]
+    assert adaptativo == [(loja.name, 240)]  # uma execução ociosa registrada pelo resultado somado
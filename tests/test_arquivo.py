@@ -0,0 +1,101 @@
+import gzip
+import html
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import integracao
+
+
+@pytest.fixture
+def arquivo(tmp_path):
+    integracao.get_dedup_store()  # o índice junta o status de notas_processadas
+    return integracao.InvoiceArchive(str(tmp_path / 'arquivo'))
+
+
+def arquiva(arquivo, xml_data, loja='teste'):
+    omie_json = integracao.convert_xml_to_omie_json(xml_data)
+    arquivo.put(loja, xml_data, omie_json, integracao.nfce_dh_emi(xml_data))
+    return omie_json
+
+
+def test_lookup_by_key_and_number_rebuilds_payload(arquivo, xml_nfce):
+    xml_data = xml_nfce(7)
+    omie_json = arquiva(arquivo, xml_data)
+    arquiva(arquivo, xml_nfce(8))
+
+    [por_chave] = arquivo.lookup(chave=omie_json["NFe"]["chNFe"])
+    [por_numero] = arquivo.lookup(nnf=7, serie=1, store_name='teste')
+    assert por_chave == por_numero
+    assert por_chave["xml"] == xml_data
+    assert por_chave["payload"] == omie_json  # nfceXml refeito do XML da ZIG
+    assert por_chave["payload"]["nfce"]["nfceXml"] == html.unescape(xml_data)
+    assert por_chave["status"] is None
+    assert arquivo.lookup(nnf=7, store_name='outra') == []
+    assert arquivo.lookup() == []
+
+
+def test_status_comes_from_the_dedup_index(arquivo, xml_nfce):
+    omie_json = arquiva(arquivo, xml_nfce(7))
+    integracao.get_dedup_store().mark(omie_json["nfce"]["nfceMd5"], "enviada", omie_json["NFe"]["chNFe"], 'teste')
+    assert arquivo.lookup(nnf=7)[0]["status"] == "enviada"
+
+
+def test_segments_are_daily_and_readable_as_plain_gzip(arquivo, xml_nfce):
+    arquiva(arquivo, xml_nfce(1, '2024-10-23T10:00:00-03:00'))
+    arquiva(arquivo, xml_nfce(2, '2024-10-23T11:00:00-03:00'))
+    arquiva(arquivo, xml_nfce(3, '2024-10-24T09:00:00-03:00'))
+
+    segmento = os.path.join(arquivo.directory, 'teste', '2024-10-23.ndjson.gz')
+    with gzip.open(segmento, 'rt', encoding='utf-8') as f:
+        assert [json.loads(line)["nNF"] for line in f] == ['1', '2']
+
+    dia = datetime(2024, 10, 23)
+    assert [r["nNF"] for r in arquivo.iter_range('teste', dia, dia)] == ['1', '2']
+    assert [r["nNF"] for r in arquivo.iter_range('teste', dia, dia + timedelta(days=1))] == ['1', '2', '3']
+    assert list(arquivo.iter_range('outra', dia, dia)) == []
+
+
+def test_rewriting_a_note_points_the_index_at_the_new_copy(arquivo, xml_nfce):
+    arquiva(arquivo, xml_nfce(7))
+    arquiva(arquivo, xml_nfce(7))
+    assert len(arquivo.lookup(nnf=7)) == 1
+
+
+def test_compact_removes_segments_older_than_retention(arquivo, xml_nfce):
+    antigo = (datetime.now() - timedelta(days=10)).strftime('%Y-%m-%dT10:00:00-03:00')
+    recente = datetime.now().strftime('%Y-%m-%dT10:00:00-03:00')
+    arquiva(arquivo, xml_nfce(1, antigo))
+    arquiva(arquivo, xml_nfce(2, recente))
+
+    assert arquivo.compact(retention_days=0) == 0  # 0 = guarda para sempre
+    assert arquivo.compact(retention_days=5) == 1
+    assert arquivo.lookup(nnf=1) == []
+    assert [r["nNF"] for r in arquivo.lookup(nnf=2)] == ['2']
+    assert os.listdir(os.path.join(arquivo.directory, 'teste')) == [f"{datetime.now():%Y-%m-%d}.ndjson.gz"]
+
+
+def test_archive_invoice_is_off_without_directory(monkeypatch, xml_nfce):
+    monkeypatch.setattr(integracao, 'ARQUIVO_DIR', '')
+    assert integracao.get_archive() is None
+    xml_data = xml_nfce(1)
+    integracao.archive_invoice('teste', {"xml": xml_data}, integracao.convert_xml_to_omie_json(xml_data))
+
+
+def test_replay_sends_archived_payloads_of_known_stores(monkeypatch, arquivo, loja, xml_nfce):
+    omie_json = arquiva(arquivo, xml_nfce(7))
+    arquiva(arquivo, xml_nfce(8), loja='fora-do-cadastro')
+    monkeypatch.setattr(integracao.config, 'stores', {loja.name: loja})
+    enviados = []
+
+    def process(store_config, payload, deadline=None, force=False):
+        enviados.append((store_config.name, payload, force))
+        return "enviada"
+
+    monkeypatch.setattr(integracao, 'process_omie_invoice', process)
+    dia = datetime(2024, 10, 23)
+    registros = list(arquivo.iter_range('teste', dia, dia)) + list(arquivo.iter_range('fora-do-cadastro', dia, dia))
+    assert integracao.replay_invoices(registros, force=True) == {"enviada": 1, "erro": 1}
+    assert enviados == [('teste', omie_json, True)]
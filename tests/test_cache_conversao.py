@@ -0,0 +1,90 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import integracao
+
+
+def payload(n, tamanho=10):
+    return {"NFe": {"nNF": str(n), "det": ["x" * tamanho]}}
+
+
+def tamanho(omie_json):
+    return len(json.dumps(omie_json, ensure_ascii=False))
+
+
+def test_get_returns_a_fresh_copy():
+    cache = integracao.ConversionCache(10_000)
+    cache.put('a', payload(1))
+    copia = cache.get('a')
+    copia["NFe"]["nNF"] = "alterado"  # apply_store_fields altera o payload devolvido
+    assert cache.get('a') == payload(1)
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_memory_is_lru_bounded_by_size():
+    cache = integracao.ConversionCache(2 * tamanho(payload(1)))
+    cache.put('a', payload(1))
+    cache.put('b', payload(2))
+    cache.get('a')  # 'b' passa a ser o menos usado
+    cache.put('c', payload(3))
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.size == 2 * tamanho(payload(1))
+    cache.put('grande', payload(4, tamanho=1000))  # maior que o cache inteiro: não entra
+    assert 'grande' not in cache.entries and list(cache.entries) == ['a', 'c']
+
+
+def test_disk_cache_survives_a_new_instance(tmp_path):
+    banco = str(tmp_path / 'cache.db')
+    integracao.ConversionCache(10_000, disk=True, path=banco).put('a', payload(1))
+    cache = integracao.ConversionCache(10_000, disk=True, path=banco)
+    assert cache.get('a') == payload(1)
+    assert cache.get('a') == payload(1)
+    assert (cache.hits, cache.disk_hits) == (1, 1)  # a segunda leitura já vem da memória
+
+
+def test_compact_drops_disk_entries_unused_for_the_retention(monkeypatch, tmp_path):
+    cache = integracao.ConversionCache(10_000, disk=True, path=str(tmp_path / 'cache.db'))
+    agora = integracao.time.time()
+    monkeypatch.setattr(integracao.time, 'time', lambda: agora - 10 * 86400)
+    cache.put('antigo', payload(1))
+    monkeypatch.setattr(integracao.time, 'time', lambda: agora)
+    cache.put('recente', payload(2))
+    assert cache.compact(retention_days=7) == 1
+    assert integracao.ConversionCache(10_000, disk=True, path=str(tmp_path / 'cache.db')).get('antigo') is None
+    assert integracao.ConversionCache(0).compact() == 0  # só memória: nada a compactar
+
+
+@pytest.fixture
+def conversoes(monkeypatch):
+    conversoes = []
+    timed = integracao.convert_xml_timed
+    monkeypatch.setattr(integracao, 'convert_xml_timed', lambda xml_data: conversoes.append(xml_data) or timed(xml_data))
+    return conversoes
+
+
+def test_convert_xml_cached_converts_each_xml_once(conversoes, xml_nfce):
+    primeira = integracao.convert_xml_cached(xml_nfce(1))
+    assert integracao.convert_xml_cached(xml_nfce(1)) == primeira
+    integracao.convert_xml_cached(xml_nfce(2))
+    assert conversoes == [xml_nfce(1), xml_nfce(2)]
+
+
+def test_cache_can_be_disabled(monkeypatch, conversoes, xml_nfce):
+    monkeypatch.setattr(integracao, 'CACHE_CONVERSAO_MB', 0)
+    assert integracao.get_conversion_cache() is None
+    integracao.convert_xml_cached(xml_nfce(1))
+    integracao.convert_xml_cached(xml_nfce(1))
+    assert len(conversoes) == 2
+
+
+def test_pooled_conversion_uses_the_cache(monkeypatch, conversoes, xml_nfce):
+    with ThreadPoolExecutor(2) as pool:
+        monkeypatch.setattr(integracao, 'get_conversion_pool', lambda: pool)
+        itens = [(1, {"xml": xml_nfce(1)}), (1, {"xml": xml_nfce(2)}), (1, {"xml": xml_nfce(1)}), (1, None)]
+        primeira = list(integracao.convert_invoices(itens[:2]))
+        segunda = list(integracao.convert_invoices(itens))
+    assert sorted(conversoes) == [xml_nfce(1), xml_nfce(2)]
+    assert [r for _, _, r in segunda] == [primeira[0][2], primeira[1][2], primeira[0][2], None]
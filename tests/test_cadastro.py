@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+import integracao
+
+LOJA = {"zig_token": "token", "zig_rede": "rede", "omie_app_key": "app-key", "omie_app_secret": "secret"}
+
+
+def grava(path, data):
+    path.write_text(json.dumps(data))
+    # mtime_ns pode não mudar entre duas gravações seguidas; o tamanho nem sempre muda
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+@pytest.fixture
+def cadastro(tmp_path):
+    return tmp_path / 'lojas.json'
+
+
+def test_store_from_dict_resolves_env_and_defaults(monkeypatch):
+    monkeypatch.setenv('TOKEN_TESTE', 'do-ambiente')
+    loja = integracao.store_from_dict('a', dict(LOJA, zig_token='env:TOKEN_TESTE', intervalo=60))
+    assert loja.zig_token == 'do-ambiente'
+    assert loja.intervalo == 60
+    assert loja.max_envios == integracao.LOJA_MAX_ENVIOS
+
+
+@pytest.mark.parametrize('data', [
+    'texto',
+    {k: v for k, v in LOJA.items() if k != 'omie_app_key'},
+    dict(LOJA, intervalo=0),
+    dict(LOJA, intervalo='300'),
+    dict(LOJA, max_envios=True),
+    dict(LOJA, max_envios=-1),
+    dict(LOJA, horario='25:00-26:00'),
+], ids=['nao-objeto', 'campo-ausente', 'intervalo-zero', 'intervalo-texto', 'max-envios-bool', 'max-envios-negativo',
+        'horario'])
+def test_store_from_dict_rejects_invalid_entries(data):
+    with pytest.raises(ValueError):
+        integracao.store_from_dict('a', data)
+
+
+def test_initial_load_skips_invalid_and_inactive_stores(cadastro):
+    grava(cadastro, {'a': LOJA, 'b': 'texto', 'c': dict(LOJA, max_envios=0), 'd': dict(LOJA, ativa=False)})
+    assert sorted(integracao.Config(str(cadastro)).stores) == ['a']
+
+
+def test_store_directory_uses_file_name_or_nome(tmp_path):
+    (tmp_path / 'lojas.d').mkdir()
+    grava(tmp_path / 'lojas.d' / 'a.json', LOJA)
+    grava(tmp_path / 'lojas.d' / 'b.json', dict(LOJA, nome='outra'))
+    grava(tmp_path / 'lojas.d' / 'c.json', [LOJA])
+    assert sorted(integracao.Config(str(tmp_path / 'lojas.d')).stores) == ['a', 'outra']
+
+
+def test_reload_reports_added_removed_and_changed(cadastro):
+    grava(cadastro, {'a': LOJA, 'b': LOJA})
+    config = integracao.Config(str(cadastro))
+    assert config.reload() == (set(), set(), set())
+    antigo = config.stores
+    grava(cadastro, {'a': dict(LOJA, intervalo=60), 'c': LOJA})
+    assert config.reload() == ({'c'}, {'b'}, {'a'})
+    assert config.stores['a'].intervalo == 60
+    assert sorted(antigo) == ['a', 'b']  # quem tinha o dicionário antigo continua com ele
+
+
+@pytest.mark.parametrize('conteudo', ['{"a": ', [LOJA], {'a': LOJA, 'b': dict(LOJA, intervalo=-5)}, {'a': LOJA, 'b': 1}],
+                         ids=['sintaxe', 'lista', 'intervalo-negativo', 'loja-nao-objeto'])
+def test_invalid_reload_keeps_current_stores(cadastro, conteudo):
+    grava(cadastro, {'a': LOJA})
+    config = integracao.Config(str(cadastro))
+    if isinstance(conteudo, str):
+        cadastro.write_text(conteudo)
+    else:
+        grava(cadastro, conteudo)
+    assert config.reload() == (set(), set(), set())
+    assert sorted(config.stores) == ['a']
+
+
+def test_reload_ignores_file_replaced_during_the_check(cadastro, tmp_path, monkeypatch):
+    grava(cadastro, {'a': LOJA})
+    config = integracao.Config(str(cadastro))
+    # Listado e removido antes do os.stat
+    monkeypatch.setattr(config, '_files', lambda: [str(cadastro), str(tmp_path / 'sumiu.json')])
+    assert config.reload() == (set(), set(), set())
+    assert sorted(config.stores) == ['a']
+
+
+def test_removed_registry_keeps_current_stores(cadastro):
+    grava(cadastro, {'a': LOJA})
+    config = integracao.Config(str(cadastro))
+    cadastro.unlink()
+    assert config.reload() == (set(), set(), set())
+    assert sorted(config.stores) == ['a']
+    grava(cadastro, {'b': LOJA})
+    assert config.reload() == ({'b'}, {'a'}, set())
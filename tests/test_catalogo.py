@@ -0,0 +1,129 @@
+import pytest
+
+import integracao
+
+
+class Omie:
+    """ListarProdutos falso: `produtos` é o cadastro; registra os filtros de cada chamada."""
+
+    def __init__(self, produtos, por_pagina=2):
+        self.produtos = produtos
+        self.por_pagina = por_pagina
+        self.chamadas = []
+        self.falha = None
+
+    def __call__(self, store_config, url, call, param, stage, deadline=None):
+        assert call == "ListarProdutos"
+        [filtros] = param
+        self.chamadas.append(filtros)
+        if self.falha is not None:
+            raise self.falha
+        produtos = self.produtos
+        if "produtosPorCodigo" in filtros:
+            codigos = {item["codigo"] for item in filtros["produtosPorCodigo"]}
+            produtos = [p for p in produtos if p["codigo"] in codigos]
+        if not produtos:
+            return Resposta(), {"faultcode": "SOAP-ENV:Client-5113", "faultstring": "Não existem registros"}
+        paginas = [produtos[i:i + self.por_pagina] for i in range(0, len(produtos), self.por_pagina)]
+        return Resposta(), {"total_de_paginas": len(paginas),
+                            "produto_servico_cadastro": paginas[filtros["pagina"] - 1]}
+
+
+class Resposta:
+    status_code = 200
+
+
+def produto(id_produto, codigo, ean="", **campos):
+    return dict(codigo_produto=id_produto, codigo=codigo, codigo_produto_integracao="", ean=ean, **campos)
+
+
+@pytest.fixture
+def omie(monkeypatch):
+    monkeypatch.setattr(integracao, 'CATALOGO_PRODUTOS', True)
+    fake = Omie([produto(1, "P1"), produto(2, "P2", ean="7890000000002"), produto(3, "P3")])
+    monkeypatch.setattr(integracao, 'call_omie', fake)
+    return fake
+
+
+@pytest.fixture
+def catalogo(omie, loja):
+    return integracao.get_product_catalog(loja)
+
+
+def test_full_sync_resolves_by_code_then_ean(catalogo, omie):
+    assert catalogo.refresh() == 3
+    assert [c["pagina"] for c in omie.chamadas] == [1, 2]
+    assert catalogo.resolve([("P1", ""), ("X", "7890000000002"), ("X", "SEM GTIN"), ("", "")]) == [1, 2, None, None]
+
+
+def test_catalog_survives_a_new_instance(catalogo, loja):
+    catalogo.refresh()
+    assert integracao.ProductCatalog(loja).resolve([("P3", "")]) == [3]
+
+
+def test_refresh_only_syncs_when_due(catalogo, omie):
+    catalogo.refresh()
+    omie.chamadas.clear()
+    assert catalogo.refresh() == 0
+    assert omie.chamadas == []
+    catalogo.next_sync = 0
+    catalogo.refresh()
+    assert omie.chamadas[0]["filtrar_apenas_alteracao"] == "S"  # incremental depois da carga completa
+
+
+def test_full_sync_drops_inactive_and_removed_products(catalogo, omie):
+    catalogo.refresh()
+    omie.produtos = [produto(1, "P1"), produto(2, "P2", inativo="S")]
+    catalogo.refresh(full=True)
+    assert catalogo.resolve([("P1", ""), ("P2", ""), ("P3", "")]) == [1, None, None]
+
+
+def test_unknown_codes_are_queried_once(catalogo, omie):
+    catalogo.refresh()
+    omie.produtos.append(produto(4, "P4"))
+    assert catalogo.resolve([("P4", ""), ("P9", "")]) == [None, None]
+    omie.chamadas.clear()
+    catalogo.refresh()
+    assert [{i["codigo"] for i in c["produtosPorCodigo"]} for c in omie.chamadas] == [{"P4", "P9"}]
+    assert catalogo.resolve([("P4", ""), ("P9", "")]) == [4, None]
+    omie.chamadas.clear()
+    catalogo.refresh()
+    assert omie.chamadas == []  # P9 só volta a ser consultado depois de CATALOGO_AUSENTE_TTL
+
+
+def test_failed_sync_keeps_the_stored_catalog(catalogo, omie, caplog):
+    catalogo.refresh()
+    omie.falha = ConnectionError("Omie fora do ar")
+    assert catalogo.refresh(force=True) == 0
+    assert catalogo.resolve([("P1", "")]) == [1]
+    assert "Omie fora do ar" in caplog.text
+
+
+def test_refresh_without_wait_skips_when_another_is_running(catalogo, omie):
+    catalogo.sync_lock.acquire()
+    try:
+        assert catalogo.refresh(wait=False) == 0
+    finally:
+        catalogo.sync_lock.release()
+    assert omie.chamadas == []
+
+
+def test_store_run_refresh_is_short_and_never_raises(monkeypatch, catalogo, loja):
+    prazos = []
+    monkeypatch.setattr(integracao, 'CATALOGO_TIMEOUT_LOJA', 0.5)
+
+    def refresh(deadline=None, full=None, force=False, wait=True):
+        prazos.append((deadline.remaining() <= 0.5, wait))
+        raise RuntimeError("banco travado")
+
+    monkeypatch.setattr(catalogo, 'refresh', refresh)
+    integracao.refresh_store_catalog(loja)
+    assert prazos == [(True, False)]
+
+
+def test_resolve_products_falls_back_to_default_id(catalogo, loja, xml_nfce):
+    catalogo.refresh()
+    omie_json = integracao.convert_xml_to_omie_json(xml_nfce(1, itens=2))
+    omie_json["NFe"]["det"][1]["prod"]["cProd"] = "P9"
+    integracao.resolve_products(loja, omie_json)
+    assert [det["prodIdent"]["idProduto"] for det in omie_json["NFe"]["det"]] == [1, integracao.OMIE_ID_PRODUTO_PADRAO]
@@ -0,0 +1,73 @@
+import re
+from datetime import datetime
+
+import pytest
+
+import integracao
+
+
+def com_prefixo(xml_data):
+    """O mesmo XML com prefixo de namespace em todas as tags (fora do padrão das regexes)."""
+    return re.sub(r'<(/?)', r'<\1nfe:', xml_data).replace('xmlns=', 'xmlns:nfe=')
+
+
+def test_row_reads_fields_without_parsing(monkeypatch, xml_nfce):
+    xml_data = xml_nfce(7, itens=3, tpag='04').replace('<vDesc>0.00</vDesc>', '<vDesc>1.50</vDesc>')
+    monkeypatch.setattr(integracao, 'parse_nfe_record', lambda xml_data: pytest.fail("não devia ler o XML inteiro"))
+    assert integracao.reconciliation_row(xml_data, 'md5') == (
+        f"3524{7:040d}", 'md5', '7', '2024-10-23T20:15:30-03:00', 'CRD', 60.0, 1.5,
+        [('5102', '22030000', 20.0)] * 3)
+
+
+def test_row_matches_the_full_parser(monkeypatch, xml_nfce):
+    xml_data = xml_nfce(7, itens=2)
+    rapida = integracao.reconciliation_row(xml_data)
+    chamadas = []
+    parse = integracao.parse_nfe_record
+    monkeypatch.setattr(integracao, 'parse_nfe_record', lambda xml_data: chamadas.append(1) or parse(xml_data))
+    assert integracao.reconciliation_row(com_prefixo(xml_data), rapida[1]) == rapida
+    assert chamadas == [1]
+
+
+def test_row_defaults_for_missing_discount_and_payment(xml_nfce):
+    xml_data = re.sub(r'<pag>.*</pag>', '', xml_nfce(1).replace('<vDesc>0.00</vDesc>', ''))
+    row = integracao.reconciliation_row(xml_data)
+    assert row[4:7] == ('99999', 40.0, 0.0)
+
+
+def test_row_ignores_vprod_and_vdesc_outside_items_and_totals(xml_nfce):
+    # vProd/vDesc do ICMSTot não contam como item; vDesc de item não é o desconto da nota
+    xml_data = xml_nfce(1, itens=1).replace('<vProd>20.00</vProd><indTot>',
+                                             '<vProd>20.00</vProd><vDesc>5.00</vDesc><indTot>')
+    row = integracao.reconciliation_row(xml_data)
+    assert row[6] == 0.0
+    assert row[7] == [('5102', '22030000', 20.0)]
+
+
+def test_row_matches_the_sent_payload(xml_nfce):
+    xml_data = xml_nfce(3)
+    zig = integracao.reconciliation_row(xml_data)
+    enviado = integracao.payload_row(integracao.convert_xml_to_omie_json(xml_data), zig[3])
+    assert zig == enviado
+    assert integracao._row_differences(zig, enviado, 0.01) == []
+
+
+def test_reconcile_store_from_archive(monkeypatch, loja, xml_nfce):
+    monkeypatch.setattr(integracao.config, 'stores', {loja.name: loja})
+    arquivo, dedup = integracao.get_archive(), integracao.get_dedup_store()
+    for n in (1, 2, 3):
+        xml_data = xml_nfce(n)
+        omie_json = integracao.convert_xml_to_omie_json(xml_data)
+        if n == 3:
+            omie_json["NFe"]["total"]["vCF"] = "35.00"
+        arquivo.put(loja.name, xml_data, omie_json, integracao.nfce_dh_emi(xml_data))
+        if n != 2:
+            dedup.mark(omie_json["nfce"]["nfceMd5"], "enviada", omie_json["NFe"]["chNFe"], loja.name)
+
+    dia = datetime(2024, 10, 23)
+    report = integracao.reconcile_store(loja.name, dia, dia, source='arquivo')
+    assert (report["notas_zig"], report["notas_omie"]) == (3, 2)
+    assert (report["total_zig"], report["total_omie"]) == (120.0, 75.0)
+    assert report["totais"]["tpag"] == {"CRC": {"zig": 120.0, "omie": 75.0, "diferenca": 45.0}}
+    problemas = {p["nNF"]: p["problema"] for p in report["problemas"]}
+    assert problemas == {'2': "nao_enviada", '3': "divergente"}
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import integracao
+
+
+def test_coordinator_splits_stores_without_overlap():
+    lojas = ['a', 'b', 'c', 'd', 'e']
+    primeiro = integracao.ShardCoordinator('primeiro')
+    segundo = integracao.ShardCoordinator('segundo')
+    assert primeiro.rebalance(lojas) == set(lojas)
+    assert segundo.rebalance(lojas) == set()  # tudo ainda concedido ao primeiro
+
+    # Na renovação o primeiro devolve o excedente da parte justa, que o segundo assume
+    detidas = primeiro.rebalance(lojas)
+    assert len(detidas) == 3
+    assert segundo.rebalance(lojas) == set(lojas) - detidas
+    assert primeiro.owns(sorted(detidas)[0]) and not segundo.owns(sorted(detidas)[0])
+
+
+def test_coordinator_keeps_busy_stores_and_hands_over_on_stop():
+    lojas = ['a', 'b', 'c', 'd']
+    primeiro = integracao.ShardCoordinator('primeiro')
+    segundo = integracao.ShardCoordinator('segundo')
+    primeiro.rebalance(lojas)
+    segundo.rebalance(lojas)
+    assert primeiro.rebalance(lojas, busy=lojas) == set(lojas)  # lojas em execução não são devolvidas
+
+    primeiro.stop()
+    assert not primeiro.owns('a')
+    assert segundo.rebalance(lojas) == set(lojas)
+
+
+def test_coordinator_takes_over_expired_leases(monkeypatch):
+    lojas = ['a', 'b']
+    primeiro = integracao.ShardCoordinator('primeiro')
+    primeiro.rebalance(lojas)
+    agora = integracao.time.time()
+    monkeypatch.setattr(integracao.time, 'time', lambda: agora + integracao.CONCESSAO_DURACAO + 1)
+    assert not primeiro.owns('a')
+    assert integracao.ShardCoordinator('segundo').rebalance(lojas) == set(lojas)
+
+
+def test_page_cursors_of_replicas_do_not_overwrite_each_other():
+    inicio, fim = datetime(2024, 10, 23), datetime(2024, 10, 24)
+    integracao.PageCursorStore().save('a', integracao._cursor_key(inicio, fim), 3)
+    integracao.PageCursorStore().save('b', integracao._cursor_key(inicio, fim), 5)
+    assert integracao.load_page_cursor('a', inicio, fim) == 3
+    assert integracao.load_page_cursor('b', inicio, fim) == 5
+    assert integracao.load_page_cursor('a', inicio, datetime(2024, 10, 25)) == 1  # outro período
+    integracao.clear_page_cursor('a')
+    assert integracao.load_page_cursor('a', inicio, fim) == 1
+    assert integracao.load_page_cursor('b', inicio, fim) == 5
+
+
+def test_rate_limiter_state_is_shared_per_app_key():
+    estado = {'rate': 1.5, 'tokens': 2.0, 'updated': 100.0, 'blocked_until': 500.0}
+    integracao.RateLimiterStore().save({'app-a': estado})
+    integracao.RateLimiterStore().save({'app-b': dict(estado, rate=0.5)})
+    integracao.RateLimiterStore().save({'app-a': dict(estado, tokens=1.0, blocked_until=200.0)})
+
+    store = integracao.get_rate_limiter_store()
+    assert store.load('app-a') == dict(estado, tokens=1.0)  # o bloqueio mais longo prevalece
+    assert store.load('app-b')['rate'] == 0.5
+    assert store.load('app-c') is None
+
+
+def test_save_rate_limiters_round_trip(monkeypatch):
+    limiter = integracao.get_rate_limiter('app-a')
+    limiter.on_throttle(30)
+    integracao.save_rate_limiters()
+    monkeypatch.setattr(integracao, '_rate_limiters', {})
+    retomado = integracao.get_rate_limiter('app-a')
+    assert retomado.rate == limiter.rate
+    assert retomado.blocked_until == limiter.blocked_until
@@ -0,0 +1,56 @@
+import integracao
+
+
+def test_dedup_mark_is_idempotent():
+    dedup = integracao.get_dedup_store()
+    dedup.mark('md5-1', 'enviada', 'chave-1', 'teste')
+    dedup.mark('md5-1', 'enviada', 'chave-1', 'teste')
+    assert dedup.seen('md5-1') == 'enviada'
+    assert dedup.seen(chave='chave-1') == 'enviada'
+    assert dedup.conn.execute('SELECT COUNT(*) FROM notas_processadas').fetchone()[0] == 1
+
+
+def test_dedup_only_final_statuses_are_seen_after_load():
+    dedup = integracao.get_dedup_store()
+    dedup.mark('md5-1', 'pendente', 'chave-1', 'teste')
+    dedup.mark('md5-2', 'pendente', 'chave-2', 'teste')
+    dedup.mark('md5-2', 'duplicada', 'chave-2', 'teste')
+    dedup.mark('md5-3', 'erro', None, 'teste')
+
+    # Outro processo no mesmo banco enxerga só as notas com status final
+    outro = integracao.DedupStore()
+    outro.load()
+    assert outro.seen('md5-1', 'chave-1') is None
+    assert outro.seen('md5-2') == 'duplicada'
+    assert outro.seen('outro-md5', 'chave-2') == 'duplicada'
+    assert outro.seen('md5-3') is None
+
+
+def test_dedup_keeps_chave_when_marked_without_it():
+    dedup = integracao.get_dedup_store()
+    dedup.mark('md5-1', 'pendente', 'chave-1', 'teste')
+    dedup.mark('md5-1', 'enviada')
+    assert dedup.statuses('teste') == ({'md5-1': 'enviada'}, {'chave-1': 'enviada'})
+
+
+def test_dedup_imports_legacy_file_once(estado):
+    (estado / integracao.LEGACY_MD5_FILE).write_text('md5-a\nmd5-b\n\n')
+    dedup = integracao.DedupStore()
+    dedup.load()
+    assert dedup.seen('md5-a') == dedup.seen('md5-b') == 'enviada'
+
+    (estado / integracao.LEGACY_MD5_FILE).write_text('md5-c\n')
+    outro = integracao.DedupStore()
+    outro.load()
+    assert outro.seen('md5-c') is None
+
+
+def test_dedup_compact_removes_only_old_records(monkeypatch):
+    dedup = integracao.get_dedup_store()
+    agora = integracao.time.time()
+    monkeypatch.setattr(integracao.time, 'time', lambda: agora - 10 * 86400)
+    dedup.mark('md5-antiga', 'enviada')
+    monkeypatch.setattr(integracao.time, 'time', lambda: agora)
+    dedup.mark('md5-nova', 'enviada')
+    assert dedup.compact(retention_days=5) == 1
+    assert dedup.statuses('teste')[0] == {'md5-nova': 'enviada'}
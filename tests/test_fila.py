@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import integracao
+
+
+def test_work_queue_replays_pending_after_restart(nota):
+    fila = integracao.get_work_queue()
+    dh_emi = datetime(2024, 10, 23, 12, 30)
+    for n in range(3):
+        fila.enqueue('teste', nota(n), dh_emi + timedelta(minutes=n))
+    fila.enqueue('teste', nota(0), dh_emi)  # reenfileirar não duplica
+    fila.enqueue('outra', nota(9))
+    fila.finish('md5-1', 'enviada')
+
+    # Nova instância, como depois de uma queda: as pendentes voltam na ordem de entrada
+    fila = integracao.WorkQueue()
+    assert fila.pending_md5s('teste') == ['md5-0', 'md5-2']
+    assert list(fila.iter_pending('teste')) == [(dh_emi, nota(0)), (dh_emi + timedelta(minutes=2), nota(2))]
+
+
+def test_work_queue_gives_up_after_max_attempts(monkeypatch, nota):
+    monkeypatch.setattr(integracao, 'FILA_MAX_TENTATIVAS', 2)
+    fila = integracao.get_work_queue()
+    fila.enqueue('teste', nota(1))
+    fila.finish('md5-1', 'erro')
+    assert fila.pending_md5s('teste') == ['md5-1']
+    fila.finish('md5-1', 'interrompida')  # prazo esgotado não conta como tentativa
+    fila.finish('md5-1', 'erro')
+    assert fila.pending_md5s('teste') == []
+    assert fila.conn.execute("SELECT status, tentativas FROM fila_envio").fetchone() == ('erro', 2)
+
+
+def test_pipeline_resends_queued_notes_first_and_once(monkeypatch, loja, nota):
+    fila = integracao.get_work_queue()
+    for n in range(3):
+        fila.enqueue(loja.name, nota(n))
+    enviadas = []
+
+    def process_omie_invoice(store_config, omie_json, deadline=None):
+        enviadas.append(omie_json["nfce"]["nfceMd5"])
+        return "erro" if omie_json["nfce"]["nfceMd5"] == 'md5-1' else "enviada"
+
+    monkeypatch.setattr(integracao, 'process_omie_invoice', process_omie_invoice)
+    results = integracao.run_store_pipeline(loja, iter([]))
+    assert enviadas == ['md5-0', 'md5-1', 'md5-2']
+    assert results == {'enviada': 2, 'erro': 1}
+    assert fila.pending_md5s(loja.name) == ['md5-1']
+
+    enviadas.clear()
+    integracao.run_store_pipeline(loja, iter([]))
+    assert enviadas == ['md5-1']
+
+
+class Resposta:
+    status_code = 200
+    text = ''
+
+
+def omie_falso(monkeypatch, resposta):
+    def post_omie_nfce(store_config, param, deadline=None):
+        if isinstance(resposta, Exception):
+            raise resposta
+        return Resposta(), resposta
+    monkeypatch.setattr(integracao, 'post_omie_nfce', post_omie_nfce)
+
+
+def test_forced_resend_failure_keeps_enviada(monkeypatch, loja, nota):
+    dedup = integracao.get_dedup_store()
+    dedup.mark('md5-1', 'enviada', nota(1)["NFe"]["chNFe"], loja.name)
+    omie_falso(monkeypatch, Exception("conexão recusada"))
+    assert integracao.process_omie_invoice(loja, nota(1), force=True) == "erro"
+    omie_falso(monkeypatch, TimeoutError("Operation timed out."))
+    assert integracao.process_omie_invoice(loja, nota(1), force=True) == "interrompida"
+    assert dedup.statuses(loja.name)[0] == {'md5-1': 'enviada'}
+
+
+def test_forced_resend_of_sent_note_reported_duplicate_keeps_enviada(monkeypatch, loja, nota):
+    dedup = integracao.get_dedup_store()
+    dedup.mark('md5-1', 'enviada', nota(1)["NFe"]["chNFe"], loja.name)
+    omie_falso(monkeypatch, {"faultcode": "SOAP-ENV:Client-3333", "faultstring": "Cupom já cadastrado"})
+    assert integracao.process_omie_invoice(loja, nota(1), force=True) == "duplicada"
+    assert dedup.statuses(loja.name)[0] == {'md5-1': 'enviada'}
+
+
+def test_send_failure_of_new_note_is_recorded(monkeypatch, loja, nota):
+    omie_falso(monkeypatch, Exception("conexão recusada"))
+    assert integracao.process_omie_invoice(loja, nota(1)) == "erro"
+    assert integracao.get_dedup_store().statuses(loja.name)[0] == {'md5-1': 'erro'}
+    assert integracao.process_omie_invoice(loja, nota(1), force=True) == "erro"
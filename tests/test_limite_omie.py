@@ -0,0 +1,110 @@
+import pytest
+
+import integracao
+
+
+class Relogio:
+    """time.time/time.sleep falsos: dormir só avança o relógio."""
+
+    def __init__(self, agora=1000.0):
+        self.agora = agora
+        self.esperas = []
+
+    def time(self):
+        return self.agora
+
+    def sleep(self, segundos):
+        self.esperas.append(segundos)
+        self.agora += segundos
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    relogio = Relogio()
+    monkeypatch.setattr(integracao.time, 'time', relogio.time)
+    monkeypatch.setattr(integracao.time, 'sleep', relogio.sleep)
+    return relogio
+
+
+class Resposta:
+    def __init__(self, status_code=200, dados=None, headers=None):
+        self.status_code = status_code
+        self.dados = dados or {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.dados
+
+
+def test_burst_then_paced_by_rate(relogio):
+    limiter = integracao.OmieRateLimiter('app', taxa_maxima=2, rajada=3)
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0]
+    assert limiter.reserve() == pytest.approx(0.5)
+    relogio.agora += 0.5
+    assert limiter.reserve() == 0
+    relogio.agora += 100
+    assert [limiter.reserve() for _ in range(4)][-1] > 0  # o balde não passa da rajada
+
+
+def test_throttle_halves_rate_and_blocks(relogio, monkeypatch):
+    monkeypatch.setattr(integracao, 'OMIE_TAXA_MINIMA', 0.5)
+    limiter = integracao.OmieRateLimiter('app', taxa_maxima=2, rajada=3)
+    limiter.on_throttle(30)
+    assert limiter.rate == 1
+    assert limiter.reserve() == 30
+    limiter.on_throttle(10)  # um bloqueio mais curto não encurta o anterior
+    assert limiter.reserve() == 30
+    limiter.on_throttle()
+    assert limiter.rate == 0.5  # não cai abaixo da taxa mínima
+    assert limiter.reserve() == integracao.OMIE_BACKOFF_PADRAO
+
+
+def test_success_raises_rate_back_to_maximum():
+    limiter = integracao.OmieRateLimiter('app', taxa_maxima=2, rajada=3, state={'rate': 1})
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.rate == pytest.approx(1.8)
+    limiter.on_success()
+    limiter.on_success()
+    assert limiter.rate == 2
+
+
+def test_restored_state_is_clamped(relogio):
+    limiter = integracao.OmieRateLimiter('app', taxa_maxima=2, rajada=3,
+                                         state={'rate': 9, 'tokens': 9, 'updated': relogio.agora + 60})
+    assert (limiter.rate, limiter.tokens, limiter.updated) == (2, 3, relogio.agora)
+
+
+def test_limiter_state_survives_restart(relogio):
+    integracao.get_rate_limiter('app').on_throttle(120)
+    integracao.save_rate_limiters()
+    integracao._rate_limiters.clear()
+    assert integracao.get_rate_limiter('app').reserve() == 120
+
+
+@pytest.mark.parametrize('resposta, espera', [
+    (Resposta(200, {"nCodNF": 1}), None),
+    (Resposta(500, {"faultcode": "SOAP-ENV:Client-102", "faultstring": "Nota já cadastrada"}), None),
+    (Resposta(429, headers={'Retry-After': '7'}), 7),
+    (Resposta(429), 0),
+    (Resposta(500, {"faultcode": "MISUSE_API_PROCESS",
+                    "faultstring": "Consumo redundante detectado. Aguarde 45 segundos."}), 45),
+])
+def test_omie_throttle_wait(resposta, espera):
+    assert integracao.omie_throttle_wait(resposta, resposta.dados) == espera
+
+
+def test_call_omie_waits_out_throttling_and_retries(monkeypatch, relogio, loja):
+    respostas = [Resposta(429, headers={'Retry-After': '20'}), Resposta(200, {"nCodNF": 1})]
+    monkeypatch.setattr(integracao, 'http_request', lambda *args, **kwargs: respostas.pop(0))
+    response, dados = integracao.call_omie(loja, integracao.OMIE_API_URL, "IncluirNfce", [{}], 'omie_envio')
+    assert dados == {"nCodNF": 1}
+    assert relogio.esperas == [20]
+    assert integracao.get_rate_limiter(loja.omie_app_key).throttled == 1
+
+
+def test_call_omie_gives_up_after_max_attempts(monkeypatch, relogio, loja):
+    monkeypatch.setattr(integracao, 'OMIE_MAX_TENTATIVAS', 2)
+    monkeypatch.setattr(integracao, 'http_request', lambda *args, **kwargs: Resposta(429, headers={'Retry-After': '1'}))
+    with pytest.raises(Exception, match="persistiu após 2 tentativas"):
+        integracao.call_omie(loja, integracao.OMIE_API_URL, "IncluirNfce", [{}], 'omie_envio')
@@ -0,0 +1,96 @@
+import pytest
+
+import integracao
+
+DUPLICADA = {"faultcode": "SOAP-ENV:Client-3333", "faultstring": "Cupom fiscal já cadastrado"}
+RECUSADA = {"faultcode": "SOAP-ENV:Client-102", "faultstring": "Campo obrigatório ausente"}
+ACEITA = {"codigo_status": "0", "descricao_status": "Cupom incluído com sucesso"}
+
+
+class Resposta:
+    def __init__(self, status_code=200, text=''):
+        self.status_code = status_code
+        self.text = text
+
+
+class OmieFalso:
+    """Substitui post_omie_nfce: cada chamada consome a próxima resposta de `lote`
+    (envio com mais de uma nota) ou responde pelas notas avulsas em `avulsas`."""
+
+    def __init__(self, lote=(), avulsas=None):
+        self.lote = list(lote)
+        self.avulsas = avulsas or {}
+        self.chamadas = []
+
+    def __call__(self, store_config, param, deadline=None):
+        self.chamadas.append([omie_json["nfce"]["nfceMd5"] for omie_json in param])
+        if len(param) == 1:
+            resposta = self.avulsas.get(param[0]["nfce"]["nfceMd5"], ACEITA)
+        else:
+            resposta = self.lote.pop(0)
+        if isinstance(resposta, Exception):
+            raise resposta
+        return Resposta(), resposta
+
+
+@pytest.fixture
+def omie(monkeypatch):
+    def instalar(**kwargs):
+        falso = OmieFalso(**kwargs)
+        monkeypatch.setattr(integracao, 'post_omie_nfce', falso)
+        return falso
+    return instalar
+
+
+def test_batch_maps_list_response_by_position(omie, loja, nota):
+    falso = omie(lote=[[ACEITA, DUPLICADA, RECUSADA, ACEITA]], avulsas={'md5-2': ACEITA})
+    statuses = integracao.process_omie_batch(loja, [nota(n) for n in range(4)])
+    assert statuses == ['enviada', 'duplicada', 'enviada', 'enviada']
+    # Só a nota com fault próprio é reenviada
+    assert falso.chamadas == [['md5-0', 'md5-1', 'md5-2', 'md5-3'], ['md5-2']]
+    dedup = integracao.get_dedup_store()
+    assert [dedup.seen(f'md5-{n}') for n in range(4)] == ['enviada', 'duplicada', 'enviada', 'enviada']
+
+
+def test_batch_item_refused_again_alone_is_erro(omie, loja, nota):
+    omie(lote=[[ACEITA, RECUSADA]], avulsas={'md5-1': RECUSADA})
+    assert integracao.process_omie_batch(loja, [nota(0), nota(1)]) == ['enviada', 'erro']
+    assert integracao.get_dedup_store().seen('md5-1') is None
+
+
+def test_batch_skips_notes_already_sent(omie, loja, nota):
+    integracao.get_dedup_store().mark('md5-1', 'enviada', nota(1)["NFe"]["chNFe"], loja.name)
+    falso = omie(lote=[[ACEITA, ACEITA]])
+    statuses = integracao.process_omie_batch(loja, [nota(0), nota(1), nota(2)])
+    assert statuses == ['enviada', 'ignorada', 'enviada']
+    assert falso.chamadas == [['md5-0', 'md5-2']]
+
+
+def test_batch_with_one_new_note_is_sent_alone(omie, loja, nota):
+    integracao.get_dedup_store().mark('md5-0', 'duplicada', None, loja.name)
+    falso = omie()
+    assert integracao.process_omie_batch(loja, [nota(0), nota(1)]) == ['ignorada', 'enviada']
+    assert falso.chamadas == [['md5-1']]
+
+
+@pytest.mark.parametrize('resposta', [
+    ACEITA,  # uma resposta só, sem resultado por nota
+    RECUSADA,  # lote recusado por inteiro
+    [ACEITA, ACEITA],  # lista com tamanho diferente do lote
+    'texto',
+    Exception("conexão recusada"),
+], ids=['dict-sem-fault', 'fault-do-lote', 'lista-curta', 'texto', 'excecao'])
+def test_batch_ambiguous_response_resends_each_note(omie, loja, resposta, nota):
+    # O Omie recusa como duplicada a nota que já tinha aceitado no lote
+    falso = omie(lote=[resposta], avulsas={'md5-0': DUPLICADA})
+    statuses = integracao.process_omie_batch(loja, [nota(n) for n in range(3)])
+    assert statuses == ['duplicada', 'enviada', 'enviada']
+    assert falso.chamadas == [['md5-0', 'md5-1', 'md5-2'], ['md5-0'], ['md5-1'], ['md5-2']]
+
+
+def test_batch_timeout_leaves_notes_pending(omie, loja, nota):
+    omie(lote=[TimeoutError("Operation timed out.")])
+    assert integracao.process_omie_batch(loja, [nota(0), nota(1)]) == ['interrompida', 'interrompida']
+    dedup = integracao.get_dedup_store()
+    assert dedup.seen('md5-0') is None
+    assert dedup.statuses(loja.name)[0] == {'md5-0': 'pendente', 'md5-1': 'pendente'}
@@ -0,0 +1,100 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import integracao
+
+
+def xml(hora):
+    return f"<NFe><infNFe><ide><dhEmi>2024-10-23T{hora:02d}:00:00</dhEmi></ide></infNFe></NFe>"
+
+
+def hora(xml_data):
+    return integracao.nfce_dh_emi(xml_data).hour
+
+
+@pytest.fixture
+def pipeline(monkeypatch, loja, nota):
+    """Conversão, campos da loja e envio substituídos: o payload da nota é nota(hora)."""
+    monkeypatch.setattr(integracao, 'ARQUIVO_DIR', '')
+    monkeypatch.setattr(integracao, 'convert_xml_cached', lambda xml_data, store_name=None: nota(hora(xml_data)))
+    monkeypatch.setattr(integracao, 'apply_store_fields', lambda store_name, omie_json, invoice: omie_json)
+    monkeypatch.setattr(integracao, 'process_omie_invoice', lambda store_config, omie_json, deadline=None: "enviada")
+    monkeypatch.setattr(integracao.config, 'stores', {loja.name: loja})
+    return monkeypatch
+
+
+def test_watermark_store_never_moves_back():
+    marcas = integracao.get_watermark_store()
+    assert marcas.load('teste') is None
+    marcas.advance('teste', datetime(2024, 10, 23, 12))
+    marcas.advance('teste', datetime(2024, 10, 23, 9))
+    assert marcas.load('teste') == datetime(2024, 10, 23, 12)
+    marcas.advance('teste', datetime(2024, 10, 24))
+    assert integracao.WatermarkStore().load('teste') == datetime(2024, 10, 24)
+
+
+def test_watermark_tracker_stops_before_oldest_failure():
+    tracker = integracao.WatermarkTracker()
+    tracker.observe(datetime(2024, 10, 23, 10), True)
+    tracker.observe(datetime(2024, 10, 23, 12), False)
+    tracker.observe(datetime(2024, 10, 23, 14), True)
+    assert tracker.value() == datetime(2024, 10, 23, 11, 59, 59)
+
+
+def test_watermark_tracker_failure_without_dh_emi_holds_it():
+    tracker = integracao.WatermarkTracker()
+    tracker.observe(datetime(2024, 10, 23, 10), True)
+    tracker.observe(None, True)
+    assert tracker.value() == datetime(2024, 10, 23, 10)
+    tracker.observe(None, False)
+    assert tracker.value() is None
+
+
+def test_store_window_uses_watermark_with_overlap(monkeypatch):
+    monkeypatch.setattr(integracao, 'ZIG_SOBREPOSICAO_HORAS', 2)
+    fim = datetime(2024, 10, 24)
+    assert integracao.store_window('teste', to_date=fim)[2] is None
+    integracao.get_watermark_store().advance('teste', datetime(2024, 10, 23, 12))
+    assert integracao.store_window('teste', to_date=fim) == (datetime(2024, 10, 23, 10), fim, datetime(2024, 10, 23, 10))
+    backfill = integracao.store_window('teste', datetime(2024, 10, 1), fim)
+    assert backfill == (datetime(2024, 10, 1), fim, None)
+
+
+@pytest.mark.parametrize('etapa', ['conversao', 'campos_da_loja'])
+def test_failed_note_holds_watermark_at_its_dh_emi(pipeline, loja, nota, etapa):
+    def falha(n):
+        if n == 12:
+            raise sqlite3.OperationalError("database is locked")
+        return nota(n)
+
+    if etapa == 'conversao':
+        pipeline.setattr(integracao, 'convert_xml_cached', lambda xml_data, store_name=None: falha(hora(xml_data)))
+    else:
+        pipeline.setattr(integracao, 'apply_store_fields',
+                         lambda store_name, omie_json, invoice: falha(int(omie_json["nfce"]["nfceMd5"][4:])))
+    tracker = integracao.WatermarkTracker()
+    invoices = [(1, {"xml": xml(hora)}) for hora in (10, 12, 14)] + [(1, None)]
+    results = integracao.run_store_pipeline(loja, iter(invoices), watermark=tracker)
+    assert results == {'enviada': 2, 'erro': 1}
+    assert tracker.value() == datetime(2024, 10, 23, 11, 59, 59)
+
+
+def test_watermark_advances_only_after_the_whole_window(pipeline, loja):
+    def invoices(store_config, from_date, to_date, start_page=1, deadline=None):
+        yield 1, {"xml": xml(14)}
+        yield 1, None
+        if falhar:
+            raise Exception("falha na página 2")
+        yield 2, {"xml": xml(10)}
+        yield 2, None
+
+    pipeline.setattr(integracao, 'iter_invoices', invoices)
+    falhar = True
+    integracao.execute_store_integration(loja.name)
+    assert integracao.get_watermark_store().load(loja.name) is None
+
+    falhar = False
+    integracao.execute_store_integration(loja.name)
+    assert integracao.get_watermark_store().load(loja.name) == datetime(2024, 10, 23, 14)
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+import integracao
+
+
+def test_deadline_expires_and_check_raises():
+    deadline = integracao.Deadline(0.05)
+    assert 0 < deadline.remaining() <= 0.05
+    deadline.check()
+    time.sleep(0.06)
+    assert deadline.expired()
+    with pytest.raises(TimeoutError):
+        deadline.check()
+
+
+def test_timeout_cancels_the_deadline_on_exit():
+    with integracao.timeout(60) as deadline:
+        assert not deadline.expired()
+    assert deadline.remaining() == 0
+    with pytest.raises(TimeoutError):
+        deadline.check()
+
+
+def test_deadline_sleep_is_capped_and_wakes_on_cancel():
+    deadline = integracao.Deadline(0.05)
+    inicio = time.monotonic()
+    deadline.sleep(10)
+    assert time.monotonic() - inicio < 1
+
+    deadline = integracao.Deadline(60)
+    threading.Timer(0.05, deadline.cancel).start()
+    inicio = time.monotonic()
+    deadline.sleep(10)
+    assert time.monotonic() - inicio < 1
+
+
+def test_cancel_active_run():
+    assert not integracao.cancel_active_run('teste')
+    with integracao.timeout(60) as deadline, integracao.active_run('teste', deadline):
+        assert integracao.active_run_names() == {'teste'}
+        assert integracao.cancel_active_run('teste')
+        assert deadline.expired()
+    assert integracao.active_run_names() == set()
+
+
+class Sessao:
+    def __init__(self):
+        self.timeouts = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        return type('Resposta', (), {'status_code': 200})()
+
+
+@pytest.fixture
+def sessao(monkeypatch):
+    sessao = Sessao()
+    monkeypatch.setattr(integracao, 'get_http_session', lambda url: sessao)
+    return sessao
+
+
+def test_http_timeouts_are_capped_by_the_deadline(sessao):
+    integracao.http_request("GET", integracao.ZIG_API_URL, "zig.invoice", deadline=integracao.Deadline(2))
+    [(conexao, leitura)] = sessao.timeouts
+    assert conexao <= min(integracao.HTTP_TIMEOUT_CONEXAO, 2)
+    assert leitura <= 2
+
+
+def test_http_request_is_not_made_after_the_deadline(sessao):
+    deadline = integracao.Deadline(60)
+    deadline.cancel()
+    with pytest.raises(TimeoutError):
+        integracao.http_request("GET", integracao.ZIG_API_URL, "zig.invoice", deadline=deadline)
+    assert sessao.timeouts == []
+
+
+def test_expired_run_sends_nothing_new_and_raises(monkeypatch, loja, nota):
+    monkeypatch.setattr(integracao, 'ARQUIVO_DIR', '')
+    monkeypatch.setattr(integracao, 'convert_xml_cached', lambda xml_data, store_name=None: nota(int(xml_data[6:-2])))
+    monkeypatch.setattr(integracao, 'apply_store_fields', lambda store_name, omie_json, invoice: omie_json)
+    deadline = integracao.Deadline(60)
+    enviadas = []
+
+    def process(store_config, omie_json, deadline=None):
+        enviadas.append(omie_json["nfce"]["nfceMd5"])
+        deadline.cancel()  # prazo esgota durante o primeiro envio
+        return "enviada"
+
+    monkeypatch.setattr(integracao, 'process_omie_invoice', process)
+    concluidas = []
+    invoices = iter([(1, {"xml": f"<nota {n}/>"}) for n in range(1, 6)] + [(1, None)])
+    with pytest.raises(TimeoutError):
+        integracao.run_store_pipeline(loja, invoices, integracao.PageCheckpoint(concluidas.append), {}, deadline)
+    assert enviadas == ["md5-1"]
+    assert concluidas == []  # a página não é confirmada: a próxima execução a busca de novo
+    assert "md5-1" not in integracao.get_work_queue().pending_md5s(loja.name)  # as interrompidas ficam na fila
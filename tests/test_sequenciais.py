@@ -0,0 +1,55 @@
+import integracao
+
+
+def reservado(alocador, tipo='seqCaixa'):
+    return alocador.conn.execute('SELECT valor FROM sequenciais WHERE tipo = ?', (tipo,)).fetchone()[0]
+
+
+def test_sequence_allocator_never_repeats_across_instances(monkeypatch):
+    monkeypatch.setattr(integracao, 'SEQUENCIAL_LOTE', 3)
+    primeiro = integracao.SequenceAllocator()
+    segundo = integracao.SequenceAllocator()
+    valores = [primeiro.next('seqCaixa'), segundo.next('seqCaixa'), primeiro.next('seqCaixa'),
+               segundo.next('seqCaixa'), primeiro.next('seqCaixa'), primeiro.next('seqCaixa')]
+    assert valores == [1, 4, 2, 5, 3, 7]
+    assert primeiro.next('seqCupom') == 1
+
+
+def test_sequence_allocator_release_returns_unused_tail(monkeypatch):
+    monkeypatch.setattr(integracao, 'SEQUENCIAL_LOTE', 10)
+    alocador = integracao.SequenceAllocator()
+    assert [alocador.next('seqCaixa') for _ in range(3)] == [1, 2, 3]
+    alocador.release()
+    assert integracao.SequenceAllocator().next('seqCaixa') == 4
+
+
+def test_sequence_allocator_release_keeps_blocks_reserved_later(monkeypatch):
+    monkeypatch.setattr(integracao, 'SEQUENCIAL_LOTE', 10)
+    primeiro = integracao.SequenceAllocator()
+    primeiro.next('seqCaixa')
+    segundo = integracao.SequenceAllocator()
+    assert segundo.next('seqCaixa') == 11
+    primeiro.release()  # outro processo reservou depois: a sobra não volta
+    assert integracao.SequenceAllocator().next('seqCaixa') == 21
+
+
+def test_reserve_only_reserves_when_short(monkeypatch):
+    monkeypatch.setattr(integracao, 'SEQUENCIAL_LOTE', 10)
+    alocador = integracao.SequenceAllocator()
+    alocador.reserve(4)
+    assert reservado(alocador) == reservado(alocador, 'seqCupom') == 10
+    assert [alocador.next('seqCaixa') for _ in range(6)] == [1, 2, 3, 4, 5, 6]
+    alocador.reserve(4)  # sobram exatamente 4
+    assert reservado(alocador) == 10
+    alocador.reserve(5)
+    assert reservado(alocador) == 20
+    assert [alocador.next('seqCaixa') for _ in range(5)] == [7, 8, 9, 10, 11]
+
+
+def test_reserve_covers_batches_larger_than_the_block(monkeypatch):
+    monkeypatch.setattr(integracao, 'SEQUENCIAL_LOTE', 10)
+    alocador = integracao.SequenceAllocator()
+    alocador.reserve(25)
+    assert reservado(alocador) == 25
+    assert [alocador.next('seqCupom') for _ in range(25)] == list(range(1, 26))
+    assert reservado(alocador, 'seqCupom') == 25
@@ -0,0 +1,212 @@
+import json
+import time
+from datetime import datetime
+
+import pytest
+
+import integracao
+
+INICIO, FIM = datetime(2024, 10, 23), datetime(2024, 10, 24)
+
+
+class Paginas(dict):
+    def __init__(self):
+        super().__init__()
+        self.buscadas = []
+
+
+@pytest.fixture
+def paginas(monkeypatch):
+    """stream_invoices falso: `paginas[n]` é a lista de notas da página n (vazia se ausente)."""
+    paginas = Paginas()
+
+    def stream_invoices(store_config, from_date, to_date, page, deadline=None):
+        paginas.buscadas.append(page)
+        conteudo = paginas.get(page, [])
+        if isinstance(conteudo, Exception):
+            raise conteudo
+        yield from conteudo
+
+    monkeypatch.setattr(integracao, 'stream_invoices', stream_invoices)
+    return paginas
+
+
+def notas(*ns):
+    return [{"xml": f"<nota {n}/>"} for n in ns]
+
+
+def percorre(loja, start_page=1):
+    return [(page, invoice and invoice["xml"]) for page, invoice in
+            integracao.iter_invoices(loja, INICIO, FIM, start_page)]
+
+
+def test_walks_every_page_until_an_empty_one(paginas, loja):
+    paginas.update({1: notas(1, 2), 2: notas(3)})
+    assert percorre(loja) == [(1, "<nota 1/>"), (1, "<nota 2/>"), (1, None), (2, "<nota 3/>"), (2, None)]
+    assert paginas.buscadas == [1, 2, 3]
+
+
+def test_starts_from_the_given_page(paginas, loja):
+    paginas.update({1: notas(1), 2: notas(2), 3: notas(3)})
+    assert percorre(loja, start_page=3) == [(3, "<nota 3/>"), (3, None)]
+
+
+def test_stops_when_a_page_repeats_the_previous_one(paginas, loja):
+    # API que ignora o parâmetro page devolveria sempre a mesma página
+    paginas.update({1: notas(1, 2), 2: notas(1, 2)})
+    assert percorre(loja) == [(1, "<nota 1/>"), (1, "<nota 2/>"), (1, None)]
+
+
+def test_fetch_error_reaches_the_consumer(paginas, loja):
+    paginas.update({1: notas(1), 2: ConnectionError("ZIG fora do ar")})
+    recebidas = []
+    with pytest.raises(ConnectionError):
+        for item in integracao.iter_invoices(loja, INICIO, FIM):
+            recebidas.append(item)
+    assert recebidas == [(1, {"xml": "<nota 1/>"}), (1, None)]
+
+
+def test_prefetch_buffer_is_bounded(monkeypatch, paginas, loja):
+    monkeypatch.setattr(integracao, 'ZIG_PREFETCH_NOTAS', 2)
+    lidas = []
+    paginas[1] = (lidas.append(nota) or nota for nota in notas(*range(50)))
+    itens = integracao.iter_invoices(loja, INICIO, FIM)
+    assert next(itens) == (1, {"xml": "<nota 0/>"})
+    time.sleep(0.2)
+    assert len(lidas) <= 4  # a entregue, duas no buffer e uma esperando vaga
+    itens.close()  # o produtor para sem ler o resto da página
+    assert paginas.buscadas == [1]
+
+
+def test_checkpoint_completes_pages_in_order():
+    concluidas = []
+    checkpoint = integracao.PageCheckpoint(concluidas.append)
+    for page in (1, 1, 2):
+        checkpoint.add(page)
+    checkpoint.close(1)
+    checkpoint.close(2)
+    checkpoint.done(2)
+    assert concluidas == []  # a página 1 ainda tem notas pendentes
+    checkpoint.done(1)
+    assert concluidas == []
+    checkpoint.done(1)
+    assert concluidas == [1, 2]
+
+
+def test_checkpoint_waits_for_the_page_to_be_closed():
+    concluidas = []
+    checkpoint = integracao.PageCheckpoint(concluidas.append)
+    checkpoint.add(1)
+    checkpoint.done(1)
+    assert concluidas == []  # ainda podem chegar notas da página 1
+    checkpoint.close(1)
+    checkpoint.close(2)  # página sem notas novas
+    assert concluidas == [1, 2]
+
+
+def test_page_cursor_resumes_only_the_same_window():
+    assert integracao.load_page_cursor('teste', INICIO, FIM) == 1
+    integracao.save_page_cursor('teste', INICIO, FIM, 4)
+    assert integracao.load_page_cursor('teste', INICIO, FIM) == 4
+    assert integracao.load_page_cursor('teste', INICIO, datetime(2024, 10, 25)) == 1
+    integracao.clear_page_cursor('teste')
+    assert integracao.load_page_cursor('teste', INICIO, FIM) == 1
+
+
+def le_em_blocos(dados, tamanho):
+    stream = integracao.JsonArrayStream()
+    itens = []
+    for i in range(0, len(dados), tamanho):
+        itens += stream.feed(dados[i:i + tamanho])
+    stream.close()
+    return itens
+
+
+@pytest.mark.parametrize('tamanho', [1, 2, 7, 1 << 16])
+def test_json_stream_yields_each_element(tamanho):
+    # Separadores dentro das strings e caracteres multibyte partidos entre blocos
+    notas_zig = [{"xml": '<xProd>Ação "especial" [1], {2}</xProd>'}, {"xml": "€ ]"}, {"xml": ""}]
+    dados = (' \n[' + ' , '.join(json.dumps(n, ensure_ascii=False) for n in notas_zig) + ']\n').encode('utf-8')
+    assert le_em_blocos(dados, tamanho) == notas_zig
+
+
+def test_json_stream_hands_out_elements_before_the_end():
+    stream = integracao.JsonArrayStream()
+    assert stream.feed(b'[{"xml": "a"}, {"xm') == [{"xml": "a"}]
+    assert stream.feed(b'l": "b"}]') == [{"xml": "b"}]
+    stream.close()
+
+
+@pytest.mark.parametrize('dados', [b'[]', b'  [ ]  '])
+def test_json_stream_empty_page(dados):
+    assert le_em_blocos(dados, 1) == []
+
+
+@pytest.mark.parametrize('dados', [b'{"erro": "token"}', b'[{"xml": "a"}', b'', b'[{"xml": "a"},'])
+def test_json_stream_rejects_invalid_pages(dados):
+    with pytest.raises(ValueError):
+        le_em_blocos(dados, 3)
+
+
+class RespostaZig:
+    def __init__(self, status_code, corpo):
+        self.status_code = status_code
+        self.corpo = corpo
+        self.fechada = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.corpo), chunk_size):
+            yield self.corpo[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechada = True
+
+
+@pytest.fixture
+def resposta(monkeypatch):
+    resposta = RespostaZig(200, json.dumps(notas(1, 2)).encode())
+    pedidos = []
+
+    def http_request(method, url, endpoint, deadline=None, **kwargs):
+        pedidos.append(kwargs)
+        return resposta
+
+    monkeypatch.setattr(integracao, 'http_request', http_request)
+    monkeypatch.setattr(integracao, 'ZIG_BLOCO_BYTES', 5)
+    resposta.pedidos = pedidos
+    return resposta
+
+
+def test_stream_invoices_reads_the_page_in_blocks(resposta, loja):
+    assert list(integracao.stream_invoices(loja, INICIO, FIM, 3)) == notas(1, 2)
+    [pedido] = resposta.pedidos
+    assert pedido['stream'] is True
+    assert pedido['params'] == {"dtinicio": "2024-10-23", "dtfim": "2024-10-24", "loja": loja.zig_rede, "page": "3"}
+    assert resposta.fechada
+
+
+def test_stream_invoices_releases_the_response_when_stopped_early(resposta, loja):
+    itens = integracao.stream_invoices(loja, INICIO, FIM, 1)
+    next(itens)
+    itens.close()
+    assert resposta.fechada
+
+
+def test_stream_invoices_rejects_unexpected_status(resposta, loja):
+    resposta.status_code = 401
+    with pytest.raises(Exception, match="Unexpected status: 401"):
+        list(integracao.stream_invoices(loja, INICIO, FIM, 1))
+    assert resposta.fechada
+
+
+def test_xml_events_do_not_depend_on_block_size(xml_nfce):
+    xml_data = xml_nfce(7, itens=3)
+
+    def eventos(bloco):
+        return [(elem.tag, elem.text) for _, elem in integracao._pull_events(xml_data, bloco)]
+
+    assert eventos(7) == eventos(len(xml_data))
+    assert integracao.parse_nfe_record(xml_data).nNF == '7'